@@ -0,0 +1,127 @@
+"""
+Codificación de exportaciones en paralelo (WebP, AVIF, JPEG progresivo y PNG)
+
+Está separado de texto_imagenes_audio.py porque ProcessPoolExecutor necesita
+importar la función de trabajo en los procesos hijos, y el script de
+Streamlit no se puede importar sin ejecutar toda la interfaz.
+"""
+
+import importlib
+import io
+import multiprocessing
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+from PIL import Image, features
+
+EXPORT_FORMATS = {
+    "webp": {"label": "WebP", "extension": "webp", "mime": "image/webp"},
+    "avif": {"label": "AVIF", "extension": "avif", "mime": "image/avif"},
+    "jpeg": {"label": "JPEG progresivo", "extension": "jpg", "mime": "image/jpeg"},
+    "png": {"label": "PNG", "extension": "png", "mime": "image/png"}
+}
+
+
+def available_formats() -> List[str]:
+    """Formatos que la instalación de Pillow puede escribir (AVIF solo si hay soporte)"""
+    formats = []
+    for fmt in EXPORT_FORMATS:
+        if fmt == "webp" and not features.check("webp"):
+            continue
+        if fmt == "avif" and not _avif_supported():
+            continue
+        formats.append(fmt)
+    return formats
+
+
+def _avif_supported() -> bool:
+    # Pillow >= 11.3 trae AVIF; en versiones anteriores existe el plugin pillow-avif-plugin
+    try:
+        if features.check("avif"):
+            return True
+    except ValueError:
+        pass
+    try:
+        # Importarlo registra el códec en Pillow; el módulo en sí no se usa
+        importlib.import_module("pillow_avif")
+        return True
+    except ImportError:
+        return False
+
+
+def encode_image(image_bytes: bytes, fmt: str, quality: int) -> Tuple[bytes, float]:
+    """
+    Codifica una imagen (bytes en cualquier formato legible) al formato pedido
+
+    Returns:
+        (bytes codificados, segundos de codificación)
+    """
+    if fmt == "avif":
+        _avif_supported()  # registra el plugin si hace falta
+    start = time.perf_counter()
+    image = Image.open(io.BytesIO(image_bytes))
+    image.load()
+    buffer = io.BytesIO()
+    if fmt == "jpeg":
+        image.convert("RGB").save(buffer, format="JPEG", quality=quality, progressive=True, optimize=True)
+    elif fmt == "webp":
+        image.save(buffer, format="WEBP", quality=quality, method=4)
+    elif fmt == "avif":
+        image.save(buffer, format="AVIF", quality=quality, speed=6)
+    elif fmt == "png":
+        image.save(buffer, format="PNG", optimize=True)
+    else:
+        raise ValueError(f"Formato de exportación no soportado: {fmt}")
+    return buffer.getvalue(), time.perf_counter() - start
+
+
+def create_export_pool(max_workers: Optional[int] = None) -> ProcessPoolExecutor:
+    """
+    Pool de procesos para codificar
+
+    Se usa "spawn" porque el servidor de Streamlit tiene muchos hilos y hacer
+    fork de un proceso con hilos puede dejar locks bloqueados en el hijo.
+    """
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+def encode_batch(pool: ProcessPoolExecutor, items: List[Tuple[str, bytes]], formats: List[str], quality: int) -> Tuple[Dict[str, Dict[str, Any]], float]:
+    """
+    Codifica todas las imágenes en todos los formatos pedidos usando el pool
+
+    Args:
+        pool: Pool de procesos (ver create_export_pool)
+        items: Lista de (nombre_base_sin_extensión, bytes de la imagen)
+        formats: Claves de EXPORT_FORMATS
+        quality: Calidad 1-100 (PNG la ignora: es sin pérdida)
+
+    Returns:
+        (resultados por formato, segundos de reloj del lote completo). Cada
+        formato incluye sus archivos, tamaño total y segundos de codificación
+        (suma de lo que tardó cada imagen en su proceso)
+    """
+    results: Dict[str, Dict[str, Any]] = {}
+    batch_start = time.perf_counter()
+    futures = {
+        (fmt, name): pool.submit(encode_image, image_bytes, fmt, quality)
+        for fmt in formats
+        for name, image_bytes in items
+    }
+    for (fmt, name), future in futures.items():
+        data, seconds = future.result()
+        entry = results.setdefault(fmt, {"files": [], "total_bytes": 0, "encode_seconds": 0.0})
+        entry["files"].append((f"{name}.{EXPORT_FORMATS[fmt]['extension']}", data))
+        entry["total_bytes"] += len(data)
+        entry["encode_seconds"] += seconds
+    return results, time.perf_counter() - batch_start
+
+
+def build_zip(files: List[Tuple[str, bytes]]) -> bytes:
+    """Empaqueta los archivos ya comprimidos (ZIP_STORED: recomprimir no ahorra nada)"""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as zip_file:
+        for filename, data in files:
+            zip_file.writestr(filename, data)
+    return buffer.getvalue()
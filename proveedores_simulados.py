@@ -0,0 +1,452 @@
+"""
+Proveedores simulados: servidor HTTP local que imita las APIs que usa la app
+
+Implementa lo mínimo de cada proveedor para ejecutar texto_imagenes_audio.py
+sin claves reales ni coste (pruebas de carga, desarrollo sin conexión):
+
+- Anthropic: POST /v1/messages, POST /v1/messages/batches,
+  GET /v1/messages/batches/<id> y GET /v1/messages/batches/<id>/results
+- Black Forest Labs: POST /v1/flux-pro-1.1, POST /v1/flux-pro-1.1-ultra,
+  GET /v1/get_result y GET /images/<id>.jpg (imagen generada localmente).
+  Si el envío trae webhook_url, al terminar se hace POST del resultado a esa
+  URL con la cabecera X-Webhook-Secret (como los avisos de BFL)
+- OpenAI: POST /v1/audio/speech (MP3 sintético)
+
+Con tail_rate > 0 una fracción de los renders y audios tarda tail_factor
+veces más (cola de latencia para probar el hedging)
+
+Con key_concurrency > 0 cada clave admite ese número de solicitudes a la vez
+(en Flux, de renders sin terminar) y las que se pasan reciben 429 con
+Retry-After, como los límites por clave de los proveedores reales
+
+Uso:
+    python proveedores_simulados.py --port 8765 --flux-latency 3
+
+y arrancar la app apuntando a él:
+    ANTHROPIC_API_URL=http://127.0.0.1:8765 BFL_API_URL=http://127.0.0.1:8765 \\
+    OPENAI_API_URL=http://127.0.0.1:8765 FLUX_POLL_INTERVAL=0.5 \\
+    streamlit run texto_imagenes_audio.py
+"""
+
+import argparse
+import hashlib
+import io
+import json
+import random
+import re
+import threading
+import time
+import urllib.request
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from PIL import Image
+
+# Cabecera de trama MPEG-1 Layer III, 128 kbps, 44.1 kHz (417 bytes por trama)
+MP3_FRAME_HEADER = b"\xff\xfb\x90\x64"
+MP3_FRAME_SIZE = 417
+
+SIMULATED_STORY = """Érase una vez un gato negro llamado Luna que vivía junto al río.
+
+Luna: ¿Has visto el collar azul que brilla por la noche?
+Tomás: Sí, lo encontré en el bosque, cerca de la cueva.
+Luna: Entonces debemos devolverlo antes del amanecer.
+Tomás: Vamos juntos, no tengas miedo.
+
+Al final, Luna y Tomás cruzaron el puente de madera y devolvieron el collar al viejo búho del bosque."""
+
+
+class SimulatedProviders:
+    """Estado y configuración de los proveedores simulados"""
+
+    def __init__(self, claude_latency: float = 0.2, flux_latency: float = 1.0, tts_latency: float = 0.2, batch_latency: float = 2.0,
+                 deliver_webhooks: bool = True, tail_rate: float = 0.0, tail_factor: float = 10.0,
+                 key_concurrency: int = 0):
+        self.claude_latency = claude_latency
+        self.flux_latency = flux_latency
+        self.tts_latency = tts_latency
+        self.batch_latency = batch_latency
+        # False simula avisos perdidos (la app debe volver al polling)
+        self.deliver_webhooks = deliver_webhooks
+        self.tail_rate = tail_rate
+        self.tail_factor = tail_factor
+        self.key_concurrency = key_concurrency
+        self.base_url = ""
+        self._lock = threading.Lock()
+        self._flux_jobs: Dict[str, Dict[str, Any]] = {}
+        self._batches: Dict[str, Dict[str, Any]] = {}
+        self._request_counts: Dict[str, int] = {}
+        self._active_by_key: Dict[str, int] = {}
+        self._requests_by_key: Dict[str, int] = {}
+
+    def _latency(self, base: float) -> float:
+        return base * self.tail_factor if random.random() < self.tail_rate else base
+
+    def count(self, route: str) -> None:
+        with self._lock:
+            self._request_counts[route] = self._request_counts.get(route, 0) + 1
+
+    def request_counts(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._request_counts)
+
+    def acquire_key(self, key: str) -> bool:
+        """Ocupa un hueco de la clave; False (429) si ya tiene key_concurrency solicitudes activas"""
+        with self._lock:
+            self._requests_by_key[key] = self._requests_by_key.get(key, 0) + 1
+            if self.key_concurrency and self._active_by_key.get(key, 0) >= self.key_concurrency:
+                return False
+            self._active_by_key[key] = self._active_by_key.get(key, 0) + 1
+            return True
+
+    def release_key(self, key: str) -> None:
+        with self._lock:
+            self._active_by_key[key] = max(0, self._active_by_key.get(key, 0) - 1)
+
+    def key_counts(self) -> Dict[str, int]:
+        """Solicitudes recibidas por clave (incluidas las rechazadas con 429)"""
+        with self._lock:
+            return dict(self._requests_by_key)
+
+    # ----- Anthropic -----
+
+    def claude_message(self, payload: Dict[str, Any], latency: Optional[float] = None) -> Dict[str, Any]:
+        time.sleep(self.claude_latency if latency is None else latency)
+        system_prompt = payload.get("system", "")
+        if isinstance(system_prompt, list):
+            system_prompt = " ".join(block.get("text", "") for block in system_prompt)
+        user_text = " ".join(
+            message["content"] if isinstance(message["content"], str)
+            else " ".join(block.get("text", "") for block in message["content"])
+            for message in payload.get("messages", [])
+        )
+
+        if "análisis narrativo" in system_prompt:
+            scenes_match = re.search(r"NÚMERO DE ESCENAS A GENERAR:\s*(\d+)", user_text)
+            text = json.dumps(self._character_analysis(int(scenes_match.group(1)) if scenes_match else 3))
+        elif "prompts para modelos de AI de imágenes" in system_prompt:
+            text = "A small black cat with a glowing blue collar on a wooden bridge at sunset, cinematic composition"
+        else:
+            text = SIMULATED_STORY
+
+        return {
+            "id": f"msg_{uuid.uuid4().hex[:24]}",
+            "type": "message",
+            "role": "assistant",
+            "model": payload.get("model", ""),
+            "content": [{"type": "text", "text": text}],
+            "stop_reason": "end_turn",
+            "usage": {
+                "input_tokens": max(1, len(system_prompt + user_text) // 4),
+                "output_tokens": max(1, len(text) // 4)
+            }
+        }
+
+    @staticmethod
+    def _character_analysis(max_scenes: int) -> Dict[str, Any]:
+        characters = []
+        for name, description in (("Luna", "small black cat with yellow eyes"), ("Tomás", "young boy with red scarf")):
+            characters.append({
+                "name": name,
+                "type": "animal" if name == "Luna" else "human",
+                "physical_description": description,
+                "key_features": description.split(" with ") + ["blue glowing collar"],
+                "suggested_scenes": [
+                    {
+                        "action": f"{name} scene {index + 1}",
+                        "scene_description": f"Medium shot, {name} walking by the river, {description}, curious, forest path, golden afternoon light, variation {index + 1}",
+                        "visual_composition": "medium shot",
+                        "emotional_state": "curious",
+                        "lighting_mood": "golden afternoon light"
+                    }
+                    for index in range(max_scenes)
+                ]
+            })
+        return {
+            "has_characters": True,
+            "characters": characters,
+            "visual_style": "storybook",
+            "consistency_notes": "always show the blue collar"
+        }
+
+    def batch_create(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        batch_id = f"msgbatch_{uuid.uuid4().hex[:24]}"
+        with self._lock:
+            self._batches[batch_id] = {"created": time.monotonic(), "requests": payload.get("requests", [])}
+        return self.batch_status(batch_id)
+
+    def batch_status(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            batch = self._batches.get(batch_id)
+        if batch is None:
+            return None
+        ended = time.monotonic() - batch["created"] >= self.batch_latency
+        total = len(batch["requests"])
+        return {
+            "id": batch_id,
+            "type": "message_batch",
+            "processing_status": "ended" if ended else "in_progress",
+            "request_counts": {
+                "processing": 0 if ended else total,
+                "succeeded": total if ended else 0,
+                "errored": 0,
+                "canceled": 0,
+                "expired": 0
+            },
+            "results_url": f"{self.base_url}/v1/messages/batches/{batch_id}/results" if ended else None
+        }
+
+    def batch_results(self, batch_id: str) -> Optional[bytes]:
+        with self._lock:
+            batch = self._batches.get(batch_id)
+        if batch is None:
+            return None
+        lines = [
+            json.dumps({
+                "custom_id": request["custom_id"],
+                "result": {"type": "succeeded", "message": self.claude_message(request["params"], latency=0)}
+            }, ensure_ascii=False)
+            for request in batch["requests"]
+        ]
+        return "\n".join(lines).encode("utf-8")
+
+    # ----- Black Forest Labs -----
+
+    def flux_submit(self, endpoint: str, payload: Dict[str, Any], key: str = "") -> Dict[str, Any]:
+        job_id = uuid.uuid4().hex
+        latency = self._latency(self.flux_latency)
+        # La tarea ocupa su hueco de la clave hasta que termina
+        release_timer = threading.Timer(latency, self.release_key, (key,))
+        release_timer.daemon = True
+        release_timer.start()
+        with self._lock:
+            self._flux_jobs[job_id] = {
+                "created": time.monotonic(),
+                "latency": latency,
+                "endpoint": endpoint,
+                "width": int(payload.get("width", 1024)),
+                "height": int(payload.get("height", 1024)),
+                "seed": payload.get("seed", 42),
+                "prompt": payload.get("prompt", "")
+            }
+        if payload.get("webhook_url") and self.deliver_webhooks:
+            timer = threading.Timer(latency, self._send_webhook,
+                                    (job_id, payload["webhook_url"], payload.get("webhook_secret", "")))
+            timer.daemon = True
+            timer.start()
+        return {"id": job_id, "polling_url": f"{self.base_url}/v1/get_result?id={job_id}"}
+
+    def _send_webhook(self, job_id: str, url: str, secret: str) -> None:
+        body = json.dumps(dict(self.flux_result(job_id, finished=True), task_id=job_id)).encode("utf-8")
+        request = urllib.request.Request(
+            url, data=body, method="POST",
+            headers={"Content-Type": "application/json", "X-Webhook-Secret": secret}
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=10):
+                pass
+            self.count("WEBHOOK entregado")
+        except OSError:
+            self.count("WEBHOOK fallido")
+
+    def flux_result(self, job_id: str, finished: bool = False) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            job = self._flux_jobs.get(job_id)
+        if job is None:
+            return None
+        if not finished and time.monotonic() - job["created"] < job["latency"]:
+            return {"id": job_id, "status": "Pending", "result": None}
+        return {
+            "id": job_id,
+            "status": "Ready",
+            "result": {"prompt": job["prompt"], "seed": job["seed"], "sample": f"{self.base_url}/images/{job_id}.jpg"}
+        }
+
+    def flux_image(self, job_id: str) -> Optional[bytes]:
+        with self._lock:
+            job = self._flux_jobs.get(job_id)
+        if job is None:
+            return None
+        digest = hashlib.md5(f"{job['seed']}:{job['prompt']}".encode("utf-8")).digest()
+        image = Image.new("RGB", (job["width"], job["height"]), tuple(digest[:3]))
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=85)
+        return buffer.getvalue()
+
+    # ----- OpenAI -----
+
+    def tts(self, payload: Dict[str, Any]) -> bytes:
+        time.sleep(self._latency(self.tts_latency))
+        text = payload.get("input", "")
+        frames = max(1, len(text) // 20)
+        seed = hashlib.md5(f"{payload.get('voice')}:{text}".encode("utf-8")).digest()
+        frame_body = (seed * (MP3_FRAME_SIZE // len(seed) + 1))[:MP3_FRAME_SIZE - len(MP3_FRAME_HEADER)]
+        id3_header = b"ID3\x04\x00\x00\x00\x00\x00\x00"
+        return id3_header + (MP3_FRAME_HEADER + frame_body) * frames
+
+
+def make_handler(providers: SimulatedProviders):
+    """Crea la clase de handler HTTP ligada a un estado de proveedores"""
+
+    class ProviderHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _read_json(self) -> Dict[str, Any]:
+            length = int(self.headers.get("Content-Length", 0))
+            body = self.rfile.read(length) if length else b""
+            return json.loads(body or b"{}")
+
+        def _send(self, status: int, body: bytes, content_type: str = "application/json",
+                  headers: Optional[Dict[str, str]] = None) -> None:
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_json(self, status: int, data: Any, headers: Optional[Dict[str, str]] = None) -> None:
+            self._send(status, json.dumps(data).encode("utf-8"), headers=headers)
+
+        def _api_key(self) -> str:
+            authorization = self.headers.get("Authorization", "")
+            return (self.headers.get("x-api-key") or self.headers.get("x-key")
+                    or authorization.removeprefix("Bearer ").strip())
+
+        def do_POST(self):
+            path = urlparse(self.path).path
+            providers.count(f"POST {path}")
+            payload = self._read_json()
+            # Cada proveedor lleva su cuenta aunque se use el mismo texto de clave en todos
+            provider = {"/v1/messages": "anthropic", "/v1/audio/speech": "openai"}.get(path, "bfl")
+            key = f"{provider}:{self._api_key()}"
+            limited = path in ("/v1/messages", "/v1/flux-pro-1.1", "/v1/flux-pro-1.1-ultra", "/v1/audio/speech")
+            if limited and not providers.acquire_key(key):
+                providers.count(f"429 {path}")
+                self._send_json(429, {"error": "Límite de concurrencia de la clave"}, {"Retry-After": "1"})
+                return
+            if path in ("/v1/flux-pro-1.1", "/v1/flux-pro-1.1-ultra"):
+                # Flux libera el hueco al terminar el render, no al responder
+                self._send_json(200, providers.flux_submit(path.rsplit("/", 1)[-1], payload, key))
+                return
+            # El hueco se libera antes de responder: el cliente puede lanzar
+            # la siguiente solicitud en cuanto recibe esta
+            try:
+                if path == "/v1/messages":
+                    status, body, content_type = 200, json.dumps(providers.claude_message(payload)).encode("utf-8"), "application/json"
+                elif path == "/v1/messages/batches":
+                    status, body, content_type = 200, json.dumps(providers.batch_create(payload)).encode("utf-8"), "application/json"
+                elif path == "/v1/audio/speech":
+                    status, body, content_type = 200, providers.tts(payload), "audio/mpeg"
+                else:
+                    status, body, content_type = 404, json.dumps({"error": f"Ruta no simulada: {path}"}).encode("utf-8"), "application/json"
+            finally:
+                if limited:
+                    providers.release_key(key)
+            self._send(status, body, content_type)
+
+        def do_GET(self):
+            parsed = urlparse(self.path)
+            batch_match = re.fullmatch(r"/v1/messages/batches/([\w-]+)(/results)?", parsed.path)
+            if parsed.path.startswith("/images/"):
+                providers.count("GET /images/*")
+            elif batch_match:
+                providers.count("GET /v1/messages/batches/*" + (batch_match.group(2) or ""))
+            else:
+                providers.count(f"GET {parsed.path}")
+            if batch_match and batch_match.group(2):
+                results = providers.batch_results(batch_match.group(1))
+                if results is None:
+                    self._send_json(404, {"error": "Lote no encontrado"})
+                else:
+                    self._send(200, results, "application/binary")
+            elif batch_match:
+                batch = providers.batch_status(batch_match.group(1))
+                if batch is None:
+                    self._send_json(404, {"error": "Lote no encontrado"})
+                else:
+                    self._send_json(200, batch)
+            elif parsed.path == "/v1/get_result":
+                job_id = parse_qs(parsed.query).get("id", [""])[0]
+                result = providers.flux_result(job_id)
+                if result is None:
+                    self._send_json(404, {"status": "Task not found"})
+                else:
+                    self._send_json(200, result)
+            elif parsed.path.startswith("/images/"):
+                image_bytes = providers.flux_image(parsed.path[len("/images/"):].rsplit(".", 1)[0])
+                if image_bytes is None:
+                    self._send_json(404, {"error": "Imagen no encontrada"})
+                else:
+                    self._send(200, image_bytes, "image/jpeg")
+            else:
+                self._send_json(404, {"error": f"Ruta no simulada: {parsed.path}"})
+
+    return ProviderHandler
+
+
+def start_server(host: str = "127.0.0.1", port: int = 0, **latencies) -> Tuple[ThreadingHTTPServer, SimulatedProviders]:
+    """
+    Arranca el servidor simulado en un hilo daemon
+
+    Args:
+        host: Interfaz de escucha
+        port: Puerto (0 = elegir uno libre)
+        latencies: claude_latency, flux_latency, tts_latency, batch_latency en segundos
+            (deliver_webhooks=False simula avisos de Flux perdidos y
+            tail_rate/tail_factor una cola de solicitudes lentas y
+            key_concurrency el límite de solicitudes a la vez por clave)
+
+    Returns:
+        (servidor, proveedores); la URL base está en proveedores.base_url
+    """
+    providers = SimulatedProviders(**latencies)
+    server = ThreadingHTTPServer((host, port), make_handler(providers))
+    server.daemon_threads = True
+    providers.base_url = f"http://{host}:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, providers
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Servidor local que simula Anthropic, Black Forest Labs y OpenAI TTS")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--claude-latency", type=float, default=0.2, help="Segundos por llamada a Claude")
+    parser.add_argument("--flux-latency", type=float, default=1.0, help="Segundos hasta que una imagen está lista")
+    parser.add_argument("--tts-latency", type=float, default=0.2, help="Segundos por llamada de TTS")
+    parser.add_argument("--batch-latency", type=float, default=2.0, help="Segundos hasta que un lote termina")
+    parser.add_argument("--no-webhooks", action="store_true", help="No enviar avisos de Flux (simula avisos perdidos)")
+    parser.add_argument("--tail-rate", type=float, default=0.0, help="Fracción de renders y audios lentos")
+    parser.add_argument("--tail-factor", type=float, default=10.0, help="Cuántas veces más tardan los lentos")
+    parser.add_argument("--key-concurrency", type=int, default=0,
+                        help="Solicitudes a la vez por clave antes de responder 429 (0 = sin límite)")
+    args = parser.parse_args()
+
+    server, providers = start_server(
+        args.host, args.port,
+        claude_latency=args.claude_latency,
+        flux_latency=args.flux_latency,
+        tts_latency=args.tts_latency,
+        batch_latency=args.batch_latency,
+        deliver_webhooks=not args.no_webhooks,
+        tail_rate=args.tail_rate,
+        tail_factor=args.tail_factor,
+        key_concurrency=args.key_concurrency
+    )
+    print(f"Proveedores simulados escuchando en {providers.base_url} (Ctrl+C para salir)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+"""
+Prueba de carga multi-sesión para texto_imagenes_audio.py
+
+Lanza N sesiones simuladas con streamlit.testing (AppTest) que ejecutan el
+script real contra los proveedores simulados (proveedores_simulados.py), y
+mide por sesión el tiempo de cada rerun, el crecimiento de memoria (RSS) del
+proceso servidor y el rendimiento global.
+
+AppTest ejecuta el script dentro de este mismo proceso, así que la RSS medida
+es la del "servidor" que atiende todas las sesiones. Las ejecuciones del
+script se serializan (RUN_LOCK): varias AppTest a la vez compiten por el
+Runtime de Streamlit. Las generaciones sí corren en paralelo, en sus hilos.
+
+Uso:
+    python prueba_carga.py --sessions 8 --mode both
+    python prueba_carga.py --sessions 16 --mode sequence --flux-latency 2 --json carga.json
+    python prueba_carga.py --sessions 8 --mode sequence --tail-rate 0.1 --hedging
+    python prueba_carga.py --sessions 8 --mode sequence --key-concurrency 4 --keys 3
+"""
+
+import argparse
+import json
+import os
+import resource
+import socket
+import statistics
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+from streamlit.testing.v1 import AppTest
+
+import proveedores_simulados
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "texto_imagenes_audio.py")
+
+# Una sola ejecución de AppTest a la vez en todo el proceso
+RUN_LOCK = threading.Lock()
+
+
+def read_rss_bytes() -> int:
+    """RSS actual del proceso (Linux: /proc; resto: pico de getrusage)"""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class RssSampler(threading.Thread):
+    """Muestrea la RSS periódicamente para conocer el pico durante la prueba"""
+
+    def __init__(self, interval: float = 0.1):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = read_rss_bytes()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.peak = max(self.peak, read_rss_bytes())
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def run_session(index: int, mode: str, prompt: str, timeout: float, webhooks: bool = False, hedging: bool = False) -> Dict[str, Any]:
+    """Recorre el flujo de una sesión: carga, configuración, generación y rerun posterior"""
+    at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+    reruns: List[Dict[str, Any]] = []
+
+    def locked_run() -> float:
+        """Ejecuta el script en exclusiva y devuelve los segundos de espera por el lock"""
+        wait_start = time.perf_counter()
+        with RUN_LOCK:
+            queued = time.perf_counter() - wait_start
+            at.run()
+        if at.exception:
+            raise RuntimeError(at.exception[0].value)
+        return queued
+
+    def timed_run(label: str, wait_for_task: bool = False) -> None:
+        start = time.perf_counter()
+        queued = 0.0
+        try:
+            queued += locked_run()
+            # La generación corre en segundo plano: refrescar como lo haría el
+            # fragmento de progreso hasta que la tarea publique sus resultados
+            while wait_for_task and at.session_state["generation_task"] is not None:
+                time.sleep(0.2)
+                queued += locked_run()
+        except RuntimeError as e:
+            raise RuntimeError(f"{label}: {e}")
+        finally:
+            reruns.append({"step": label, "seconds": time.perf_counter() - start, "queued_seconds": queued})
+
+    result = {"session": index, "mode": mode, "reruns": reruns, "ok": False, "error": None}
+    session_start = time.perf_counter()
+    try:
+        timed_run("carga inicial")
+
+        for text_input in at.sidebar.text_input:
+            if "API Key" in text_input.label:
+                text_input.input("sk-simulada")
+        if mode == "sequence":
+            next(checkbox for checkbox in at.sidebar.checkbox if checkbox.label == "Activar modo secuencia").check()
+        if webhooks:
+            next(checkbox for checkbox in at.sidebar.checkbox if checkbox.label == "🔔 Avisos de Flux por webhook").check()
+        if hedging:
+            next(checkbox for checkbox in at.sidebar.checkbox if checkbox.label == "🏁 Duplicar solicitudes lentas (hedging)").check()
+        next(text_area for text_area in at.text_area if text_area.label == "Describe tu idea:").input(prompt)
+        timed_run("configuración")
+
+        next(button for button in at.button if "Generar Contenido Multimedia" in button.label).click()
+        timed_run("generación", wait_for_task=True)
+
+        # Rerun con resultados en pantalla (p. ej. al mover un control)
+        timed_run("rerun con resultados")
+        result["ok"] = bool(at.session_state["generation_complete"])
+        if not result["ok"]:
+            shown = [element.value for element in at.error]
+            result["error"] = "generación no completada" + (f": {shown[0]}" if shown else " (sin mensajes en pantalla)")
+    except Exception as e:
+        result["error"] = str(e)
+    result["total_seconds"] = time.perf_counter() - session_start
+    return result
+
+
+def find_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {}
+    ordered = sorted(values)
+    return {
+        "p50": statistics.median(ordered),
+        "p95": ordered[min(len(ordered) - 1, int(round(0.95 * (len(ordered) - 1))))],
+        "max": ordered[-1]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prueba de carga multi-sesión de la app Streamlit")
+    parser.add_argument("--sessions", type=int, default=4, help="Sesiones simultáneas")
+    parser.add_argument("--mode", choices=["normal", "sequence", "both"], default="both",
+                        help="Flujo a ejecutar (both alterna normal y secuencia)")
+    parser.add_argument("--claude-latency", type=float, default=0.2)
+    parser.add_argument("--flux-latency", type=float, default=1.0)
+    parser.add_argument("--tts-latency", type=float, default=0.2)
+    parser.add_argument("--poll-interval", type=float, default=0.25, help="Intervalo de polling de Flux en la app")
+    parser.add_argument("--webhooks", action="store_true",
+                        help="Recibir los resultados de Flux por webhook en lugar de polling")
+    parser.add_argument("--hedging", action="store_true",
+                        help="Duplicar las solicitudes que pasen del p90 de latencia")
+    parser.add_argument("--tail-rate", type=float, default=0.0,
+                        help="Fracción de renders y audios lentos en los proveedores simulados")
+    parser.add_argument("--key-concurrency", type=int, default=0,
+                        help="Solicitudes a la vez por clave en los proveedores simulados (0 = sin límite)")
+    parser.add_argument("--keys", type=int, default=0,
+                        help="Claves simuladas por proveedor en la configuración (pool de claves)")
+    parser.add_argument("--same-prompt", action="store_true",
+                        help="Todas las sesiones usan el mismo prompt (mide la agrupación de solicitudes)")
+    parser.add_argument("--timeout", type=float, default=600, help="Tiempo máximo por rerun")
+    parser.add_argument("--json", help="Ruta donde guardar el informe en JSON")
+    args = parser.parse_args()
+
+    server, providers = proveedores_simulados.start_server(
+        claude_latency=args.claude_latency,
+        flux_latency=args.flux_latency,
+        tts_latency=args.tts_latency,
+        tail_rate=args.tail_rate,
+        key_concurrency=args.key_concurrency
+    )
+    os.environ["ANTHROPIC_API_URL"] = providers.base_url
+    os.environ["BFL_API_URL"] = providers.base_url
+    os.environ["OPENAI_API_URL"] = providers.base_url
+    os.environ["FLUX_POLL_INTERVAL"] = str(args.poll_interval)
+    # Receptor de webhooks en un puerto libre para no chocar con una app en marcha
+    os.environ.setdefault("FLUX_WEBHOOK_PORT", str(find_free_port()))
+    # No contaminar el historial de latencias real con los proveedores simulados
+    os.environ["RENDER_HISTORY_PATH"] = os.path.join(tempfile.mkdtemp(prefix="prueba_carga_"), "render_history.json")
+    for provider in ("ANTHROPIC", "BFL", "OPENAI"):
+        if args.keys:
+            os.environ[f"{provider}_API_KEYS"] = ",".join(f"{provider.lower()}-simulada-{index}" for index in range(args.keys))
+
+    modes = [
+        ("sequence" if args.mode == "sequence" or (args.mode == "both" and index % 2) else "normal")
+        for index in range(args.sessions)
+    ]
+    prompts = [
+        "Un gato que viaja en el tiempo" if args.same_prompt else f"Un gato que viaja en el tiempo (sesión {index})"
+        for index in range(args.sessions)
+    ]
+
+    rss_start = read_rss_bytes()
+    sampler = RssSampler()
+    sampler.start()
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.sessions) as executor:
+        sessions = list(executor.map(run_session, range(args.sessions), modes, prompts,
+                                     [args.timeout] * args.sessions, [args.webhooks] * args.sessions,
+                                     [args.hedging] * args.sessions))
+    wall_seconds = time.perf_counter() - wall_start
+    sampler.stop()
+    rss_end = read_rss_bytes()
+    server.shutdown()
+
+    completed = [session for session in sessions if session["ok"]]
+    steps = sorted({rerun["step"] for session in sessions for rerun in session["reruns"]},
+                   key=lambda step: ["carga inicial", "configuración", "generación", "rerun con resultados"].index(step))
+    report = {
+        "sessions": args.sessions,
+        "mode": args.mode,
+        "webhooks": args.webhooks,
+        "hedging": args.hedging,
+        "tail_rate": args.tail_rate,
+        "key_concurrency": args.key_concurrency,
+        "keys": args.keys,
+        "completed": len(completed),
+        "failed": [{"session": s["session"], "error": s["error"]} for s in sessions if not s["ok"]],
+        "wall_seconds": wall_seconds,
+        "throughput_per_minute": len(completed) / wall_seconds * 60 if wall_seconds else 0.0,
+        "rss_start_mb": rss_start / 2**20,
+        "rss_peak_mb": sampler.peak / 2**20,
+        "rss_end_mb": rss_end / 2**20,
+        "rss_growth_mb": (rss_end - rss_start) / 2**20,
+        "rss_growth_per_session_mb": (rss_end - rss_start) / 2**20 / max(1, args.sessions),
+        "rerun_seconds": {
+            step: summarize([r["seconds"] for s in sessions for r in s["reruns"] if r["step"] == step])
+            for step in steps
+        },
+        "provider_requests": providers.request_counts(),
+        "requests_by_key": providers.key_counts(),
+        "per_session": sessions
+    }
+
+    print(f"\n=== Prueba de carga: {args.sessions} sesiones ({args.mode}) ===")
+    for session in sessions:
+        timings = ", ".join(f"{r['step']}: {r['seconds']:.2f}s" for r in session["reruns"])
+        status = "OK" if session["ok"] else f"FALLO ({session['error']})"
+        print(f"  Sesión {session['session']:>3} [{session['mode']:<8}] {status} | {timings}")
+    print("\nTiempo por rerun (s, incluida la espera por ejecutar el script en exclusiva):")
+    for step, stats in report["rerun_seconds"].items():
+        print(f"  {step:<22} p50 {stats['p50']:.2f} • p95 {stats['p95']:.2f} • máx {stats['max']:.2f}")
+    print(f"\nCompletadas: {len(completed)}/{args.sessions} en {wall_seconds:.1f}s "
+          f"→ {report['throughput_per_minute']:.1f} generaciones/min")
+    print(f"RSS: inicio {report['rss_start_mb']:.0f} MB • pico {report['rss_peak_mb']:.0f} MB • "
+          f"fin {report['rss_end_mb']:.0f} MB • crecimiento {report['rss_growth_mb']:.1f} MB "
+          f"({report['rss_growth_per_session_mb']:.1f} MB/sesión)")
+    print(f"Solicitudes a proveedores: {report['provider_requests']}")
+    if args.keys or args.key_concurrency:
+        print(f"Solicitudes por clave: {report['requests_by_key']}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"Informe guardado en {args.json}")
+
+
+if __name__ == "__main__":
+    main()
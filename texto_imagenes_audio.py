@@ -1,15 +1,137 @@
+from __future__ import annotations
+
+import time
+
+SCRIPT_START = time.perf_counter()
+
 import streamlit as st
-import requests
 import base64
+import importlib
 import io
-import time
-from PIL import Image
 from io import BytesIO
 import json
 import os
 import hashlib
 import re
-from typing import Optional, Dict, Any
+import math
+import contextlib
+import tracemalloc
+import shutil
+import tempfile
+import statistics
+import threading
+import random
+import uuid
+import unicodedata
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed, wait, FIRST_COMPLETED
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from collections import OrderedDict
+from typing import Optional, Dict, Any, List
+
+
+class LazyModule:
+    """
+    Módulo que se importa de verdad en el primer acceso a uno de sus atributos
+
+    requests, Pillow y el codificador (multiprocessing) solo hacen falta al
+    generar o exportar: diferirlos acelera la primera carga de la página en
+    un contenedor recién arrancado. Es seguro entre hilos.
+    """
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, attr: str):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+requests = LazyModule("requests")
+Image = LazyModule("PIL.Image")
+ImageDraw = LazyModule("PIL.ImageDraw")
+ImageFont = LazyModule("PIL.ImageFont")
+ImageOps = LazyModule("PIL.ImageOps")
+codificador_exportacion = LazyModule("codificador_exportacion")
+
+# Endpoints de los proveedores (sustituibles por servicios locales de prueba,
+# ver proveedores_simulados.py y prueba_carga.py)
+ANTHROPIC_API_URL = os.environ.get("ANTHROPIC_API_URL", "https://api.anthropic.com").rstrip("/")
+BFL_API_URL = os.environ.get("BFL_API_URL", "https://api.bfl.ml").rstrip("/")
+OPENAI_API_URL = os.environ.get("OPENAI_API_URL", "https://api.openai.com").rstrip("/")
+# Endpoints de respaldo para las solicitudes duplicadas (hedging); por defecto
+# el mismo proveedor, que atiende el duplicado en otra máquina
+BFL_API_URL_SECONDARY = os.environ.get("BFL_API_URL_SECONDARY", BFL_API_URL).rstrip("/")
+OPENAI_API_URL_SECONDARY = os.environ.get("OPENAI_API_URL_SECONDARY", OPENAI_API_URL).rstrip("/")
+FLUX_POLL_INTERVAL = float(os.environ.get("FLUX_POLL_INTERVAL", "5"))
+
+# Pools de claves de API por proveedor (ver KeyPool): nombre en la interfaz y
+# solicitudes simultáneas que admite cada clave (BFL: 24 tareas activas)
+API_KEY_PROVIDERS = {"anthropic": "Anthropic", "bfl": "Black Forest Labs", "openai": "OpenAI"}
+KEY_POOL_CONCURRENCY = {
+    "anthropic": int(os.environ.get("ANTHROPIC_KEY_CONCURRENCY", "8")),
+    "bfl": int(os.environ.get("BFL_KEY_CONCURRENCY", "24")),
+    "openai": int(os.environ.get("OPENAI_KEY_CONCURRENCY", "8"))
+}
+
+
+def configured_api_keys(provider: str) -> List[str]:
+    """
+    Claves de un proveedor en la configuración: variable <PROVEEDOR>_API_KEYS
+    (separadas por comas) y/o st.secrets["api_keys"][proveedor] (lista o
+    texto separado por comas), sin repetir
+    """
+    keys = os.environ.get(f"{provider.upper()}_API_KEYS", "").split(",")
+    try:
+        secret_keys = st.secrets.get("api_keys", {}).get(provider, [])
+    except FileNotFoundError:
+        secret_keys = []
+    keys += secret_keys.split(",") if isinstance(secret_keys, str) else list(secret_keys)
+    return list(dict.fromkeys(key.strip() for key in keys if key and key.strip()))
+
+# Timeouts de red (segundos): conexión y lectura por tipo de llamada. Dentro de
+# una generación se recortan a lo que quede de su plazo (ver Deadline)
+HTTP_CONNECT_TIMEOUT = 10.0
+FLUX_SUBMIT_TIMEOUT = 60.0
+FLUX_POLL_TIMEOUT = 30.0
+FLUX_DOWNLOAD_TIMEOUT = 120.0
+# Plazo máximo por defecto de una generación completa (minutos)
+DEFAULT_GENERATION_DEADLINE_MINUTES = 15.0
+
+# Webhooks de Flux: puerto del receptor local, URL por la que BFL lo alcanza
+# (por defecto la local, válida con proveedores_simulados.py) y segundos de
+# espera antes de volver al polling si el aviso no llega
+FLUX_WEBHOOK_PORT = int(os.environ.get("FLUX_WEBHOOK_PORT", "8600"))
+FLUX_WEBHOOK_PUBLIC_URL = os.environ.get("FLUX_WEBHOOK_PUBLIC_URL", f"http://127.0.0.1:{FLUX_WEBHOOK_PORT}").rstrip("/")
+FLUX_WEBHOOK_TIMEOUT = float(os.environ.get("FLUX_WEBHOOK_TIMEOUT", "60"))
+
+# Idiomas de las variantes (etiqueta en la interfaz → nombre en las instrucciones a Claude)
+TARGET_LANGUAGES = {
+    "English": "inglés",
+    "Français": "francés",
+    "Deutsch": "alemán",
+    "Italiano": "italiano",
+    "Português": "portugués",
+    "Nederlands": "neerlandés",
+    "中文": "chino mandarín",
+    "日本語": "japonés",
+    "العربية": "árabe"
+}
+
+# Similitud mínima por defecto para reutilizar una imagen del índice local
+DEFAULT_REUSE_THRESHOLD = 0.85
+
+# Voces de OpenAI TTS (la primera elegida narra; los diálogos reparten el resto)
+TTS_VOICES = ["alloy", "echo", "fable", "onyx", "nova", "shimmer"]
+
+# Estilos visuales de imagen (cada uno con su offset de seed y su guidance en Flux)
+IMAGE_STYLES = ["photorealistic", "digital-art", "cinematic", "documentary", "portrait", "watercolor",
+                "oil-painting", "anime", "sketch", "vintage", "minimalist"]
 
 # Configuración de la página
 st.set_page_config(
@@ -38,6 +160,24 @@ if 'character_images' not in st.session_state:
 if 'sequence_generation_complete' not in st.session_state:
     st.session_state.sequence_generation_complete = False
 
+if 'storyboard_files' not in st.session_state:
+    st.session_state.storyboard_files = None
+
+if 'message_batch' not in st.session_state:
+    st.session_state.message_batch = None
+
+# Generación en segundo plano de esta sesión (GenerationTask)
+if 'generation_task' not in st.session_state:
+    st.session_state.generation_task = None
+
+# Salidas memorizadas de cada etapa del pipeline (ver run_pipeline)
+if 'stage_memo' not in st.session_state:
+    st.session_state.stage_memo = {}
+
+# Último barrido de estilos × seeds y sus celdas ya renderizadas (ver run_style_sweep)
+if 'style_sweep' not in st.session_state:
+    st.session_state.style_sweep = None
+
 # Título principal
 st.title("🎨 Generador de Contenido Multimedia")
 st.markdown("*Powered by Claude Sonnet 4 & Flux - Transforma tus ideas en texto, imágenes y audio*")
@@ -52,6 +192,18 @@ with st.sidebar:
     bfl_api_key = st.text_input("Black Forest Labs API Key", type="password", help="Para generación de imágenes con Flux")
     openai_api_key = st.text_input("OpenAI API Key", type="password", help="Para generación de audio TTS")
     
+    # Claves de la configuración: se reparten las solicitudes entre ellas y la
+    # de arriba (si se escribe); sin clave escrita basta con las del pool
+    pooled_api_keys = {provider: configured_api_keys(provider) for provider in API_KEY_PROVIDERS}
+    bfl_key_count = len(set(pooled_api_keys["bfl"]) | ({bfl_api_key} if bfl_api_key else set()))
+    anthropic_api_key = anthropic_api_key or next(iter(pooled_api_keys["anthropic"]), "")
+    bfl_api_key = bfl_api_key or next(iter(pooled_api_keys["bfl"]), "")
+    openai_api_key = openai_api_key or next(iter(pooled_api_keys["openai"]), "")
+    if any(pooled_api_keys.values()):
+        st.caption("🔑 Claves en la configuración: " + " • ".join(
+            f"{API_KEY_PROVIDERS[provider]}: {len(keys)}" for provider, keys in pooled_api_keys.items() if keys
+        ))
+    
     # Configuraciones del modelo
     st.subheader("Configuración de Modelos")
     
@@ -72,25 +224,92 @@ with st.sidebar:
     )
     
     flux_steps = st.slider("Pasos de generación (Flux)", 1, 50, 25, help="Más pasos = mejor calidad pero más tiempo")
+    flux_webhook = st.checkbox(
+        "🔔 Avisos de Flux por webhook",
+        value=False,
+        help=f"Flux avisa al terminar cada imagen en lugar de consultarle cada {FLUX_POLL_INTERVAL:g} s. "
+             f"El receptor escucha en el puerto {FLUX_WEBHOOK_PORT} y BFL debe poder alcanzar "
+             f"{FLUX_WEBHOOK_PUBLIC_URL} (variable FLUX_WEBHOOK_PUBLIC_URL). Si un aviso no llega "
+             f"en {FLUX_WEBHOOK_TIMEOUT:g} s se vuelve a consultar como siempre."
+    )
+    hedging = st.checkbox(
+        "🏁 Duplicar solicitudes lentas (hedging)",
+        value=False,
+        help="Si una imagen o un audio tarda más que el 90% de los anteriores, se pide también al backend de respaldo "
+             "(BFL_API_URL_SECONDARY / OPENAI_API_URL_SECONDARY, por defecto el mismo proveedor) y se usa el primero "
+             "que llegue. Recorta las esperas largas a cambio de pagar alguna imagen duplicada."
+    )
     
     # Estilo de imagen
     image_style = st.selectbox(
         "Estilo de imagen",
-        ["photorealistic", "digital-art", "cinematic", "documentary", "portrait", "watercolor", "oil-painting", "anime", "sketch", "vintage", "minimalist"],
+        IMAGE_STYLES,
         index=0,
         help="Estilo visual para la generación de imágenes"
     )
+    fast_visual_prompt = st.checkbox(
+        "⚡ Prompt visual local (modo rápido)",
+        value=False,
+        help="Construye el prompt de la imagen con palabras clave del texto, sin llamada extra a Claude: Flux empieza al instante"
+    )
+    
+    # Reutilizar imágenes ya generadas con prompts casi iguales
+    reuse_similar_images = st.checkbox(
+        "♻️ Reutilizar imágenes parecidas",
+        value=False,
+        help="Antes de renderizar busca en el índice local imágenes de tu clave de Flux con el mismo estilo, modelo, "
+             "pasos y tamaño y un prompt muy parecido, y te ofrece usarlas en lugar de pagar un render nuevo"
+    )
+    if reuse_similar_images:
+        reuse_threshold = st.slider(
+            "Similitud mínima para reutilizar",
+            min_value=0.5,
+            max_value=1.0,
+            value=DEFAULT_REUSE_THRESHOLD,
+            step=0.01,
+            help="Similitud TF-IDF entre el prompt de Flux nuevo y el de la imagen guardada (1.0 = mismo prompt)"
+        )
+    else:
+        reuse_threshold = None
     
     # Configuración de audio
     voice_model = st.selectbox(
         "Voz para Audio",
-        ["alloy", "echo", "fable", "onyx", "nova", "shimmer"],
+        TTS_VOICES,
         index=0
     )
+    dialogue_voices = st.checkbox(
+        "🎭 Una voz por personaje en diálogos",
+        value=False,
+        help="En los diálogos situacionales, cada interlocutor habla con una voz distinta. "
+             "Los turnos se sintetizan a la vez y se unen en un solo MP3"
+    )
+    tts_sentence_cache = st.checkbox(
+        "♻️ Reutilizar frases ya narradas",
+        value=False,
+        help="Narra frase a frase y guarda cada frase (por voz, modelo y texto) en una caché local: "
+             "al regenerar o editar el texto solo se sintetizan las frases nuevas o cambiadas"
+    )
+    target_languages = st.multiselect(
+        "🌍 Idiomas adicionales",
+        list(TARGET_LANGUAGES),
+        default=[],
+        help="Genera en paralelo el texto y el audio en cada idioma; la imagen o secuencia se genera una sola vez y se comparte"
+    )
     
     # Configuraciones adicionales
     st.subheader("Configuraciones Avanzadas")
     max_tokens_claude = st.number_input("Max tokens Claude", 500, 4000, 2000)
+    input_token_budget = st.number_input(
+        "Presupuesto de entrada (tokens)", 1000, 50000, 8000, step=500,
+        help="Máximo estimado de tokens del texto que se reenvía a Claude para análisis y prompt visual; si se supera se envía un resumen extractivo"
+    )
+    memory_profiling = st.checkbox(
+        "🧠 Perfilar memoria por etapa",
+        value=False,
+        help="Toma snapshots de tracemalloc al final de cada etapa (ralentiza la generación). tracemalloc es global "
+             "al servidor: las cifras incluyen a las demás sesiones y el trazado sigue mientras alguna lo use"
+    )
     
     # NUEVO: Configuración para secuencias de personajes
     st.subheader("🎭 Secuencias de Personajes")
@@ -107,8 +326,26 @@ with st.sidebar:
         value=3,
         help="Número de escenas a generar por cada personaje detectado"
     )
+        draft_mode = st.checkbox(
+            "Modo borrador (previsualización rápida)",
+            value=False,
+            help="Primero genera todas las escenas con pocos pasos y baja resolución; después renderiza a calidad completa solo las que apruebes"
+        )
+        storyboard_enabled = st.checkbox(
+            "🗂️ Storyboard PDF incremental",
+            value=True,
+            help="Monta el PDF y la hoja de contactos a medida que terminan las escenas, con memoria acotada a una página"
+        )
+        chapter_analysis = st.checkbox(
+            "📚 Análisis por capítulos en textos largos",
+            value=True,
+            help="Los textos largos se dividen en capítulos que se analizan en paralelo; los personajes se fusionan y las escenas se reparten por toda la narración"
+        )
     else:
         max_scenes_per_character = 3  # Valor por defecto
+        draft_mode = False
+        storyboard_enabled = False
+        chapter_analysis = False
     
     if sequence_mode != st.session_state.character_sequence_mode:
         st.session_state.character_sequence_mode = sequence_mode
@@ -128,1225 +365,5678 @@ with st.sidebar:
         image_width = 1024  # Valor por defecto para Ultra
         image_height = 1024
 
+    # NUEVO: Planificación por plazo (estimación antes de gastar en APIs)
+    st.subheader("⏱️ Planificación por Plazo")
+    flux_concurrency = st.slider(
+        "Renders simultáneos (Flux)",
+        min_value=1,
+        max_value=KEY_POOL_CONCURRENCY["bfl"] * max(1, bfl_key_count),
+        value=4,
+        help="Máximo de imágenes que se generan a la vez (BFL admite hasta 24 tareas activas por clave; "
+             "con varias claves en el pool, 24 por cada una)"
+    )
+    deadline_planning = st.checkbox(
+        "Planificar según tiempo objetivo",
+        value=False,
+        help="Estima la duración con el historial de ejecuciones y ajusta concurrencia, pasos o resolución"
+    )
+    if deadline_planning:
+        target_minutes = st.number_input("Tiempo objetivo (minutos)", 0.5, 60.0, 5.0, step=0.5)
+        allow_step_reduction = st.checkbox("Permitir reducir pasos", value=True)
+        allow_resolution_reduction = st.checkbox("Permitir reducir resolución", value=False)
+    else:
+        target_minutes = 5.0
+        allow_step_reduction = False
+        allow_resolution_reduction = False
+    generation_deadline_minutes = st.number_input(
+        "⏱️ Plazo máximo por generación (minutos)",
+        min_value=1.0,
+        max_value=120.0,
+        value=DEFAULT_GENERATION_DEADLINE_MINUTES,
+        step=1.0,
+        help="Al agotarse se detienen las solicitudes pendientes y se conserva lo ya terminado. "
+             "Cada llamada de red usa como timeout lo que quede de plazo"
+    )
+
 # ===============================
-# FUNCIONES PARA DETECCIÓN DE PERSONAJES
+# AGRUPACIÓN DE SOLICITUDES IDÉNTICAS (SINGLE-FLIGHT)
 # ===============================
 
-def analyze_characters_with_claude(text_content: str, content_type: str, api_key: str, model: str, max_scenes: int = 3) -> Dict[str, Any]:
-    """Analiza el texto con Claude para detectar personajes y generar character cards con escenas específicas y variadas"""
-    try:
-        headers = {
-            "x-api-key": api_key,
-            "Content-Type": "application/json",
-            "anthropic-version": "2023-06-01"
-        }
-        
-        system_prompt = """Eres un experto en análisis narrativo, dirección cinematográfica y storyboarding visual. Tu tarea es analizar texto narrativo y extraer información detallada sobre personajes para generar secuencias de imágenes VISUALMENTE MUY DIFERENTES pero con personajes consistentes.
+# Cada cuánto comprueba su cancelación quien espera una solicitud agrupada
+SINGLE_FLIGHT_FOLLOWER_POLL = 0.25
 
-PRINCIPIO FUNDAMENTAL DE VARIACIÓN VISUAL:
-Cada escena debe ser ÚNICA y RADICALMENTE DISTINTA en composición, ángulo, acción, ambiente y emoción. El objetivo es contar la historia visualmente con MÁXIMA DIVERSIDAD mientras se mantiene la identidad del personaje.
 
-ESTRATEGIAS OBLIGATORIAS DE VARIACIÓN POR ESCENA:
+class SingleFlight:
+    """
+    Agrupa solicitudes idénticas que están en curso al mismo tiempo
 
-1. ÁNGULOS DE CÁMARA - Usar DIFERENTES en cada escena:
-   - Extreme close-up (ECU): Solo rostro/detalle, alta carga emocional
-   - Close-up (CU): Cara y hombros, conexión emocional
-   - Medium close-up (MCU): Cintura hacia arriba, balance emoción-acción
-   - Medium shot (MS): Cuerpo completo de rodillas arriba, acción moderada
-   - Medium long shot (MLS): Cuerpo completo con contexto, acción en ambiente
-   - Long shot (LS): Personaje completo en entorno, énfasis en espacio
-   - Extreme long shot (ELS): Personaje pequeño en paisaje vasto, escala épica
-   - Over-the-shoulder (OTS): Desde detrás del personaje
-   - Low angle: Desde abajo hacia arriba, sensación de poder/heroísmo
-   - High angle: Desde arriba hacia abajo, sensación de vulnerabilidad
-   - Bird's eye view: Vista cenital, perspectiva única
-   - Dutch angle: Cámara inclinada, tensión/desorientación
+    La primera solicitud para una clave hace la llamada real; las que llegan
+    mientras sigue en curso esperan y reciben el mismo resultado (o la misma
+    excepción) sin una segunda llamada al proveedor.
+    """
 
-2. POSES Y ACCIONES - COMPLETAMENTE DIFERENTES:
-   - VARIEDAD OBLIGATORIA: sentado, corriendo, saltando, agachado, escondido, mirando hacia arriba, mirando hacia abajo, caminando, parado en una pata, estirándose, jugando, durmiendo, explorando, trepando
-   - PROHIBIDO: Repetir "sentado mirando al frente" en múltiples escenas
-   - CADA ESCENA: Nueva acción física distintiva del personaje
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._in_flight: Dict[str, Future] = {}
+        self._stats: Dict[str, Dict[str, int]] = {}
 
-3. ESTADOS EMOCIONALES - Progresión narrativa clara:
-   - Varía entre: curioso, asustado, valiente, triste, feliz, sorprendido, determinado, pensativo, preocupado, aliviado, emocionado
-   - Expresión facial visible y diferente en cada escena
-   - Las emociones deben reflejar la progresión de la historia
+    def do(self, namespace: str, payload: Dict[str, Any], fn, credential: str = "",
+           cancel_token: Optional["CancellationToken"] = None, on_stop=None):
+        """
+        Ejecuta fn() una sola vez por payload canónico y credencial en curso
 
-4. AMBIENTES Y CONTEXTOS - CONTRASTANTES:
-   - Alternancia OBLIGATORIA entre espacios:
-     * Interior vs Exterior
-     * Espacios abiertos (bosque, campo) vs cerrados (habitación, cueva)
-     * Diferentes ubicaciones del relato (hogar → bosque → río → cueva, etc.)
-   - Elementos del entorno ESPECÍFICOS y VARIADOS por escena
-   - NUNCA el mismo fondo genérico
+        La credencial (clave de API de la sesión) entra en la clave como hash:
+        nunca se entrega a una sesión la respuesta, ni el 401/429, pedida con
+        la clave de otra. Quien espera a otro no se queda colgado de él: si su
+        cancel_token se cancela o vence su plazo, deja de esperar y devuelve
+        on_stop() (por defecto, el stop_message del token).
+        """
+        credential_hash = hashlib.sha256(credential.encode("utf-8")).hexdigest()[:16] if credential else ""
+        key = namespace + ":" + credential_hash + ":" + hashlib.sha256(
+            json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")
+        ).hexdigest()
 
-5. ILUMINACIÓN Y HORA DEL DÍA - VARIEDAD:
-   - Morning sunlight (luz suave matutina)
-   - Afternoon golden light (luz dorada de tarde)
-   - Sunset dramatic lighting (atardecer dramático)
-   - Night moonlight (luz de luna nocturna)
-   - Filtered forest light (luz filtrada entre árboles)
-   - Dramatic rim lighting (luz de contorno)
-   - Magical glow (resplandor mágico)
-   - Soft indoor lighting (luz interior suave)
-   - Dark mysterious shadows (sombras misteriosas)
+        with self._lock:
+            stats = self._stats.setdefault(namespace, {"requests": 0, "upstream": 0, "coalesced": 0})
+            stats["requests"] += 1
+            future = self._in_flight.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = Future()
+                self._in_flight[key] = future
+                stats["upstream"] += 1
+            else:
+                stats["coalesced"] += 1
 
-6. COMPOSICIÓN VISUAL - Regla de tercios y balance:
-   - Variar posición del personaje: centro, izquierda, derecha, primer plano, fondo
-   - Usar profundidad de campo (foreground/background elements)
-   - Cambiar el peso visual de la escena
+        if not is_leader:
+            while True:
+                if cancel_token is not None and cancel_token.cancelled:
+                    return on_stop() if on_stop else cancel_token.stop_message
+                try:
+                    return future.result(timeout=SINGLE_FLIGHT_FOLLOWER_POLL)
+                except FutureTimeoutError:
+                    continue
 
-FORMATO DE RESPUESTA (JSON válido estricto):
-{
-  "has_characters": true/false,
-  "characters": [
-    {
-      "name": "nombre_descriptivo_único",
-      "type": "human/animal/creature/object",
-      "physical_description": "DESCRIPCIÓN FÍSICA BREVE Y ESPECÍFICA en inglés con 2-3 características DISTINTIVAS únicas (color específico, rasgo único memorable, tamaño relativo). Máximo 15 palabras.",
-      "key_features": [
-        "característica física única 1 (ej: bright yellow eyes with vertical pupils)",
-        "característica física única 2 (ej: small black fluffy body)",
-        "característica física única 3 (ej: magical blue glowing collar)"
-      ],
-      "suggested_scenes": [
-        {
-          "action": "acción/momento específico del relato (ej: discovering the magical collar, running from danger, meeting new friend)",
-          "scene_description": "FORMATO OPTIMIZADO: {CAMERA_ANGLE}, {SPECIFIC_ACTION}, {BRIEF_CHARACTER_TRAITS}, {VISIBLE_EMOTION}, {SPECIFIC_ENVIRONMENT}, {LIGHTING_TYPE}",
-          "visual_composition": "tipo de plano específico (extreme close-up/close-up/medium shot/wide shot/low angle/high angle/bird's eye view/dutch angle)",
-          "emotional_state": "emoción específica visible en rostro/postura (frightened/brave/curious/happy/worried/determined/surprised/relieved)",
-          "lighting_mood": "tipo de iluminación específica y hora (morning sunlight/dramatic sunset/moonlight/filtered forest light/magical glow/rim lighting)"
-        }
-      ]
-    }
-  ],
-  "visual_style": "estilo visual sugerido global",
-  "consistency_notes": "elementos clave para mantener consistencia visual del personaje entre TODAS las escenas (ej: always show yellow eyes, blue collar, black fur texture)"
-}
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
 
-EJEMPLOS DE scene_description CORRECTOS (MÁXIMA VARIACIÓN):
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Copia de las estadísticas por proveedor (solicitudes, llamadas reales, agrupadas)"""
+        with self._lock:
+            return {namespace: dict(values) for namespace, values in self._stats.items()}
 
-Escena 1 - Close-up emocional:
-"Close-up shot, small black cat with yellow eyes looking directly at camera with wide frightened expression, ears flat back, whiskers trembling, dark mysterious forest background blurred, dramatic rim lighting from behind"
 
-Escena 2 - Wide shot de acción:
-"Wide establishing shot, tiny black cat with blue collar running across old wooden bridge, full body visible in motion, determined posture with tail up, sunny countryside landscape with river below, golden afternoon light"
+@st.cache_resource
+def get_request_coalescer() -> SingleFlight:
+    """Agrupador compartido por todas las sesiones del proceso"""
+    return SingleFlight()
 
-Escena 3 - Low angle heroico:
-"Low angle hero shot, black cat with glowing collar standing on top of large rock looking up at starry sky, one paw raised heroically, brave expression, magical blue light illuminating face from below, epic night scene with stars, cinematic lighting"
+# ===============================
+# CANCELACIÓN COOPERATIVA
+# ===============================
 
-Escena 4 - Extreme close-up de detalle:
-"Extreme close-up, black cat's yellow eye reflecting magical blue light, single eye filling frame, wonder and curiosity visible in pupil dilation, soft indoor lighting, warm bokeh background"
+CANCELLED_MESSAGE = "Generación cancelada por el usuario."
+DEADLINE_MESSAGE = "Se agotó el plazo de la generación."
+# Resultados de una solicitud que se detuvo sin error propio
+STOP_MESSAGES = (CANCELLED_MESSAGE, DEADLINE_MESSAGE)
 
-Escena 5 - High angle vulnerable:
-"High angle shot, small black cat crouched low hiding behind fern leaves in jungle, looking up nervously, vulnerable posture with body compressed, giant prehistoric plants surrounding, filtered green jungle light"
 
-Escena 6 - Bird's eye view de contexto:
-"Bird's eye view, black cat walking alone on winding forest path, small figure from above, cautious movement, surrounded by tall trees creating natural frame, dappled morning sunlight on path"
+class Deadline:
+    """
+    Instante límite de una generación (o de una de sus etapas)
 
-ESTRUCTURA ÓPTIMA de scene_description:
-"{ÁNGULO_ESPECÍFICO}, {ACCIÓN_ÚNICA}, {1-2_RASGOS_CLAVE_PERSONAJE}, {EMOCIÓN_VISIBLE}, {AMBIENTE_ESPECÍFICO}, {LUZ_ESPECÍFICA}"
+    timeout() da el (connect, read) de requests para la próxima llamada: el
+    de siempre, recortado a lo que quede de plazo.
+    """
 
-REGLAS CRÍTICAS:
+    def __init__(self, seconds: float, end: Optional[float] = None):
+        self.seconds = seconds
+        self.end = time.monotonic() + seconds if end is None else end
 
-✅ HACER:
-- Usar UN ángulo de cámara diferente por escena
-- Crear UNA acción física única por escena
-- Mostrar UNA emoción distinta y progresiva por escena
-- Cambiar el ambiente/ubicación según la narrativa
-- Variar la iluminación para mood diferente
-- Mantener 2-3 características físicas clave en CADA escena para consistencia
-- Usar máximo 30-40 palabras por scene_description
-- Priorizar DIFERENCIA visual sobre descripción exhaustiva del personaje
+    def remaining(self) -> float:
+        return max(0.0, self.end - time.monotonic())
 
-❌ NO HACER:
-- Repetir el mismo ángulo (ej: "medium shot" en todas)
-- Usar la misma pose (ej: "sitting looking forward" repetido)
-- Describir TODO el personaje detalladamente en cada prompt
-- Usar descripciones genéricas (ej: "in a forest" sin especificar)
-- Mantener la misma iluminación "natural light" en todas
-- Crear escenas visualmente similares
-- Exceder 40 palabras por scene_description
-- Olvidar las características clave que dan consistencia
+    @property
+    def expired(self) -> bool:
+        return time.monotonic() >= self.end
 
-OBJETIVO FINAL:
-Generar exactamente el número solicitado de escenas por personaje que:
-1. Cuenten la historia visualmente de forma DINÁMICA
-2. Muestren MÁXIMA VARIEDAD en composición, ángulo, acción, emoción, ambiente
-3. Mantengan CONSISTENCIA del personaje mediante 2-3 rasgos físicos clave siempre presentes
-4. Sean escenas CINEMATOGRÁFICAS dignas de un storyboard profesional
+    def split(self, reserve_seconds: float) -> "Deadline":
+        """
+        Plazo de una etapa: deja reserve_seconds para las siguientes, pero
+        nunca se queda con menos de la mitad de lo que queda
+        """
+        now = time.monotonic()
+        end = max(now + self.remaining() / 2, self.end - reserve_seconds)
+        return Deadline(end - now, end=end)
 
-Responde ÚNICAMENTE con el JSON solicitado, sin texto adicional."""
+    def timeout(self, read: float) -> tuple:
+        left = max(0.1, self.remaining())
+        return (min(HTTP_CONNECT_TIMEOUT, left), min(read, left))
 
-        user_message = f"""Analiza el siguiente {content_type} momento a momento y extrae información detallada sobre personajes:
 
-CONTENIDO COMPLETO:
-{text_content}
+class CancellationToken:
+    """
+    Señal de cancelación compartida por todos los hilos de una generación
 
-NÚMERO DE ESCENAS A GENERAR: {max_scenes} escenas por personaje
+    Los hilos consultan el token antes de cada solicitud y esperan con wait()
+    en lugar de time.sleep: cancel() los despierta y se detienen sin agotar
+    el polling. Con deadline, el token también cuenta como cancelado al
+    agotarse el plazo, y las llamadas de red toman de él sus timeouts
+    (http_timeout).
+    """
 
-INSTRUCCIONES ESPECÍFICAS DE ANÁLISIS:
-1. Lee el relato/cuento COMPLETO de principio a fin
-2. Identifica los momentos narrativos MÁS IMPORTANTES donde cada personaje:
-   - Tiene una acción significativa
-   - Experimenta una emoción fuerte
-   - Interactúa con otros personajes o el ambiente
-   - Avanza la historia de manera relevante
+    def __init__(self, deadline: Optional[Deadline] = None, event: Optional[threading.Event] = None):
+        self._event = event or threading.Event()
+        self.deadline = deadline
 
-3. Para cada escena seleccionada, crea una descripción siguiendo ESTRICTAMENTE este formato:
-   "{{ÁNGULO_DE_CÁMARA_ESPECÍFICO}}, {{ACCIÓN_FÍSICA_ÚNICA}}, {{2-3_RASGOS_FÍSICOS_CLAVE}}, {{EMOCIÓN_VISIBLE_EN_ROSTRO}}, {{AMBIENTE_ESPECÍFICO_CON_DETALLES}}, {{TIPO_DE_ILUMINACIÓN}}"
+    def cancel(self) -> None:
+        self._event.set()
 
-4. ASEGÚRATE de que cada scene_description incluya:
-   ✅ UN ángulo de cámara diferente (close-up, wide shot, low angle, bird's eye, etc.)
-   ✅ UNA acción/pose completamente diferente (NO repetir "sentado" o "mirando")
-   ✅ Solo 2-3 características físicas clave del personaje (NO toda la descripción)
-   ✅ UNA emoción específica apropiada al momento narrativo
-   ✅ UN ambiente/ubicación específico diferente (interior/exterior, día/noche, etc.)
-   ✅ UN tipo de iluminación variado según el mood de la escena
+    @property
+    def cancel_requested(self) -> bool:
+        """Cancelado con cancel() (no por plazo)"""
+        return self._event.is_set()
 
-5. DISTRIBUCIÓN DE ESCENAS SUGERIDA para {max_scenes} escenas:
-   - Escena inicial: Establecer personaje (medium/wide shot, estado neutral/curioso)
-   - Escenas intermedias: Conflicto/desarrollo (close-ups emocionales, action shots)
-   - Escena final: Resolución/clímax (low angle heroico o wide shot épico)
+    @property
+    def expired(self) -> bool:
+        return self.deadline is not None and self.deadline.expired and not self._event.is_set()
 
-6. VERIFICACIÓN FINAL antes de responder:
-   - ¿Cada escena tiene un ángulo de cámara DIFERENTE? ✓
-   - ¿Cada escena muestra una acción/pose ÚNICA? ✓
-   - ¿Las escenas cuentan la progresión de la historia? ✓
-   - ¿La iluminación y ambiente varían según la narrativa? ✓
-   - ¿Se mantienen 2-3 rasgos clave del personaje en TODAS las escenas? ✓
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set() or self.expired
 
-OBJETIVO: Crear {max_scenes} escenas VISUALMENTE DISTINTAS que narren la historia del personaje de forma cinematográfica, manteniendo su identidad visual mediante características físicas consistentes.
+    @property
+    def stop_message(self) -> str:
+        """Resultado que devuelve una solicitud detenida por este token"""
+        return DEADLINE_MESSAGE if self.expired else CANCELLED_MESSAGE
 
-Responde ÚNICAMENTE con el JSON válido solicitado, sin comentarios adicionales."""
+    def wait(self, seconds: float) -> bool:
+        """Espera hasta seconds segundos; devuelve True si se canceló (o venció el plazo) entretanto"""
+        if self.deadline is not None:
+            seconds = min(seconds, self.deadline.remaining())
+        return self._event.wait(seconds) or self.cancelled
 
-        data = {
-            "model": model,
-            "max_tokens": 3000,
-            "temperature": 0.4,
-            "system": system_prompt,
-            "messages": [
-                {"role": "user", "content": user_message}
-            ]
-        }
-        
-        response = requests.post(
-            "https://api.anthropic.com/v1/messages",
-            headers=headers,
-            json=data,
-            timeout=90
-        )
-        
-        if response.status_code == 200:
-            response_data = response.json()
-            claude_response = response_data["content"][0]["text"].strip()
-            
-            # Limpiar respuesta de Claude (quitar markdown si existe)
-            if claude_response.startswith("```json"):
-                claude_response = claude_response.replace("```json", "").replace("```", "").strip()
-            
-            # Parsear JSON
-            try:
-                character_data = json.loads(claude_response)
-                
-                # Validar que se generaron escenas variadas
-                if character_data.get("has_characters", False):
-                    total_scenes = sum(len(char.get("suggested_scenes", [])) for char in character_data.get("characters", []))
-                    if total_scenes > 0:
-                        st.success(f"✅ Claude generó {total_scenes} escenas variadas para la secuencia")
-                
-                return character_data
-            except json.JSONDecodeError as e:
-                st.error(f"Error parseando análisis de personajes: {e}")
-                st.error(f"Respuesta de Claude: {claude_response[:500]}...")
-                return {"has_characters": False, "characters": []}
-        else:
-            st.error(f"Error en análisis de personajes: {response.status_code}")
-            return {"has_characters": False, "characters": []}
-            
-    except Exception as e:
-        st.error(f"Error analizando personajes: {str(e)}")
-        return {"has_characters": False, "characters": []}
+    def with_deadline(self, deadline: Optional[Deadline]) -> "CancellationToken":
+        """Token con otro plazo (p. ej. el de una etapa) que comparte la cancelación"""
+        return CancellationToken(deadline, self._event)
 
-def generate_character_seed(character_name: str, scene_action: str = "", scene_index: int = 0, style: str = "photorealistic") -> int:
+
+def http_timeout(cancel_token: Optional[CancellationToken], read: float) -> tuple:
+    """(connect, read) para requests, recortado al plazo del token si lo tiene"""
+    if cancel_token is not None and cancel_token.deadline is not None:
+        return cancel_token.deadline.timeout(read)
+    return (HTTP_CONNECT_TIMEOUT, read)
+
+
+# Los hilos de trabajo no pueden llamar a Streamlit: dentro de una
+# GenerationTask los mensajes de las funciones de generación van a su registro
+_ui_sink = threading.local()
+
+
+def ui():
+    """Destino de los mensajes de generación: st o el registro de la tarea en curso"""
+    return getattr(_ui_sink, "target", None) or st
+
+
+# ===============================
+# WEBHOOKS DE FLUX
+# ===============================
+
+class FluxWebhookReceiver:
     """
-    Genera seeds con MAYOR variación para diferentes escenas del mismo personaje
-    y OFFSET por estilo para empujar hacia espacios latentes específicos
-    
-    Args:
-        character_name: Nombre del personaje (para consistencia base)
-        scene_action: Acción específica de la escena (para variación)
-        scene_index: Índice de la escena (para variación adicional)
-        style: Estilo visual seleccionado (afecta el offset del seed)
-    
-    Returns:
-        Seed que mantiene consistencia del personaje pero con variación por escena y estilo
+    Servidor HTTP local que recibe los avisos de BFL cuando termina un render
+
+    Cada render enviado con webhook_url espera aquí su aviso en lugar de
+    consultar get_result cada FLUX_POLL_INTERVAL segundos. La ruta lleva un
+    secreto aleatorio del proceso: lo que llegue a otra ruta se rechaza. Un
+    aviso puede llegar antes de que el hilo que envió el render se ponga a
+    esperarlo, así que los avisos se guardan hasta que alguien los recoge.
     """
-    import hashlib
-    
-    # Seed base del personaje (consistencia - 50% del peso)
-    base_hash = hashlib.md5(character_name.encode()).hexdigest()
-    base_seed = int(base_hash[:8], 16) % 100000
-    
-    # Variación por acción de escena (40% del peso)
-    if scene_action and scene_action.strip():
-        scene_hash = hashlib.md5(scene_action.encode()).hexdigest()
-        scene_variation = int(scene_hash[:6], 16) % 10000  # Variación 10x mayor que antes
-    else:
-        scene_variation = 0
-    
-    # Variación por índice de escena (10% del peso)
-    index_variation = scene_index * 1000
-    
-    # NUEVO: Offset por estilo para empujar hacia espacios latentes específicos
-    # Estilos ilustrados/no-realistas necesitan offset para evitar zona hiperrealista
-    style_offset = get_style_seed_offset(style)
-    
-    # Combinar con pesos balanceados
-    final_seed = (base_seed + scene_variation + index_variation + style_offset) % 1000000
-    
-    return final_seed
 
+    def __init__(self, port: int, public_url: str):
+        self.secret = uuid.uuid4().hex
+        self.url = f"{public_url}/flux-webhook/{self.secret}"
+        self._lock = threading.Lock()
+        self._slots: Dict[str, Dict[str, Any]] = {}
+        self.received = 0
+        self._server = self._start_server(port)
 
-def get_style_seed_offset(style: str) -> int:
+    def _start_server(self, port: int):
+        import http.server
+
+        receiver = self
+
+        class WebhookHandler(http.server.BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length) if length else b""
+                if self.path != f"/flux-webhook/{receiver.secret}":
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                try:
+                    payload = json.loads(body or b"{}")
+                except ValueError:
+                    payload = {}
+                job_id = payload.get("id") or payload.get("task_id")
+                if job_id:
+                    receiver.deliver(job_id, payload)
+                self.send_response(200 if job_id else 400)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+        server = http.server.ThreadingHTTPServer(("0.0.0.0", port), WebhookHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="flux-webhook", daemon=True).start()
+        return server
+
+    def _slot(self, job_id: str) -> Dict[str, Any]:
+        # Llamar con el lock tomado
+        slot = self._slots.get(job_id)
+        if slot is None:
+            slot = self._slots[job_id] = {"event": threading.Event(), "payload": None, "created": time.monotonic()}
+        return slot
+
+    def deliver(self, job_id: str, payload: Dict[str, Any]) -> None:
+        with self._lock:
+            self.received += 1
+            # Avisos que nadie recogió (render cancelado, sondeo de respaldo)
+            stale = [key for key, slot in self._slots.items() if time.monotonic() - slot["created"] > 600]
+            for key in stale:
+                del self._slots[key]
+            slot = self._slot(job_id)
+            slot["payload"] = payload
+        slot["event"].set()
+
+    def wait(self, job_id: str, timeout: float, cancel_token: Optional[CancellationToken] = None) -> Optional[Dict[str, Any]]:
+        """
+        Espera el aviso de un render
+
+        Returns:
+            El cuerpo del aviso, el stop_message del token si se canceló (o
+            venció su plazo) o None si no llegó en timeout segundos (el
+            llamador vuelve al polling)
+        """
+        with self._lock:
+            slot = self._slot(job_id)
+        deadline = time.monotonic() + timeout
+        try:
+            # Tramos cortos para atender la cancelación sin un hilo más por render
+            while not slot["event"].wait(min(0.25, max(0.0, deadline - time.monotonic()))):
+                if cancel_token and cancel_token.cancelled:
+                    return cancel_token.stop_message
+                if time.monotonic() >= deadline:
+                    return None
+            return slot["payload"]
+        finally:
+            with self._lock:
+                self._slots.pop(job_id, None)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"received": self.received, "waiting": sum(1 for slot in self._slots.values() if slot["payload"] is None)}
+
+
+@st.cache_resource
+def get_flux_webhook_receiver() -> Optional[FluxWebhookReceiver]:
+    """Receptor compartido por todas las sesiones; None si el puerto no está libre"""
+    try:
+        return FluxWebhookReceiver(FLUX_WEBHOOK_PORT, FLUX_WEBHOOK_PUBLIC_URL)
+    except OSError:
+        return None
+
+
+# ===============================
+# POOLS DE CLAVES DE API
+# ===============================
+
+# Segundos en los que un 429 cuenta como reciente al elegir clave
+KEY_POOL_THROTTLE_WINDOW = 60.0
+# Pausa de una clave tras un 429 sin Retry-After, y de una clave de la
+# configuración tras un 401
+KEY_POOL_DEFAULT_PAUSE = 10.0
+KEY_POOL_REJECTED_PAUSE = 300.0
+# Segundos que se conservan las estadísticas de una clave de sesión sin usar
+KEY_POOL_SESSION_STATS_TTL = 3600.0
+# Cada cuánto revisa su cancelación una solicitud que espera una clave libre
+KEY_POOL_WAIT_SLICE = 0.25
+
+
+def mask_api_key(key: str) -> str:
+    """Clave irreconocible para mostrarla (solo los 4 últimos caracteres)"""
+    return f"…{key[-4:]}" if len(key) > 8 else "…"
+
+
+def retry_after_seconds(response) -> Optional[float]:
+    """Segundos de la cabecera Retry-After (None si no viene o no es un número)"""
+    try:
+        return max(0.0, float(response.headers.get("retry-after", "")))
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+
+class KeyRejected(requests.exceptions.HTTPError):
+    """Todas las claves disponibles están en pausa por haber sido rechazadas"""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(f"{status} - {message}")
+        self.status = status
+
+
+class KeyPool:
     """
-    Calcula offset de seed según el estilo visual
-    
-    Los estilos no-realistas necesitan offset para empujar la generación
-    hacia áreas del espacio latente que producen imágenes más ilustradas/artísticas
-    en lugar del realismo 3D/fotográfico que Flux favorece por defecto
-    
-    Args:
-        style: Estilo visual seleccionado
-    
-    Returns:
-        Valor de offset a sumar al seed (0 para estilos realistas)
+    Claves de API de un proveedor y su uso en este servidor
+
+    Cada solicitud toma, entre las claves con hueco (menos solicitudes en
+    curso que su límite) y sin pausa (Retry-After o rechazadas), la de más
+    concurrencia libre, penalizada por los 429 recientes. Si todas están
+    llenas o en pausa por un 429, espera a que se libere una: así el pool no
+    provoca los 429. Solo se pausan por un 401 las claves de la
+    configuración (un 403 puede ser de una solicitud concreta), y nunca se
+    espera a una clave rechazada: si no queda otra, falla con su estado. Lo
+    comparten todas las sesiones: las claves de la configuración sirven a
+    todas y la de la barra lateral solo a la sesión que la escribió. Las
+    estadísticas van por hash de la clave, y las de una clave de sesión se
+    descartan tras KEY_POOL_SESSION_STATS_TTL segundos sin usarse.
     """
-    style_offsets = {
-        "photorealistic": 0,           # Sin offset - zona realista natural
-        "digital-art": 100000,         # Offset significativo hacia ilustración
-        "cinematic": 0,                # Realista/fotográfico
-        "documentary": 0,              # Realista/fotográfico
-        "portrait": 0,                 # Realista/fotográfico
-        "watercolor": 150000,          # Offset hacia painted/acuarela
-        "oil-painting": 200000,        # Offset fuerte hacia painted/óleo
-        "anime": 250000,               # Offset máximo hacia 2D/anime
-        "sketch": 180000,              # Offset hacia drawn/dibujado
-        "vintage": 50000,              # Offset leve - semi-realista
-        "minimalist": 120000           # Offset moderado hacia ilustración simple
-    }
-    
-    return style_offsets.get(style, 0)
 
-def create_character_prompt(character: Dict, scene: Dict, style: str = "photorealistic") -> str:
+    _IDLE = {"in_flight": 0, "requests": 0, "throttled": 0, "errors": 0, "seconds": 0.0,
+             "recent_429": [], "paused_until": 0.0, "rejected": None, "last_used": 0.0}
+
+    def __init__(self, provider: str, keys: List[str], concurrency: int):
+        self.provider = provider
+        self.keys = list(keys)
+        self.concurrency = max(1, int(concurrency))
+        self._condition = threading.Condition()
+        self._configured = {self._fingerprint(key) for key in self.keys}
+        self._stats: Dict[str, Dict[str, Any]] = {}
+
+    @staticmethod
+    def _fingerprint(key: str) -> str:
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+    def _entry(self, key: str) -> Dict[str, Any]:
+        return self._stats.setdefault(self._fingerprint(key), dict(self._IDLE, recent_429=[]))
+
+    def _peek(self, key: str) -> Dict[str, Any]:
+        return self._stats.get(self._fingerprint(key), self._IDLE)
+
+    def _forget_idle_session_keys(self, now: float) -> None:
+        for fingerprint in [fingerprint for fingerprint, entry in self._stats.items()
+                            if fingerprint not in self._configured and not entry["in_flight"]
+                            and now - entry["last_used"] > KEY_POOL_SESSION_STATS_TTL]:
+            del self._stats[fingerprint]
+
+    def candidates(self, session_key: str = "") -> List[str]:
+        return self.keys + ([session_key] if session_key and session_key not in self.keys else [])
+
+    def _rejected(self, key: str, now: float) -> bool:
+        entry = self._peek(key)
+        return entry["rejected"] is not None and entry["paused_until"] > now
+
+    def _score(self, key: str, now: float) -> tuple:
+        entry = self._peek(key)
+        recent = sum(1 for moment in entry["recent_429"] if now - moment < KEY_POOL_THROTTLE_WINDOW)
+        return ((self.concurrency - entry["in_flight"]) / (1 + recent), -entry["requests"])
+
+    def acquire(self, session_key: str = "", exclude: tuple = (),
+                cancel_token: Optional[CancellationToken] = None) -> str:
+        """
+        Elige clave para una solicitud y la cuenta como en uso hasta release()
+
+        Espera mientras todas estén llenas o en pausa por un 429; si el token
+        se cancela (o vence) entretanto, lanza Timeout como una solicitud
+        cortada. Las claves rechazadas no se esperan: si solo quedan esas,
+        lanza KeyRejected con su estado.
+        """
+        with self._condition:
+            while True:
+                keys = [key for key in self.candidates(session_key) if key not in exclude] or self.candidates(session_key)
+                if not keys:
+                    return session_key
+                now = time.monotonic()
+                usable = [key for key in keys if not self._rejected(key, now)]
+                if not usable:
+                    raise KeyRejected(self._peek(keys[0])["rejected"],
+                                      f"{self.provider} rechazó la clave {mask_api_key(keys[0])}")
+                keys = usable
+                free = [key for key in keys
+                        if self._peek(key)["paused_until"] <= now and self._peek(key)["in_flight"] < self.concurrency]
+                if free:
+                    key = max(free, key=lambda key: self._score(key, now))
+                    entry = self._entry(key)
+                    entry["in_flight"] += 1
+                    entry["requests"] += 1
+                    entry["last_used"] = now
+                    return key
+                if cancel_token is not None and cancel_token.cancelled:
+                    raise requests.exceptions.Timeout(cancel_token.stop_message)
+                pauses = [self._peek(key)["paused_until"] - now for key in keys if self._peek(key)["paused_until"] > now]
+                self._condition.wait(min([KEY_POOL_WAIT_SLICE] + pauses))
+
+    def release(self, key: str, status: Optional[int], seconds: float, retry_after: Optional[float] = None) -> None:
+        """Devuelve la clave y anota el resultado (status None: fallo de red)"""
+        if not key:
+            return
+        now = time.monotonic()
+        with self._condition:
+            entry = self._entry(key)
+            entry["in_flight"] = max(0, entry["in_flight"] - 1)
+            entry["seconds"] += seconds
+            entry["last_used"] = now
+            if entry["rejected"] is not None and status not in (401, 403):
+                # Otra solicitud en curso con la clave ha funcionado: no estaba rechazada
+                entry["rejected"] = None
+                entry["paused_until"] = now
+            if status == 429:
+                entry["throttled"] += 1
+                entry["recent_429"] = [moment for moment in entry["recent_429"]
+                                       if now - moment < KEY_POOL_THROTTLE_WINDOW] + [now]
+                pause = retry_after if retry_after is not None else KEY_POOL_DEFAULT_PAUSE
+                entry["paused_until"] = max(entry["paused_until"], now + pause)
+            elif status in (401, 403):
+                entry["errors"] += 1
+                # La clave de la sesión no se pausa: su siguiente solicitud
+                # devolverá el mismo error al usuario en vez de esperar
+                if status == 401 and self._fingerprint(key) in self._configured:
+                    entry["rejected"] = status
+                    entry["paused_until"] = now + KEY_POOL_REJECTED_PAUSE
+            elif status is None or status >= 500:
+                entry["errors"] += 1
+            self._forget_idle_session_keys(now)
+            self._condition.notify_all()
+
+    def has_alternative(self, session_key: str, exclude: List[str]) -> bool:
+        """Si queda alguna clave sin probar y sin pausa"""
+        now = time.monotonic()
+        with self._condition:
+            return any(key not in exclude and self._peek(key)["paused_until"] <= now
+                       for key in self.candidates(session_key))
+
+    def stats(self, session_key: str = "") -> List[Dict[str, Any]]:
+        """Salud y uso de cada clave que puede usar la sesión"""
+        now = time.monotonic()
+        rows = []
+        with self._condition:
+            for key in self.candidates(session_key):
+                entry = self._peek(key)
+                recent = sum(1 for moment in entry["recent_429"] if now - moment < KEY_POOL_THROTTLE_WINDOW)
+                if self._rejected(key, now):
+                    health = f"⛔ rechazada ({entry['rejected']}), en pausa {entry['paused_until'] - now:.0f} s"
+                elif entry["paused_until"] > now:
+                    health = f"⏸️ en pausa {entry['paused_until'] - now:.0f} s"
+                elif recent:
+                    health = f"⚠️ {recent} × 429 en {KEY_POOL_THROTTLE_WINDOW:.0f} s"
+                else:
+                    health = "✅ sana"
+                rows.append({
+                    "key": mask_api_key(key),
+                    "source": "configuración" if key in self.keys else "barra lateral",
+                    "health": health,
+                    "in_flight": entry["in_flight"],
+                    "concurrency": self.concurrency,
+                    "requests": entry["requests"],
+                    "throttled": entry["throttled"],
+                    "errors": entry["errors"],
+                    "mean_seconds": entry["seconds"] / entry["requests"] if entry["requests"] else 0.0
+                })
+        return rows
+
+
+@st.cache_resource
+def get_key_pool(provider: str) -> KeyPool:
+    """Pool compartido por todas las sesiones (la configuración se lee al arrancar)"""
+    return KeyPool(provider, configured_api_keys(provider), KEY_POOL_CONCURRENCY[provider])
+
+
+@contextlib.contextmanager
+def pooled_request(provider: str, session_key: str, send, cancel_token: Optional[CancellationToken] = None):
     """
-    Crea un prompt optimizado con estilo INTEGRADO en todo el prompt
-    
-    ESTRATEGIA:
-    1. ESTILO al principio (establecer)
-    2. Contenido visual
-    3. ESTILO al final (reforzar)
+    Envía una solicitud con una clave del pool del proveedor
+
+    send(clave) hace la solicitud y devuelve la respuesta. Si es un 429 y
+    queda otra clave sin pausa, se descarta (cerrándola) y se repite con ella. Da (respuesta, clave), y
+    la clave cuenta como en uso hasta salir del with (en Flux, hasta terminar
+    la consulta del render, que solo responde a la clave que lo envió).
+    """
+    pool = get_key_pool(provider)
+    tried: List[str] = []
+    while True:
+        key = pool.acquire(session_key, tuple(tried), cancel_token)
+        start = time.perf_counter()
+        try:
+            response = send(key)
+        except Exception:
+            pool.release(key, None, time.perf_counter() - start)
+            raise
+        if (response.status_code == 429 and not (cancel_token and cancel_token.cancelled)
+                and pool.has_alternative(session_key, tried + [key])):
+            pool.release(key, 429, time.perf_counter() - start, retry_after_seconds(response))
+            response.close()
+            tried.append(key)
+            continue
+        break
+    try:
+        yield response, key
+    finally:
+        pool.release(key, response.status_code, time.perf_counter() - start, retry_after_seconds(response))
+
+
+# ===============================
+# BACKENDS DE IMAGEN Y VOZ (CON HEDGING)
+# ===============================
+
+# Percentil de latencia a partir del cual se lanza la solicitud duplicada
+HEDGE_PERCENTILE = 0.9
+# Muestras mínimas para fiarse del percentil (antes no se duplica nada)
+HEDGE_MIN_SAMPLES = 8
+# Hilos compartidos por los intentos de respaldo del proceso
+HEDGE_MAX_WORKERS = 32
+
+
+class ImageBackend(ABC):
+    """Proveedor de imágenes: recibe el cuerpo de la solicitud y devuelve imagen PIL o mensaje de error"""
+
+    name = "imagen"
+
+    @abstractmethod
+    def render(self, endpoint: str, json_data: Dict[str, Any], api_key: str, show_progress: bool = False,
+               cancel_token: Optional[CancellationToken] = None, webhook_receiver: Optional[FluxWebhookReceiver] = None):
+        ...
+
+
+class BflImageBackend(ImageBackend):
+    """Black Forest Labs (Flux) en una URL base concreta"""
+
+    def __init__(self, name: str, base_url: str):
+        self.name = name
+        self.base_url = base_url
+
+    def render(self, endpoint, json_data, api_key, show_progress=False, cancel_token=None, webhook_receiver=None):
+        try:
+            with pooled_request("bfl", api_key, lambda key: requests.post(
+                f'{self.base_url}/v1/{endpoint}',
+                headers={
+                    'accept': 'application/json',
+                    'x-key': key,
+                    'Content-Type': 'application/json',
+                },
+                json=with_webhook(json_data, webhook_receiver),
+                timeout=http_timeout(cancel_token, FLUX_SUBMIT_TIMEOUT),
+            ), cancel_token) as (response, key):
+                return process_flux_response(response, key, show_progress, cancel_token, webhook_receiver, self.base_url)
+        except KeyRejected as e:
+            return f"Error: {e}"
+        except requests.exceptions.RequestException as e:
+            # Un timeout recortado por el plazo es el plazo, no un fallo de red
+            if cancel_token and cancel_token.cancelled:
+                return cancel_token.stop_message
+            return f"Error de red con Flux ({self.name}): {str(e)}"
+
+
+class SpeechBackend(ABC):
+    """Proveedor de voz: recibe el cuerpo de la solicitud y devuelve (bytes MP3 o None, error o None)"""
+
+    name = "voz"
+
+    @abstractmethod
+    def synthesize(self, data: Dict[str, Any], api_key: str,
+                   cancel_token: Optional[CancellationToken] = None) -> tuple[Optional[bytes], Optional[str]]:
+        ...
+
+
+class OpenAISpeechBackend(SpeechBackend):
+    """OpenAI Text-to-Speech en una URL base concreta"""
+
+    def __init__(self, name: str, base_url: str):
+        self.name = name
+        self.base_url = base_url
+
+    def synthesize(self, data, api_key, cancel_token=None):
+        with pooled_request("openai", api_key, lambda key: requests.post(
+            f"{self.base_url}/v1/audio/speech",
+            headers={
+                "Authorization": f"Bearer {key}",
+                "Content-Type": "application/json"
+            },
+            json=data,
+            timeout=http_timeout(cancel_token, 120)
+        ), cancel_token) as (response, _):
+            if response.status_code == 200:
+                return response.content, None
+            return None, f"Error generando audio: {response.status_code} - {response.text}"
+
+
+# (principal, respaldo): el respaldo solo se usa al hacer hedging
+IMAGE_BACKENDS = (BflImageBackend("bfl", BFL_API_URL), BflImageBackend("bfl-respaldo", BFL_API_URL_SECONDARY))
+SPEECH_BACKENDS = (OpenAISpeechBackend("openai", OPENAI_API_URL), OpenAISpeechBackend("openai-respaldo", OPENAI_API_URL_SECONDARY))
+
+
+class HedgeStats:
+    """
+    Latencias recientes por tipo de solicitud y resultados del hedging
+
+    Las latencias se guardan divididas por "scale" (p. ej. miles de caracteres
+    en el TTS) para que textos largos y cortos compartan percentil. Las de
+    imagen se siembran con el historial del planificador (mismas muestras
+    "image" con el mismo modelo, pasos y tamaño).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latencies: Dict[tuple, List[float]] = {}
+        self._counters: Dict[str, Dict[str, float]] = {}
+
+    def _samples(self, key: tuple) -> List[float]:
+        # Sin el lock: la primera vez lee el historial del disco; la lista
+        # devuelta se modifica después con el lock tomado
+        with self._lock:
+            samples = self._latencies.get(key)
+        if samples is None:
+            kind, attributes = key[0], dict(key[1:])
+            seeded = [
+                sample["seconds"] for sample in load_render_history()
+                if sample.get("kind") == kind and all(sample.get(name) == value for name, value in attributes.items())
+            ][-200:] if kind == "image" else []
+            with self._lock:
+                samples = self._latencies.setdefault(key, seeded)
+        return samples
+
+    def hedge_delay(self, key: tuple, scale: float = 1.0) -> Optional[float]:
+        """Segundos tras los que conviene duplicar (percentil HEDGE_PERCENTILE) o None si faltan muestras"""
+        samples = self._samples(key)
+        with self._lock:
+            samples = sorted(samples)
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(HEDGE_PERCENTILE * len(samples)))] * scale
+
+    def expected_latency(self, key: tuple, elapsed: float, scale: float = 1.0) -> Optional[float]:
+        """
+        Latencia esperada de una solicitud que lleva elapsed segundos sin
+        terminar: la media de las muestras más lentas que eso (None si no hay)
+        """
+        samples = self._samples(key)
+        with self._lock:
+            slower = [sample * scale for sample in samples if sample * scale > elapsed]
+        return sum(slower) / len(slower) if slower else None
+
+    def record_latency(self, key: tuple, seconds: float, scale: float = 1.0) -> None:
+        samples = self._samples(key)
+        with self._lock:
+            samples.append(seconds / scale)
+            del samples[:-200]
+
+    def record_call(self, kind: str, hedged: bool = False, hedge_won: bool = False) -> None:
+        with self._lock:
+            counters = self._counters.setdefault(kind, {"requests": 0, "hedged": 0, "hedge_wins": 0, "saved_seconds": 0.0})
+            counters["requests"] += 1
+            counters["hedged"] += int(hedged)
+            counters["hedge_wins"] += int(hedge_won)
+
+    def record_saving(self, kind: str, seconds: float) -> None:
+        with self._lock:
+            self._counters[kind]["saved_seconds"] += max(0.0, seconds)
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Por tipo: solicitudes, duplicadas, ganadas por el duplicado, tasa de hedging y segundos ahorrados"""
+        with self._lock:
+            return {
+                kind: dict(values, hedge_rate=values["hedged"] / values["requests"] if values["requests"] else 0.0)
+                for kind, values in self._counters.items()
+            }
+
+
+@st.cache_resource
+def get_hedge_stats() -> HedgeStats:
+    """Estadísticas de hedging compartidas por todas las sesiones del proceso"""
+    return HedgeStats()
+
+
+@st.cache_resource
+def get_hedge_executor() -> ThreadPoolExecutor:
+    """Hilos de los intentos de respaldo, compartidos (no un grupo por llamada)"""
+    return ThreadPoolExecutor(max_workers=HEDGE_MAX_WORKERS, thread_name_prefix="hedge")
+
+
+def hedged_call(kind: str, key: tuple, attempt, backends: tuple, is_success, scale: float = 1.0,
+                cancel_token: Optional[CancellationToken] = None):
+    """
+    Llama al backend principal y, si no ha terminado al llegar al percentil
+    p90 de su latencia, lanza la misma solicitud al de respaldo y se queda
+    con la primera que termine bien
+
+    Args:
+        kind: Tipo para las estadísticas ("imagen", "voz")
+        key: Clave de latencias (tipo y atributos que la determinan)
+        attempt: attempt(backend, token) hace la solicitud; con el token
+            cancelado debe terminar cuanto antes
+        backends: (principal, respaldo o None para no duplicar)
+        is_success: Indica si un resultado es bueno
+        scale: Divisor de la latencia (ver HedgeStats)
+        cancel_token: Cancelación de la generación (se propaga a los intentos)
+
+    La perdedora se cancela en cuanto gana la otra, pero eso solo deja de
+    esperarla: el proveedor cobra la solicitud al recibirla (con BFL, que
+    por defecto es también el respaldo, cada render se paga al enviarse), así
+    que cada respaldo lanzado es una imagen o un audio más pagado. Si gana el
+    respaldo, el ahorro se estima con las latencias registradas de la
+    principal (HedgeStats.expected_latency). La principal corre en el hilo
+    que llama, para que no haga cola con las de otras sesiones; solo el
+    respaldo va a los hilos compartidos de get_hedge_executor, y un hilo
+    vigía por llamada lo lanza al llegar al retardo y propaga la
+    cancelación. Un fallo de la principal antes de lanzar el respaldo se
+    devuelve (o se relanza) tal cual: el hedging no es un reintento.
     """
-    # Obtener el scene_description optimizado de Claude
-    scene_description = scene.get("scene_description", "")
+    primary, secondary = backends
+    stats = get_hedge_stats()
+    delay = stats.hedge_delay(key, scale) if secondary is not None else None
+    start = time.perf_counter()
+    if delay is None:
+        # Sin respaldo o sin historial suficiente: solicitud normal, en este hilo
+        result = attempt(primary, cancel_token)
+        if is_success(result):
+            stats.record_latency(key, time.perf_counter() - start, scale)
+        stats.record_call(kind)
+        return result
     
-    # Limpiar cualquier mención de estilo del scene_description
-    style_keywords_to_remove = [
-        "anime style", "photorealistic", "digital art", "cinematic",
-        "watercolor", "oil painting", "sketch", "vintage", "minimalist",
-        "Japanese animation art", "manga style", "illustration style",
-        "photography", "painting style", "art style", "realistic",
-        "photograph", "photo"
-    ]
+    # Cada intento con su propio token (para parar al perdedor) y el plazo común
+    tokens = [CancellationToken(cancel_token.deadline if cancel_token else None) for _ in range(2)]
+    # Cuándo empezó a correr cada intento: la espera del respaldo en la cola
+    # del grupo compartido no es latencia del proveedor
+    launched: List[Optional[float]] = [start, None]
+    primary_done = threading.Event()
+    backup: List[Optional[Future]] = [None]
+    backup_won = [False]
     
-    cleaned_description = scene_description
-    for keyword in style_keywords_to_remove:
-        pattern = re.compile(re.escape(keyword), re.IGNORECASE)
-        cleaned_description = pattern.sub("", cleaned_description)
+    def run_attempt(index: int, backend):
+        launched[index] = time.perf_counter()
+        result = attempt(backend, tokens[index])
+        # Un intento cancelado por perder no es una latencia representativa
+        if is_success(result) and not tokens[index].cancelled:
+            stats.record_latency(key, time.perf_counter() - launched[index], scale)
+        return result
     
-    # Limpiar formato
-    cleaned_description = re.sub(r',\s*,', ',', cleaned_description)
-    cleaned_description = re.sub(r'\s+', ' ', cleaned_description)
-    cleaned_description = cleaned_description.strip().strip(',').strip()
+    def outcome(future: Future):
+        try:
+            return future.result()
+        except Exception as e:
+            return e
     
-    # Si quedó un prompt válido, usarlo; sino crear manualmente
-    if cleaned_description and len(cleaned_description.split(",")) >= 3:
-        content_prompt = cleaned_description
-    else:
-        visual_composition = scene.get("visual_composition", "medium shot")
-        scene_action = scene.get("action", "")
-        key_features = character.get("key_features", [])
-        compact_features = ", ".join(key_features[:3]) if key_features else character.get("physical_description", "")
-        emotional_state = scene.get("emotional_state", "")
-        lighting_mood = scene.get("lighting_mood", "natural lighting")
-        
-        content_prompt = f"{visual_composition}, {scene_action}, character: {compact_features}, {emotional_state}, {lighting_mood}"
+    def propagate_cancel():
+        if cancel_token and cancel_token.cancel_requested:
+            for token in tokens:
+                token.cancel()
     
-    # Obtener prefijo y sufijo de estilo
-    style_prefix = get_style_prefix(style)
-    style_suffix = get_style_suffix(style)
+    def watch():
+        while not primary_done.wait(0.1):
+            propagate_cancel()
+            if (backup[0] is None and not (cancel_token and cancel_token.cancelled)
+                    and time.perf_counter() - start >= delay):
+                backup[0] = get_hedge_executor().submit(run_attempt, 1, secondary)
+            if backup[0] is not None and backup[0].done() and not backup_won[0]:
+                backup_result = outcome(backup[0])
+                if not isinstance(backup_result, Exception) and is_success(backup_result):
+                    # Gana el respaldo: la principal se para ya
+                    backup_won[0] = True
+                    tokens[0].cancel()
     
-    # ESTRUCTURA: ESTILO + CONTENIDO + ESTILO
-    # Esto crea un "sandwich" que mantiene el estilo constante
-    final_prompt = f"{style_prefix}, {content_prompt}, {style_suffix}"
+    watcher = threading.Thread(target=watch, name="hedge-watch", daemon=True)
+    watcher.start()
+    try:
+        result = run_attempt(0, primary)
+    except Exception as e:
+        result = e
+    finally:
+        primary_done.set()
+        watcher.join()
     
-    return final_prompt
+    winner = None
+    if backup_won[0]:
+        winner, result = 1, outcome(backup[0])
+    elif not isinstance(result, Exception) and is_success(result):
+        winner = 0
+        if backup[0] is not None:
+            # La perdedora se para ya
+            tokens[1].cancel()
+            backup[0].cancel()
+    elif backup[0] is not None:
+        # La principal falló con el respaldo ya en curso: se espera a este
+        while not wait([backup[0]], timeout=0.1).done:
+            propagate_cancel()
+        result = outcome(backup[0])
+        if not isinstance(result, Exception) and is_success(result):
+            winner = 1
+    
+    stats.record_call(kind, hedged=backup[0] is not None, hedge_won=winner == 1)
+    if winner == 1:
+        # Ahorro: lo que la principal habría tardado de más según su historial
+        elapsed = time.perf_counter() - launched[0]
+        expected = stats.expected_latency(key, elapsed, scale)
+        if expected is not None:
+            stats.record_saving(kind, expected - elapsed)
+    if isinstance(result, Exception):
+        raise result
+    return result
 
 
-def get_style_prefix(style: str) -> str:
-    """
-    Prefijos de estilo que van AL INICIO del prompt
-    """
-    style_map = {
-        "photorealistic": "Photorealistic photograph, professional camera work",
-        
-        "digital-art": "Digital art illustration, artistic digital painting",
-        
-        "cinematic": "Cinematic film scene, movie cinematography",
-        
-        "documentary": "Documentary photography, photojournalism style",
-        
-        "portrait": "Portrait photography, professional portrait",
-        
-        "watercolor": "Watercolor painting, traditional watercolor art",
-        
-        "oil-painting": "Oil painting on canvas, classical oil technique",
-        
-        "anime": "Anime art, Japanese animation style",
-        
-        "sketch": "Pencil sketch drawing, hand-drawn sketch",
-        
-        "vintage": "Vintage photograph, retro photography",
-        
-        "minimalist": "Minimalist design, clean aesthetic"
+def claude_headers(api_key: str) -> Dict[str, str]:
+    """Cabeceras comunes de la API de Anthropic"""
+    return {
+        "x-api-key": api_key,
+        "Content-Type": "application/json",
+        "anthropic-version": "2023-06-01"
     }
-    
-    return style_map.get(style, style_map["photorealistic"])
 
 
-def get_style_suffix(style: str) -> str:
+def post_claude_messages(data: Dict[str, Any], api_key: str, timeout: int, ledger: Optional["TokenLedger"] = None, purpose: str = "claude",
+                         cancel_token: Optional[CancellationToken] = None):
     """
-    Sufijos de estilo que van AL FINAL del prompt para reforzar
-    Más cortos que antes pero específicos
+    POST a la Messages API de Anthropic agrupando solicitudes idénticas en curso
+
+    Si se pasa un TokenLedger, registra la estimación local de entrada y el
+    usage real (entrada, salida y caché) de la respuesta bajo "purpose".
+    timeout es el de lectura; con cancel_token se recorta a su plazo. La
+    clave sale del pool de Anthropic (api_key es la de la sesión). Como en
+    do_flux_request, si la solicitud agrupada la paró otra sesión (su
+    cancelación o su plazo, no los nuestros), se repite una vez.
     """
-    style_map = {
-        "photorealistic": "realistic photo quality, authentic imagery",
-        
-        "digital-art": "digital artwork style, illustrated aesthetic",
-        
-        "cinematic": "cinematic look, film quality",
-        
-        "documentary": "documentary style, candid photography",
-        
-        "portrait": "portrait composition, expressive character work",
-        
-        "watercolor": "watercolor medium, painted illustration",
-        
-        "oil-painting": "oil paint texture, painterly style",
-        
-        "anime": "anime aesthetic, manga art style",
-        
-        "sketch": "sketch style, drawn illustration",
-        
-        "vintage": "vintage aesthetic, retro style",
-        
-        "minimalist": "minimalist style, simple design"
+    trimmed = []
+
+    def post(key):
+        request_timeout = http_timeout(cancel_token, timeout)
+        trimmed.append(request_timeout != (HTTP_CONNECT_TIMEOUT, timeout))
+        return requests.post(
+            f"{ANTHROPIC_API_URL}/v1/messages",
+            headers=claude_headers(key),
+            json=data,
+            timeout=request_timeout
+        )
+
+    def send():
+        try:
+            with pooled_request("anthropic", api_key, post, cancel_token) as (response, _):
+                return response
+        except requests.exceptions.Timeout as e:
+            # Un timeout recortado a nuestro plazo es ese plazo, no un fallo del
+            # proveedor: quien espere agrupado con más plazo debe repetirla
+            if trimmed and trimmed[-1] and str(e) not in STOP_MESSAGES:
+                raise requests.exceptions.Timeout(DEADLINE_MESSAGE) from e
+            raise
+
+    def stopped():
+        # Igual que una solicitud propia cortada por la cancelación o el plazo
+        raise requests.exceptions.Timeout(cancel_token.stop_message)
+
+    coalescer = get_request_coalescer()
+    start = time.perf_counter()
+    try:
+        response = coalescer.do("claude", data, send, api_key, cancel_token, stopped)
+    except requests.exceptions.Timeout as e:
+        if str(e) not in STOP_MESSAGES or (cancel_token and cancel_token.cancelled):
+            raise
+        trimmed.clear()
+        response = coalescer.do("claude", data, send, api_key, cancel_token, stopped)
+    if ledger is not None:
+        ledger.record(purpose, data, response, time.perf_counter() - start)
+    return response
+
+# ===============================
+# CONTABILIDAD DE TOKENS Y PRESUPUESTO DE ENTRADA
+# ===============================
+
+# Estimación local: el español ronda 3.5 caracteres por token
+CHARS_PER_TOKEN = 3.5
+
+# USD por millón de tokens (entrada, salida, escritura y lectura de caché)
+CLAUDE_PRICES_PER_MTOK = {
+    "claude-sonnet-4-20250514": {"input": 3.0, "output": 15.0, "cache_creation": 3.75, "cache_read": 0.30},
+    "claude-3-5-sonnet-20241022": {"input": 3.0, "output": 15.0, "cache_creation": 3.75, "cache_read": 0.30}
+}
+
+
+BATCH_PRICE_FACTOR = 0.5
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimación local de tokens (sin llamar a la API de conteo)"""
+    return math.ceil(len(text) / CHARS_PER_TOKEN) if text else 0
+
+
+def estimate_request_tokens(data: Dict[str, Any]) -> int:
+    """Estimación de los tokens de entrada de un payload de la Messages API"""
+    system_prompt = data.get("system", "")
+    if isinstance(system_prompt, list):
+        system_prompt = " ".join(block.get("text", "") for block in system_prompt)
+    total = estimate_tokens(system_prompt)
+    for message in data.get("messages", []):
+        content = message.get("content", "")
+        if isinstance(content, list):
+            content = " ".join(block.get("text", "") for block in content)
+        total += estimate_tokens(content)
+    return total
+
+
+def summarize_to_token_budget(text: str, budget: int) -> str:
+    """
+    Reduce un texto a ~budget tokens con un resumen extractivo local
+
+    Conserva el inicio y el final, y rellena con las frases más
+    representativas (frecuencia de palabras de contenido) en su orden
+    original, marcando los saltos con […]. Todas las frases, también las
+    del inicio y el final, cuentan contra el presupuesto; si aun así se
+    pasa, se recorta la última frase conservada.
+    """
+    if estimate_tokens(text) <= budget:
+        return text
+    sentences = [sentence.strip() for sentence in re.split(r"(?<=[.!?])\s+|\n+", text) if sentence.strip()]
+    if len(sentences) <= 3:
+        return text[:int(budget * CHARS_PER_TOKEN)]
+
+    def content_words(sentence):
+        return [word for word in re.findall(r"\w+", sentence.lower()) if len(word) > 3 and word not in SPANISH_STOPWORDS]
+
+    frequencies: Dict[str, int] = {}
+    for sentence in sentences:
+        for word in content_words(sentence):
+            frequencies[word] = frequencies.get(word, 0) + 1
+
+    def score(index):
+        words = content_words(sentences[index])
+        return sum(frequencies[word] for word in words) / math.sqrt(len(words)) if words else 0.0
+
+    # Primero el inicio y el final, luego por puntuación; +1 por la posible marca […]
+    anchors = [0, len(sentences) - 1, 1]
+    ranked = anchors + [index for index in sorted(range(len(sentences)), key=score, reverse=True) if index not in anchors]
+    selected = set()
+    used = 0
+    for index in ranked:
+        cost = estimate_tokens(sentences[index]) + 1
+        if used + cost > budget:
+            continue
+        selected.add(index)
+        used += cost
+    if not selected:
+        selected.add(0)
+
+    parts = []
+    previous = None
+    for index in sorted(selected):
+        if previous is not None and index != previous + 1:
+            parts.append("[…]")
+        parts.append(sentences[index])
+        previous = index
+    summary = " ".join(parts)
+    max_chars = int(budget * CHARS_PER_TOKEN)
+    if len(summary) > max_chars:
+        summary = summary[:max(0, max_chars - 1)].rstrip() + "…"
+    return summary
+
+
+class TokenLedger:
+    """
+    Registro de tokens de todas las llamadas a Claude de una generación
+
+    Es seguro entre hilos (el análisis por capítulos llama en paralelo) y
+    además aplica el presupuesto de entrada: los textos que se reenvían a
+    Claude se resumen antes de enviarlos si superan input_budget tokens.
+    """
+
+    def __init__(self, input_budget: Optional[int] = None):
+        self.input_budget = input_budget
+        self._lock = threading.Lock()
+        self.calls: List[Dict[str, Any]] = []
+        self.trims: List[Dict[str, Any]] = []
+
+    def fit(self, text: str, purpose: str) -> str:
+        """Devuelve el texto dentro del presupuesto de entrada (resumido si hace falta)"""
+        if not self.input_budget:
+            return text
+        fitted = summarize_to_token_budget(text, self.input_budget)
+        if fitted is not text:
+            with self._lock:
+                self.trims.append({
+                    "purpose": purpose,
+                    "estimated_before": estimate_tokens(text),
+                    "estimated_after": estimate_tokens(fitted)
+                })
+        return fitted
+
+    def record(self, purpose: str, data: Dict[str, Any], response, seconds: float) -> None:
+        """Anota una llamada: estimación previa y usage real de la respuesta"""
+        status = getattr(response, "status_code", None)
+        response_data = {}
+        if status == 200:
+            try:
+                response_data = response.json()
+            except ValueError:
+                pass
+        self.record_usage(purpose, data, response_data, seconds, status)
+
+    def record_usage(self, purpose: str, data: Dict[str, Any], response_data: Dict[str, Any], seconds: float,
+                     status: Optional[int] = 200, batch: bool = False) -> None:
+        """Anota el usage de un mensaje ya decodificado (también los resultados de un lote)"""
+        usage = response_data.get("usage") or {}
+        entry = {
+            "purpose": purpose,
+            "model": data.get("model", ""),
+            "max_tokens": data.get("max_tokens", 0),
+            "estimated_input_tokens": estimate_request_tokens(data),
+            "stop_reason": response_data.get("stop_reason"),
+            "status": status,
+            "seconds": seconds,
+            "batch": batch
+        }
+        for key in ("input_tokens", "output_tokens", "cache_creation_input_tokens", "cache_read_input_tokens"):
+            entry[key] = usage.get(key) or 0
+        with self._lock:
+            self.calls.append(entry)
+
+    @staticmethod
+    def call_cost(entry: Dict[str, Any]) -> float:
+        prices = CLAUDE_PRICES_PER_MTOK.get(entry["model"])
+        if not prices:
+            return 0.0
+        cost = (
+            entry["input_tokens"] * prices["input"]
+            + entry["output_tokens"] * prices["output"]
+            + entry["cache_creation_input_tokens"] * prices["cache_creation"]
+            + entry["cache_read_input_tokens"] * prices["cache_read"]
+        ) / 1_000_000
+        # La Message Batches API factura la mitad
+        return cost * BATCH_PRICE_FACTOR if entry.get("batch") else cost
+
+    def report(self) -> Dict[str, Any]:
+        """Resumen serializable: llamadas, totales por propósito y de la generación"""
+        with self._lock:
+            calls = [dict(entry, cost_usd=self.call_cost(entry)) for entry in self.calls]
+            trims = list(self.trims)
+        keys = ("estimated_input_tokens", "input_tokens", "output_tokens",
+                "cache_creation_input_tokens", "cache_read_input_tokens", "cost_usd")
+        by_purpose: Dict[str, Dict[str, Any]] = {}
+        for entry in calls:
+            totals = by_purpose.setdefault(entry["purpose"], dict({key: 0 for key in keys}, calls=0, truncated=0))
+            totals["calls"] += 1
+            totals["truncated"] += entry["stop_reason"] == "max_tokens"
+            for key in keys:
+                totals[key] += entry[key]
+        return {
+            "input_budget": self.input_budget,
+            "calls": calls,
+            "trims": trims,
+            "by_purpose": by_purpose,
+            "totals": {key: sum(entry[key] for entry in calls) for key in keys}
+        }
+
+# ===============================
+# FUNCIONES PARA DETECCIÓN DE PERSONAJES
+# ===============================
+
+def analysis_max_tokens(max_scenes: int) -> int:
+    """max_tokens del análisis según las escenas pedidas (~250 tokens por escena y hasta 3 personajes)"""
+    return min(4096, 600 + 250 * 3 * max_scenes)
+
+
+def build_character_analysis_request(text_content: str, content_type: str, model: str, max_scenes: int = 3, segment_note: str = "") -> Dict[str, Any]:
+    """Payload de la Messages API para el análisis de personajes (llamada directa o por lotes)"""
+    system_prompt = """Eres un experto en análisis narrativo, dirección cinematográfica y storyboarding visual. Tu tarea es analizar texto narrativo y extraer información detallada sobre personajes para generar secuencias de imágenes VISUALMENTE MUY DIFERENTES pero con personajes consistentes.
+
+PRINCIPIO FUNDAMENTAL DE VARIACIÓN VISUAL:
+Cada escena debe ser ÚNICA y RADICALMENTE DISTINTA en composición, ángulo, acción, ambiente y emoción. El objetivo es contar la historia visualmente con MÁXIMA DIVERSIDAD mientras se mantiene la identidad del personaje.
+
+ESTRATEGIAS OBLIGATORIAS DE VARIACIÓN POR ESCENA:
+
+1. ÁNGULOS DE CÁMARA - Usar DIFERENTES en cada escena:
+   - Extreme close-up (ECU): Solo rostro/detalle, alta carga emocional
+   - Close-up (CU): Cara y hombros, conexión emocional
+   - Medium close-up (MCU): Cintura hacia arriba, balance emoción-acción
+   - Medium shot (MS): Cuerpo completo de rodillas arriba, acción moderada
+   - Medium long shot (MLS): Cuerpo completo con contexto, acción en ambiente
+   - Long shot (LS): Personaje completo en entorno, énfasis en espacio
+   - Extreme long shot (ELS): Personaje pequeño en paisaje vasto, escala épica
+   - Over-the-shoulder (OTS): Desde detrás del personaje
+   - Low angle: Desde abajo hacia arriba, sensación de poder/heroísmo
+   - High angle: Desde arriba hacia abajo, sensación de vulnerabilidad
+   - Bird's eye view: Vista cenital, perspectiva única
+   - Dutch angle: Cámara inclinada, tensión/desorientación
+
+2. POSES Y ACCIONES - COMPLETAMENTE DIFERENTES:
+   - VARIEDAD OBLIGATORIA: sentado, corriendo, saltando, agachado, escondido, mirando hacia arriba, mirando hacia abajo, caminando, parado en una pata, estirándose, jugando, durmiendo, explorando, trepando
+   - PROHIBIDO: Repetir "sentado mirando al frente" en múltiples escenas
+   - CADA ESCENA: Nueva acción física distintiva del personaje
+
+3. ESTADOS EMOCIONALES - Progresión narrativa clara:
+   - Varía entre: curioso, asustado, valiente, triste, feliz, sorprendido, determinado, pensativo, preocupado, aliviado, emocionado
+   - Expresión facial visible y diferente en cada escena
+   - Las emociones deben reflejar la progresión de la historia
+
+4. AMBIENTES Y CONTEXTOS - CONTRASTANTES:
+   - Alternancia OBLIGATORIA entre espacios:
+     * Interior vs Exterior
+     * Espacios abiertos (bosque, campo) vs cerrados (habitación, cueva)
+     * Diferentes ubicaciones del relato (hogar → bosque → río → cueva, etc.)
+   - Elementos del entorno ESPECÍFICOS y VARIADOS por escena
+   - NUNCA el mismo fondo genérico
+
+5. ILUMINACIÓN Y HORA DEL DÍA - VARIEDAD:
+   - Morning sunlight (luz suave matutina)
+   - Afternoon golden light (luz dorada de tarde)
+   - Sunset dramatic lighting (atardecer dramático)
+   - Night moonlight (luz de luna nocturna)
+   - Filtered forest light (luz filtrada entre árboles)
+   - Dramatic rim lighting (luz de contorno)
+   - Magical glow (resplandor mágico)
+   - Soft indoor lighting (luz interior suave)
+   - Dark mysterious shadows (sombras misteriosas)
+
+6. COMPOSICIÓN VISUAL - Regla de tercios y balance:
+   - Variar posición del personaje: centro, izquierda, derecha, primer plano, fondo
+   - Usar profundidad de campo (foreground/background elements)
+   - Cambiar el peso visual de la escena
+
+FORMATO DE RESPUESTA (JSON válido estricto):
+{
+  "has_characters": true/false,
+  "characters": [
+    {
+      "name": "nombre_descriptivo_único",
+      "type": "human/animal/creature/object",
+      "physical_description": "DESCRIPCIÓN FÍSICA BREVE Y ESPECÍFICA en inglés con 2-3 características DISTINTIVAS únicas (color específico, rasgo único memorable, tamaño relativo). Máximo 15 palabras.",
+      "key_features": [
+        "característica física única 1 (ej: bright yellow eyes with vertical pupils)",
+        "característica física única 2 (ej: small black fluffy body)",
+        "característica física única 3 (ej: magical blue glowing collar)"
+      ],
+      "suggested_scenes": [
+        {
+          "action": "acción/momento específico del relato (ej: discovering the magical collar, running from danger, meeting new friend)",
+          "scene_description": "FORMATO OPTIMIZADO: {CAMERA_ANGLE}, {SPECIFIC_ACTION}, {BRIEF_CHARACTER_TRAITS}, {VISIBLE_EMOTION}, {SPECIFIC_ENVIRONMENT}, {LIGHTING_TYPE}",
+          "visual_composition": "tipo de plano específico (extreme close-up/close-up/medium shot/wide shot/low angle/high angle/bird's eye view/dutch angle)",
+          "emotional_state": "emoción específica visible en rostro/postura (frightened/brave/curious/happy/worried/determined/surprised/relieved)",
+          "lighting_mood": "tipo de iluminación específica y hora (morning sunlight/dramatic sunset/moonlight/filtered forest light/magical glow/rim lighting)"
+        }
+      ]
+    }
+  ],
+  "visual_style": "estilo visual sugerido global",
+  "consistency_notes": "elementos clave para mantener consistencia visual del personaje entre TODAS las escenas (ej: always show yellow eyes, blue collar, black fur texture)"
+}
+
+EJEMPLOS DE scene_description CORRECTOS (MÁXIMA VARIACIÓN):
+
+Escena 1 - Close-up emocional:
+"Close-up shot, small black cat with yellow eyes looking directly at camera with wide frightened expression, ears flat back, whiskers trembling, dark mysterious forest background blurred, dramatic rim lighting from behind"
+
+Escena 2 - Wide shot de acción:
+"Wide establishing shot, tiny black cat with blue collar running across old wooden bridge, full body visible in motion, determined posture with tail up, sunny countryside landscape with river below, golden afternoon light"
+
+Escena 3 - Low angle heroico:
+"Low angle hero shot, black cat with glowing collar standing on top of large rock looking up at starry sky, one paw raised heroically, brave expression, magical blue light illuminating face from below, epic night scene with stars, cinematic lighting"
+
+Escena 4 - Extreme close-up de detalle:
+"Extreme close-up, black cat's yellow eye reflecting magical blue light, single eye filling frame, wonder and curiosity visible in pupil dilation, soft indoor lighting, warm bokeh background"
+
+Escena 5 - High angle vulnerable:
+"High angle shot, small black cat crouched low hiding behind fern leaves in jungle, looking up nervously, vulnerable posture with body compressed, giant prehistoric plants surrounding, filtered green jungle light"
+
+Escena 6 - Bird's eye view de contexto:
+"Bird's eye view, black cat walking alone on winding forest path, small figure from above, cautious movement, surrounded by tall trees creating natural frame, dappled morning sunlight on path"
+
+ESTRUCTURA ÓPTIMA de scene_description:
+"{ÁNGULO_ESPECÍFICO}, {ACCIÓN_ÚNICA}, {1-2_RASGOS_CLAVE_PERSONAJE}, {EMOCIÓN_VISIBLE}, {AMBIENTE_ESPECÍFICO}, {LUZ_ESPECÍFICA}"
+
+REGLAS CRÍTICAS:
+
+✅ HACER:
+- Usar UN ángulo de cámara diferente por escena
+- Crear UNA acción física única por escena
+- Mostrar UNA emoción distinta y progresiva por escena
+- Cambiar el ambiente/ubicación según la narrativa
+- Variar la iluminación para mood diferente
+- Mantener 2-3 características físicas clave en CADA escena para consistencia
+- Usar máximo 30-40 palabras por scene_description
+- Priorizar DIFERENCIA visual sobre descripción exhaustiva del personaje
+
+❌ NO HACER:
+- Repetir el mismo ángulo (ej: "medium shot" en todas)
+- Usar la misma pose (ej: "sitting looking forward" repetido)
+- Describir TODO el personaje detalladamente en cada prompt
+- Usar descripciones genéricas (ej: "in a forest" sin especificar)
+- Mantener la misma iluminación "natural light" en todas
+- Crear escenas visualmente similares
+- Exceder 40 palabras por scene_description
+- Olvidar las características clave que dan consistencia
+
+OBJETIVO FINAL:
+Generar exactamente el número solicitado de escenas por personaje que:
+1. Cuenten la historia visualmente de forma DINÁMICA
+2. Muestren MÁXIMA VARIEDAD en composición, ángulo, acción, emoción, ambiente
+3. Mantengan CONSISTENCIA del personaje mediante 2-3 rasgos físicos clave siempre presentes
+4. Sean escenas CINEMATOGRÁFICAS dignas de un storyboard profesional
+
+Responde ÚNICAMENTE con el JSON solicitado, sin texto adicional."""
+
+    user_message = f"""Analiza el siguiente {content_type} momento a momento y extrae información detallada sobre personajes:
+
+CONTENIDO COMPLETO:
+{text_content}
+
+NÚMERO DE ESCENAS A GENERAR: {max_scenes} escenas por personaje
+
+INSTRUCCIONES ESPECÍFICAS DE ANÁLISIS:
+1. Lee el relato/cuento COMPLETO de principio a fin
+2. Identifica los momentos narrativos MÁS IMPORTANTES donde cada personaje:
+   - Tiene una acción significativa
+   - Experimenta una emoción fuerte
+   - Interactúa con otros personajes o el ambiente
+   - Avanza la historia de manera relevante
+
+3. Para cada escena seleccionada, crea una descripción siguiendo ESTRICTAMENTE este formato:
+   "{{ÁNGULO_DE_CÁMARA_ESPECÍFICO}}, {{ACCIÓN_FÍSICA_ÚNICA}}, {{2-3_RASGOS_FÍSICOS_CLAVE}}, {{EMOCIÓN_VISIBLE_EN_ROSTRO}}, {{AMBIENTE_ESPECÍFICO_CON_DETALLES}}, {{TIPO_DE_ILUMINACIÓN}}"
+
+4. ASEGÚRATE de que cada scene_description incluya:
+   ✅ UN ángulo de cámara diferente (close-up, wide shot, low angle, bird's eye, etc.)
+   ✅ UNA acción/pose completamente diferente (NO repetir "sentado" o "mirando")
+   ✅ Solo 2-3 características físicas clave del personaje (NO toda la descripción)
+   ✅ UNA emoción específica apropiada al momento narrativo
+   ✅ UN ambiente/ubicación específico diferente (interior/exterior, día/noche, etc.)
+   ✅ UN tipo de iluminación variado según el mood de la escena
+
+5. DISTRIBUCIÓN DE ESCENAS SUGERIDA para {max_scenes} escenas:
+   - Escena inicial: Establecer personaje (medium/wide shot, estado neutral/curioso)
+   - Escenas intermedias: Conflicto/desarrollo (close-ups emocionales, action shots)
+   - Escena final: Resolución/clímax (low angle heroico o wide shot épico)
+
+6. VERIFICACIÓN FINAL antes de responder:
+   - ¿Cada escena tiene un ángulo de cámara DIFERENTE? ✓
+   - ¿Cada escena muestra una acción/pose ÚNICA? ✓
+   - ¿Las escenas cuentan la progresión de la historia? ✓
+   - ¿La iluminación y ambiente varían según la narrativa? ✓
+   - ¿Se mantienen 2-3 rasgos clave del personaje en TODAS las escenas? ✓
+
+OBJETIVO: Crear {max_scenes} escenas VISUALMENTE DISTINTAS que narren la historia del personaje de forma cinematográfica, manteniendo su identidad visual mediante características físicas consistentes.
+
+Responde ÚNICAMENTE con el JSON válido solicitado, sin comentarios adicionales."""
+
+    if segment_note:
+        user_message = f"{segment_note}\n\n{user_message}"
+    
+    data = {
+        "model": model,
+        "max_tokens": analysis_max_tokens(max_scenes),
+        "temperature": 0.4,
+        "system": system_prompt,
+        "messages": [
+            {"role": "user", "content": user_message}
+        ]
     }
     
-    return style_map.get(style, style_map["photorealistic"])
-# Función para generar texto con Claude Sonnet 4
-def generate_text_claude(prompt: str, content_type: str, api_key: str, model: str, max_tokens: int) -> Optional[str]:
-    """Genera contenido de texto usando Claude Sonnet 4 de Anthropic"""
+    return data
+
+
+def parse_character_analysis(response_data: Dict[str, Any]) -> tuple[Dict[str, Any], Optional[str]]:
+    """Extrae el JSON de personajes de una respuesta de la Messages API"""
+    claude_response = response_data["content"][0]["text"].strip()
+    
+    # Limpiar respuesta de Claude (quitar markdown si existe)
+    if claude_response.startswith("```json"):
+        claude_response = claude_response.replace("```json", "").replace("```", "").strip()
+    
+    # Parsear JSON
     try:
-        headers = {
-            "x-api-key": api_key,
-            "Content-Type": "application/json",
-            "anthropic-version": "2023-06-01"
-        }
+        return json.loads(claude_response), None
+    except json.JSONDecodeError as e:
+        truncated = " (respuesta truncada por max_tokens)" if response_data.get("stop_reason") == "max_tokens" else ""
+        return {"has_characters": False, "characters": []}, f"Error parseando análisis de personajes{truncated}: {e}. Respuesta de Claude: {claude_response[:500]}..."
+
+
+def request_character_analysis(text_content: str, content_type: str, api_key: str, model: str, max_scenes: int = 3, segment_note: str = "", ledger: Optional[TokenLedger] = None, cancel_token: Optional[CancellationToken] = None) -> tuple[Dict[str, Any], Optional[str]]:
+    """
+    Pide a Claude el análisis de personajes sin tocar la interfaz (apto para hilos)
+
+    Args:
+        segment_note: Aviso opcional al inicio del mensaje cuando el texto es
+            solo un fragmento de una obra más larga
+        ledger: Registro de tokens; también aplica su presupuesto de entrada
+        cancel_token: Plazo y cancelación de la generación
+
+    Returns:
+        (análisis, mensaje de error o None)
+    """
+    try:
+        if ledger is not None:
+            text_content = ledger.fit(text_content, "análisis de personajes")
+
+        data = build_character_analysis_request(text_content, content_type, model, max_scenes, segment_note)
         
-        # Prompts específicos y mejorados para Claude (AMPLIADOS)
-        system_prompts = {
-            "ejercicio": """Eres un experto educador con amplia experiencia pedagógica. Tu tarea es crear ejercicios educativos que sean:
-- Estructurados y progresivos
-- Adaptados al nivel apropiado
-- Incluyan explicaciones claras
-- Contengan ejemplos prácticos
-- Fomenten el pensamiento crítico
-Formato: Título, objetivos, desarrollo paso a paso, ejercicios prácticos y evaluación.""",
-            
-            "artículo": """Eres un periodista y escritor especializado en crear artículos informativos de alta calidad. Tu contenido debe ser:
-- Bien investigado y fundamentado
-- Estructurado con introducción, desarrollo y conclusión
-- Objetivo y equilibrado
-- Accesible para el público general
-- Incluir datos relevantes y contexto necesario
-Formato: Titular atractivo, lead informativo, desarrollo en secciones y conclusión impactante.""",
-            
-            "texto": """Eres un escritor creativo versátil. Tu objetivo es crear textos que sean:
-- Originales y creativos
-- Bien estructurados y fluidos
-- Adaptados al propósito específico
-- Engaging y memorable
-- Con estilo apropiado para el contenido
-Formato: Libre, adaptado al tipo de texto solicitado.""",
-            
-            "relato": """Eres un narrador experto en storytelling. Tus relatos deben incluir:
-- Desarrollo sólido de personajes
-- Trama envolvente con conflicto y resolución
-- Ambientación vivida y detallada
-- Diálogos naturales y efectivos
-- Ritmo narrativo apropiado
-- Final satisfactorio
-Formato: Estructura narrativa clásica con introducción, desarrollo, clímax y desenlace.""",
-            
-            "diálogo situacional": """Eres un experto en creación de contenido educativo para idiomas. Tu tarea es crear diálogos situacionales que sean:
-- Naturales y auténticos
-- Apropiados para el contexto
-- Con vocabulario cotidiano útil
-- Breves pero completos (6-10 líneas)
-- Incluyan expresiones idiomáticas comunes
-Formato: Diálogo breve + lista de 5-7 expresiones clave con explicación.""",
-            
-            "artículo cultural": """Eres un escritor especializado en divulgación cultural. Tu contenido debe ser:
-- Informativo y atractivo (120-150 palabras)
-- Claro y accesible
-- Con ejemplos concretos
-- Que despierte interés cultural
-- Educativo pero entretenido
-Formato: Artículo divulgativo + glosario de 5 palabras clave.""",
-            
-            "artículo de actualidad": """Eres un periodista especializado en adaptar noticias para diferentes audiencias. Tu contenido debe ser:
-- Claro y directo (80-120 palabras)
-- Con lenguaje sencillo
-- Bien estructurado
-- Objetivo y factual
-- Fácil de comprender
-Formato: Noticia simplificada + 2-3 preguntas de comprensión.""",
-            
-            "artículo biográfico": """Eres un biógrafo especializado en crear perfiles concisos. Tu contenido debe incluir:
-- Información esencial (100-120 palabras)
-- Fechas y logros clave
-- Relevancia cultural o histórica
-- Datos verificables
-- Un elemento curioso o interesante
-Formato: Mini-biografía + dato curioso final.""",
-            
-            "clip de noticias": """Eres un editor de noticias especializado en contenido ultrabreve. Tu tarea es crear:
-- Textos muy concisos (40-60 palabras por noticia)
-- Información directa y clara
-- Vocabulario comprensible
-- Estilo telegráfico pero completo
-- 5 noticias por tema
-Formato: 5 clips de noticias + frase resumen simple.""",
-            
-            "pregunta de debate": """Eres un moderador experto en generar debates constructivos. Tu contenido debe:
-- Plantear dilemas interesantes
-- Ser breve pero provocativo (2-3 frases)
-- Usar lenguaje sencillo
-- Estimular múltiples perspectivas
-- Terminar con pregunta abierta
-Formato: Introducción del tema + pregunta de debate abierta.""",
-            
-            "receta de cocina": """Eres un chef educador especializado en recetas sencillas. Tu contenido debe incluir:
-- Instrucciones claras (80-100 palabras)
-- Lista de ingredientes específica
-- Pasos en imperativo
-- Técnicas básicas explicadas
-- Consejos útiles
-Formato: Lista de ingredientes + 3-4 pasos de preparación.""",
-            
-            "post de redes sociales": """Eres un community manager especializado en contenido educativo para redes. Tu contenido debe ser:
-- Muy breve (40-60 palabras)
-- Tono informal y cercano
-- Incluir emojis apropiados
-- 1-2 hashtags relevantes
-- Lenguaje coloquial auténtico
-Formato: Post informal + traducción de expresiones coloquiales.""",
+        response = post_claude_messages(data, api_key, timeout=90, ledger=ledger, purpose="análisis de personajes", cancel_token=cancel_token)
+        
+        if response.status_code == 200:
+            return parse_character_analysis(response.json())
+        else:
+            return {"has_characters": False, "characters": []}, f"Error en análisis de personajes: {response.status_code}"
             
-            "trivia cultural": """Eres un creador de contenido educativo especializado en preguntas de cultura general. Tu contenido debe incluir:
-- 6 preguntas de opción múltiple
-- 4 opciones (A-D) por pregunta
-- Respuesta correcta marcada
-- Explicación breve de cada respuesta
-- Nivel apropiado de dificultad
-Formato: Batería de preguntas + explicaciones de respuestas correctas."""
+    except Exception as e:
+        return {"has_characters": False, "characters": []}, f"Error analizando personajes: {str(e)}"
+
+
+def analyze_characters_with_claude(text_content: str, content_type: str, api_key: str, model: str, max_scenes: int = 3, long_text_mode: bool = True, concurrency: int = 4, ledger: Optional[TokenLedger] = None, cancel_token: Optional[CancellationToken] = None) -> Dict[str, Any]:
+    """
+    Analiza el texto con Claude para detectar personajes y generar character cards con escenas específicas y variadas
+
+    Con long_text_mode, los textos de más de LONG_TEXT_THRESHOLD_CHARS se
+    dividen en capítulos/fragmentos que se analizan en paralelo y se fusionan.
+    """
+    if long_text_mode and len(text_content) > LONG_TEXT_THRESHOLD_CHARS:
+        windows = split_text_into_windows(text_content)
+        if len(windows) > 1:
+            ui().info(f"📚 Texto largo: analizando {len(windows)} fragmentos en paralelo")
+            character_data, errors = analyze_long_text_characters(
+                windows, content_type, api_key, model, max_scenes, concurrency, ledger, cancel_token
+            )
+        else:
+            character_data, error = request_character_analysis(text_content, content_type, api_key, model, max_scenes, ledger=ledger, cancel_token=cancel_token)
+            errors = [error] if error else []
+    else:
+        character_data, error = request_character_analysis(text_content, content_type, api_key, model, max_scenes, ledger=ledger, cancel_token=cancel_token)
+        errors = [error] if error else []
+    
+    for error in errors:
+        ui().error(error)
+    
+    # Validar que se generaron escenas variadas
+    if character_data.get("has_characters", False):
+        total_scenes = sum(len(char.get("suggested_scenes", [])) for char in character_data.get("characters", []))
+        if total_scenes > 0:
+            ui().success(f"✅ Claude generó {total_scenes} escenas variadas para la secuencia")
+    
+    return character_data
+
+
+# ===============================
+# ANÁLISIS POR CAPÍTULOS PARA TEXTOS LARGOS
+# ===============================
+
+# A partir de este tamaño (~3000 tokens) el análisis se hace por fragmentos
+LONG_TEXT_THRESHOLD_CHARS = 12000
+LONG_TEXT_WINDOW_CHARS = 8000
+CHAPTER_HEADING_PATTERN = re.compile(
+    r"^\s*(?:#{1,3}\s+.+|(?:cap[ií]tulo|chapter|parte|part)\s+[\wIVXLC]+.*)$",
+    re.IGNORECASE | re.MULTILINE
+)
+
+
+def split_text_into_windows(text: str, window_chars: int = LONG_TEXT_WINDOW_CHARS) -> List[str]:
+    """
+    Divide un texto largo en fragmentos respetando capítulos y párrafos
+
+    Si hay encabezados de capítulo se corta por ellos (uniendo capítulos
+    cortos); si no, se agrupan párrafos hasta ~window_chars caracteres.
+    """
+    headings = [match.start() for match in CHAPTER_HEADING_PATTERN.finditer(text)]
+    if len(headings) >= 2:
+        bounds = ([0] if headings[0] > 0 else []) + headings + [len(text)]
+        sections = [text[start:end] for start, end in zip(bounds, bounds[1:]) if text[start:end].strip()]
+    else:
+        sections = [paragraph for paragraph in re.split(r"\n\s*\n", text) if paragraph.strip()]
+
+    windows: List[str] = []
+    current = ""
+    for section in sections:
+        # Capítulos enormes: se parten por párrafos
+        pieces = [section] if len(section) <= window_chars else [
+            paragraph for paragraph in re.split(r"\n\s*\n", section) if paragraph.strip()
+        ]
+        for piece in pieces:
+            if current and len(current) + len(piece) > window_chars:
+                windows.append(current)
+                current = ""
+            current = f"{current}\n\n{piece}" if current else piece
+    if current:
+        windows.append(current)
+    return windows
+
+
+def normalize_character_name(name: str) -> str:
+    """Nombre comparable: minúsculas, sin acentos, sin artículos ni signos"""
+    normalized = unicodedata.normalize("NFKD", name.lower())
+    normalized = "".join(char for char in normalized if not unicodedata.combining(char))
+    words = [word for word in re.findall(r"[a-z0-9]+", normalized) if word not in {"el", "la", "los", "las", "the", "a", "an", "un", "una"}]
+    return " ".join(words)
+
+
+def feature_similarity(first: Dict[str, Any], second: Dict[str, Any]) -> float:
+    """Similitud de Jaccard entre las palabras de las características físicas de dos personajes"""
+    def words(character):
+        text = " ".join(character.get("key_features", [])) + " " + character.get("physical_description", "")
+        return {word for word in re.findall(r"[a-záéíóúñ]+", text.lower()) if len(word) > 3}
+    first_words, second_words = words(first), words(second)
+    if not first_words or not second_words:
+        return 0.0
+    return len(first_words & second_words) / len(first_words | second_words)
+
+
+def merge_character_registries(analyses: List[Dict[str, Any]], max_scenes: int) -> Dict[str, Any]:
+    """
+    Fusiona los análisis de cada fragmento en un único registro de personajes
+
+    Un personaje se considera el mismo si coincide el nombre normalizado o si
+    es del mismo tipo y sus rasgos físicos se parecen lo suficiente. Que un
+    nombre contenga al otro ("Juan" y "Juan Pérez") solo basta con el mismo
+    tipo y algún parecido en los rasgos: "lobo" y "lobo feroz", o "Juan" y
+    "Juan Pérez hijo", pueden ser personajes distintos. Las escenas se reparten de forma uniforme a lo
+    largo de toda la narración.
+    """
+    merged: List[Dict[str, Any]] = []
+    for window_index, analysis in enumerate(analyses):
+        for character in analysis.get("characters", []):
+            name = normalize_character_name(character.get("name", ""))
+            match = None
+            for existing in merged:
+                existing_name = normalize_character_name(existing["name"])
+                same_type = existing.get("type") == character.get("type")
+                similarity = feature_similarity(existing, character) if same_type else 0.0
+                same_name = bool(name) and name == existing_name
+                contained_name = bool(name) and (name in existing_name.split() or existing_name in name.split())
+                if same_name or (contained_name and similarity >= 0.25) or similarity >= 0.5:
+                    match = existing
+                    break
+
+            scenes = [dict(scene, _window=window_index) for scene in character.get("suggested_scenes", [])]
+            if match is None:
+                # Listas nuevas: los rasgos se amplían después y no deben tocar el análisis original
+                merged.append(dict(character, key_features=list(character.get("key_features", [])), suggested_scenes=scenes))
+            else:
+                for feature in character.get("key_features", []):
+                    if feature not in match["key_features"] and len(match["key_features"]) < 5:
+                        match["key_features"].append(feature)
+                match["suggested_scenes"].extend(scenes)
+
+    for character in merged:
+        scenes = character["suggested_scenes"]
+        if len(scenes) > max_scenes:
+            # Escenas repartidas por toda la narración (principio, desarrollo y final)
+            step = (len(scenes) - 1) / max(1, max_scenes - 1)
+            scenes = [scenes[round(index * step)] for index in range(max_scenes)]
+        character["suggested_scenes"] = [
+            {key: value for key, value in scene.items() if key != "_window"} for scene in scenes
+        ]
+
+    notes = []
+    for analysis in analyses:
+        note = analysis.get("consistency_notes")
+        if note and note not in notes:
+            notes.append(note)
+    return {
+        "has_characters": bool(merged),
+        "characters": merged,
+        "visual_style": next((analysis["visual_style"] for analysis in analyses if analysis.get("visual_style")), ""),
+        "consistency_notes": " ".join(notes)
+    }
+
+
+def analyze_long_text_characters(windows: List[str], content_type: str, api_key: str, model: str, max_scenes: int, concurrency: int = 4, ledger: Optional[TokenLedger] = None, cancel_token: Optional[CancellationToken] = None) -> tuple[Dict[str, Any], List[str]]:
+    """
+    Analiza cada fragmento en paralelo y fusiona los registros de personajes
+
+    Returns:
+        (análisis fusionado, lista de errores por fragmento)
+    """
+    # Pedir algo más de escenas de las necesarias por fragmento para poder repartir
+    scenes_per_window = min(max_scenes, math.ceil(max_scenes / len(windows)) + 1)
+    executor = ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(windows))))
+    try:
+        futures = {
+            executor.submit(
+                request_character_analysis,
+                window, content_type, api_key, model, scenes_per_window,
+                f"FRAGMENTO {index + 1} DE {len(windows)} de una obra más larga. Analiza solo lo que ocurre en este fragmento; usa siempre el mismo nombre para cada personaje.",
+                ledger,
+                cancel_token
+            ): index
+            for index, window in enumerate(windows)
         }
+        results = [None] * len(windows)
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    analyses = [analysis for analysis, error in results if analysis.get("has_characters")]
+    errors = [f"Fragmento {index + 1}: {error}" for index, (_, error) in enumerate(results) if error]
+    return merge_character_registries(analyses, max_scenes), errors
+
+def generate_character_seed(character_name: str, scene_action: str = "", scene_index: int = 0, style: str = "photorealistic") -> int:
+    """
+    Genera seeds con MAYOR variación para diferentes escenas del mismo personaje
+    y OFFSET por estilo para empujar hacia espacios latentes específicos
+    
+    Args:
+        character_name: Nombre del personaje (para consistencia base)
+        scene_action: Acción específica de la escena (para variación)
+        scene_index: Índice de la escena (para variación adicional)
+        style: Estilo visual seleccionado (afecta el offset del seed)
+    
+    Returns:
+        Seed que mantiene consistencia del personaje pero con variación por escena y estilo
+    """
+    import hashlib
+    
+    # Seed base del personaje (consistencia - 50% del peso)
+    base_hash = hashlib.md5(character_name.encode()).hexdigest()
+    base_seed = int(base_hash[:8], 16) % 100000
+    
+    # Variación por acción de escena (40% del peso)
+    if scene_action and scene_action.strip():
+        scene_hash = hashlib.md5(scene_action.encode()).hexdigest()
+        scene_variation = int(scene_hash[:6], 16) % 10000  # Variación 10x mayor que antes
+    else:
+        scene_variation = 0
+    
+    # Variación por índice de escena (10% del peso)
+    index_variation = scene_index * 1000
+    
+    # NUEVO: Offset por estilo para empujar hacia espacios latentes específicos
+    # Estilos ilustrados/no-realistas necesitan offset para evitar zona hiperrealista
+    style_offset = get_style_seed_offset(style)
+    
+    # Combinar con pesos balanceados
+    final_seed = (base_seed + scene_variation + index_variation + style_offset) % 1000000
+    
+    return final_seed
+
+
+def get_style_seed_offset(style: str) -> int:
+    """
+    Calcula offset de seed según el estilo visual
+    
+    Los estilos no-realistas necesitan offset para empujar la generación
+    hacia áreas del espacio latente que producen imágenes más ilustradas/artísticas
+    en lugar del realismo 3D/fotográfico que Flux favorece por defecto
+    
+    Args:
+        style: Estilo visual seleccionado
+    
+    Returns:
+        Valor de offset a sumar al seed (0 para estilos realistas)
+    """
+    style_offsets = {
+        "photorealistic": 0,           # Sin offset - zona realista natural
+        "digital-art": 100000,         # Offset significativo hacia ilustración
+        "cinematic": 0,                # Realista/fotográfico
+        "documentary": 0,              # Realista/fotográfico
+        "portrait": 0,                 # Realista/fotográfico
+        "watercolor": 150000,          # Offset hacia painted/acuarela
+        "oil-painting": 200000,        # Offset fuerte hacia painted/óleo
+        "anime": 250000,               # Offset máximo hacia 2D/anime
+        "sketch": 180000,              # Offset hacia drawn/dibujado
+        "vintage": 50000,              # Offset leve - semi-realista
+        "minimalist": 120000           # Offset moderado hacia ilustración simple
+    }
+    
+    return style_offsets.get(style, 0)
+
+def strip_style_keywords(description: str) -> str:
+    """Quita de un prompt las menciones de estilo para poder envolverlo en otro"""
+    style_keywords_to_remove = [
+        "anime style", "photorealistic", "digital art", "cinematic",
+        "watercolor", "oil painting", "sketch", "vintage", "minimalist",
+        "Japanese animation art", "manga style", "illustration style",
+        "photography", "painting style", "art style", "realistic",
+        "photograph", "photo"
+    ]
+    
+    cleaned_description = description
+    for keyword in style_keywords_to_remove:
+        pattern = re.compile(re.escape(keyword), re.IGNORECASE)
+        cleaned_description = pattern.sub("", cleaned_description)
+    
+    # Limpiar formato
+    cleaned_description = re.sub(r',\s*,', ',', cleaned_description)
+    cleaned_description = re.sub(r'\s+', ' ', cleaned_description)
+    return cleaned_description.strip().strip(',').strip()
+
+def create_character_prompt(character: Dict, scene: Dict, style: str = "photorealistic") -> str:
+    """
+    Crea un prompt optimizado con estilo INTEGRADO en todo el prompt
+    
+    ESTRATEGIA:
+    1. ESTILO al principio (establecer)
+    2. Contenido visual
+    3. ESTILO al final (reforzar)
+    """
+    # Obtener el scene_description optimizado de Claude, sin menciones de estilo
+    cleaned_description = strip_style_keywords(scene.get("scene_description", ""))
+    
+    # Si quedó un prompt válido, usarlo; sino crear manualmente
+    if cleaned_description and len(cleaned_description.split(",")) >= 3:
+        content_prompt = cleaned_description
+    else:
+        visual_composition = scene.get("visual_composition", "medium shot")
+        scene_action = scene.get("action", "")
+        key_features = character.get("key_features", [])
+        compact_features = ", ".join(key_features[:3]) if key_features else character.get("physical_description", "")
+        emotional_state = scene.get("emotional_state", "")
+        lighting_mood = scene.get("lighting_mood", "natural lighting")
         
-        # Instrucciones específicas según el tipo de contenido
-        def get_content_specific_instructions(content_type):
-            instructions = {
-                "ejercicio": "Crea un ejercicio educativo completo con estructura clara.",
-                
-                "artículo": "Redacta un artículo informativo completo y bien estructurado.",
-                
-                "texto": "Crea un texto apropiado para el tema y propósito indicado.",
-                
-                "relato": "Escribe un relato completo con estructura narrativa clásica.",
-                
-                "diálogo situacional": """Escribe un diálogo breve (6–10 líneas) entre dos personajes en el contexto indicado. Incluye expresiones naturales del idioma, vocabulario cotidiano y un tono realista. Añade debajo una lista con 5–7 expresiones clave con traducción sencilla.""",
-                
-                "artículo cultural": """Redacta un artículo cultural de 120–150 palabras sobre el tema indicado. Usa un estilo divulgativo, frases cortas y vocabulario accesible. Añade un pequeño glosario de 5 palabras con definición sencilla.""",
-                
-                "artículo de actualidad": """Escribe un artículo breve de actualidad de 80–120 palabras sobre el tema/noticia indicada. Usa un estilo sencillo y claro. Añade 2–3 preguntas de comprensión al final.""",
-                
-                "artículo biográfico": """Crea una biografía breve de 100–120 palabras sobre la persona indicada. Incluye 3–4 hechos clave (fechas, logros, importancia). Añade una línea final con 'Dato curioso'.""",
-                
-                "clip de noticias": """Escribe un clip de 5 noticias en 40–60 palabras cada una sobre el tema indicado. Debe ser directo, claro y con vocabulario comprensible. Añade una frase con la idea principal en lenguaje aún más simple.""",
-                
-                "pregunta de debate": """Plantea una pregunta de debate en 2–3 frases sobre el tema indicado. El texto debe introducir la situación brevemente y terminar con una pregunta abierta. Nivel de idioma sencillo, para fomentar conversación.""",
-                
-                "receta de cocina": """Escribe una receta breve de 80–100 palabras sobre cómo preparar el plato indicado. Incluye una lista corta de ingredientes y 3–4 pasos en imperativo (ej.: corta, mezcla, añade).""",
-                
-                "post de redes sociales": """Crea un post de redes sociales de 40–60 palabras sobre el tema indicado. Usa tono informal, emojis y 1–2 hashtags. Añade debajo la traducción literal de 3 expresiones coloquiales que aparezcan.""",
-                
-                "trivia cultural": """Escribe una batería de 6 preguntas de trivial cultural sobre el tema indicado. Ofrece 4 opciones (A–D) y marca la correcta. Añade una explicación breve (1 frase) de por qué la respuesta es la correcta."""
+        content_prompt = f"{visual_composition}, {scene_action}, character: {compact_features}, {emotional_state}, {lighting_mood}"
+    
+    # Obtener prefijo y sufijo de estilo
+    style_prefix = get_style_prefix(style)
+    style_suffix = get_style_suffix(style)
+    
+    # ESTRUCTURA: ESTILO + CONTENIDO + ESTILO
+    # Esto crea un "sandwich" que mantiene el estilo constante
+    final_prompt = f"{style_prefix}, {content_prompt}, {style_suffix}"
+    
+    return final_prompt
+
+
+def get_style_prefix(style: str) -> str:
+    """
+    Prefijos de estilo que van AL INICIO del prompt
+    """
+    style_map = {
+        "photorealistic": "Photorealistic photograph, professional camera work",
+        
+        "digital-art": "Digital art illustration, artistic digital painting",
+        
+        "cinematic": "Cinematic film scene, movie cinematography",
+        
+        "documentary": "Documentary photography, photojournalism style",
+        
+        "portrait": "Portrait photography, professional portrait",
+        
+        "watercolor": "Watercolor painting, traditional watercolor art",
+        
+        "oil-painting": "Oil painting on canvas, classical oil technique",
+        
+        "anime": "Anime art, Japanese animation style",
+        
+        "sketch": "Pencil sketch drawing, hand-drawn sketch",
+        
+        "vintage": "Vintage photograph, retro photography",
+        
+        "minimalist": "Minimalist design, clean aesthetic"
+    }
+    
+    return style_map.get(style, style_map["photorealistic"])
+
+
+def get_style_suffix(style: str) -> str:
+    """
+    Sufijos de estilo que van AL FINAL del prompt para reforzar
+    Más cortos que antes pero específicos
+    """
+    style_map = {
+        "photorealistic": "realistic photo quality, authentic imagery",
+        
+        "digital-art": "digital artwork style, illustrated aesthetic",
+        
+        "cinematic": "cinematic look, film quality",
+        
+        "documentary": "documentary style, candid photography",
+        
+        "portrait": "portrait composition, expressive character work",
+        
+        "watercolor": "watercolor medium, painted illustration",
+        
+        "oil-painting": "oil paint texture, painterly style",
+        
+        "anime": "anime aesthetic, manga art style",
+        
+        "sketch": "sketch style, drawn illustration",
+        
+        "vintage": "vintage aesthetic, retro style",
+        
+        "minimalist": "minimalist style, simple design"
+    }
+    
+    return style_map.get(style, style_map["photorealistic"])
+
+
+# ===============================
+# PROMPT VISUAL LOCAL (MODO RÁPIDO)
+# ===============================
+
+# Palabras vacías en español que nunca aportan contenido visual
+SPANISH_STOPWORDS = {
+    "el", "la", "los", "las", "un", "una", "unos", "unas", "de", "del", "al", "a", "en", "y", "o", "u", "que",
+    "por", "para", "con", "sin", "sobre", "entre", "hasta", "desde", "como", "pero", "mas", "más", "muy", "ya",
+    "se", "su", "sus", "lo", "le", "les", "me", "te", "nos", "mi", "tu", "es", "son", "era", "fue", "ser", "estar",
+    "está", "están", "ha", "han", "había", "hay", "este", "esta", "estos", "estas", "ese", "esa", "eso", "aquel",
+    "cuando", "donde", "porque", "si", "no", "también", "todo", "toda", "todos", "todas", "otro", "otra", "cada",
+    "él", "ella", "ellos", "ellas", "yo", "tú", "usted", "ustedes", "qué", "cómo", "cuál", "quién", "tan", "sí"
+}
+
+# Léxico visual español → inglés (sustantivos con peso visual)
+VISUAL_NOUNS = {
+    # Lugares y entornos
+    "bosque": "forest", "selva": "jungle", "río": "river", "mar": "sea", "playa": "beach", "montaña": "mountain",
+    "montañas": "mountains", "lago": "lake", "desierto": "desert", "campo": "countryside", "jardín": "garden",
+    "ciudad": "city", "pueblo": "village", "calle": "street", "plaza": "town square", "mercado": "market",
+    "casa": "house", "castillo": "castle", "puente": "bridge", "cueva": "cave", "isla": "island", "puerto": "harbor",
+    "escuela": "school", "aula": "classroom", "biblioteca": "library", "laboratorio": "laboratory", "oficina": "office",
+    "cafetería": "cafe", "restaurante": "restaurant", "aeropuerto": "airport", "estación": "train station",
+    "hospital": "hospital", "museo": "museum", "iglesia": "church", "catedral": "cathedral", "teatro": "theater",
+    "cocina": "kitchen", "habitación": "bedroom", "tienda": "shop", "granja": "farm", "parque": "park",
+    "cielo": "sky", "nieve": "snow", "lluvia": "rain", "tormenta": "storm", "niebla": "fog", "nubes": "clouds",
+    # Personas
+    "niño": "child", "niña": "girl", "niños": "children", "hombre": "man", "mujer": "woman", "anciano": "old man",
+    "anciana": "old woman", "abuelo": "grandfather", "abuela": "grandmother", "familia": "family",
+    "estudiante": "student", "estudiantes": "students", "profesor": "teacher", "profesora": "teacher",
+    "médico": "doctor", "científico": "scientist", "rey": "king", "reina": "queen", "princesa": "princess",
+    "príncipe": "prince", "caballero": "knight", "pescador": "fisherman", "artista": "artist", "músico": "musician",
+    "amigos": "friends", "personas": "people", "gente": "crowd",
+    # Animales
+    "gato": "cat", "gata": "cat", "perro": "dog", "caballo": "horse", "pájaro": "bird", "búho": "owl",
+    "lobo": "wolf", "zorro": "fox", "oso": "bear", "dragón": "dragon", "pez": "fish", "mariposa": "butterfly",
+    "conejo": "rabbit", "león": "lion", "elefante": "elephant", "ratón": "mouse",
+    # Objetos
+    "libro": "book", "libros": "books", "mapa": "map", "llave": "key", "collar": "necklace", "espada": "sword",
+    "barco": "boat", "tren": "train", "coche": "car", "bicicleta": "bicycle", "reloj": "clock", "lámpara": "lamp",
+    "vela": "candle", "carta": "letter", "cuadro": "painting", "guitarra": "guitar", "piano": "piano",
+    "mesa": "table", "ventana": "window", "puerta": "door", "fuego": "fire", "árbol": "tree", "árboles": "trees",
+    "flores": "flowers", "flor": "flower", "estrellas": "stars", "luna": "moon", "sol": "sun",
+    "ordenador": "computer", "teléfono": "phone", "comida": "food", "fiesta": "celebration"
+}
+
+# Adjetivos visuales que modifican al sustantivo anterior ("bosque oscuro" → "dark forest")
+VISUAL_ADJECTIVES = {
+    "oscuro": "dark", "oscura": "dark", "viejo": "old", "vieja": "old", "antiguo": "ancient", "antigua": "ancient",
+    "pequeño": "small", "pequeña": "small", "grande": "large", "enorme": "huge", "alto": "tall", "alta": "tall",
+    "negro": "black", "negra": "black", "blanco": "white", "blanca": "white", "rojo": "red", "roja": "red",
+    "azul": "blue", "verde": "green", "dorado": "golden", "dorada": "golden", "brillante": "glowing",
+    "misterioso": "mysterious", "misteriosa": "mysterious", "mágico": "magical", "mágica": "magical",
+    "tranquilo": "peaceful", "tranquila": "peaceful", "moderno": "modern", "moderna": "modern",
+    "abandonado": "abandoned", "abandonada": "abandoned", "nevado": "snowy", "nevada": "snowy",
+    "soleado": "sunny", "soleada": "sunny", "lluvioso": "rainy", "lluviosa": "rainy", "feliz": "happy",
+    "triste": "sad", "curioso": "curious", "curiosa": "curious", "valiente": "brave"
+}
+
+# Momento del día → iluminación
+VISUAL_LIGHTING = {
+    "amanecer": "soft dawn light", "mañana": "fresh morning light", "mediodía": "bright midday sun",
+    "tarde": "warm afternoon light", "atardecer": "golden sunset light", "anochecer": "blue hour dusk light",
+    "noche": "moonlit night atmosphere", "medianoche": "deep night, moonlight"
+}
+
+# Escena base por tipo de contenido cuando el texto no aporta suficientes elementos
+LOCAL_BASE_SCENES = {
+    "ejercicio": "an inviting educational setting with study materials",
+    "artículo": "an informative editorial scene illustrating the main topic",
+    "texto": "an evocative scene capturing the main idea",
+    "relato": "a cinematic narrative scene",
+    "diálogo situacional": "two people having a natural conversation in an everyday place",
+    "artículo cultural": "a cultural scene with people taking part in a local tradition",
+    "artículo de actualidad": "a contemporary news scene with a clear composition",
+    "artículo biográfico": "a portrait scene evoking the life and era of the subject",
+    "clip de noticias": "a newsroom or on-location reporting scene with a clear focal point",
+    "pregunta de debate": "people exchanging points of view around a table",
+    "receta de cocina": "a cozy kitchen with fresh ingredients and an appetizing dish",
+    "post de redes sociales": "a vibrant contemporary lifestyle scene with dynamic composition",
+    "trivia cultural": "an engaging quiz setting with books, maps and cultural symbols"
+}
+
+
+def extract_visual_elements(text: str, limit: int = 6) -> Dict[str, Any]:
+    """
+    Extrae elementos visuales del texto con heurísticas locales (sin LLM)
+
+    Puntúa los sustantivos del léxico visual por frecuencia, con más peso en
+    el primer párrafo, y forma sintagmas nominales con el adjetivo que los
+    sigue. Las palabras en mayúscula fuera de inicio de frase se cuentan como
+    nombres propios (personajes) y no se incluyen en el prompt.
+
+    Returns:
+        Diccionario con subjects (sintagmas en inglés por relevancia),
+        lighting y character_count
+    """
+    words = re.findall(r"[A-Za-zÁÉÍÓÚÜÑáéíóúüñ]+|[.!?:\n]", text)
+    first_paragraph_end = len(re.findall(r"[A-Za-zÁÉÍÓÚÜÑáéíóúüñ]+|[.!?:\n]", text.split("\n\n", 1)[0]))
+    scores: Dict[str, float] = {}
+    first_position: Dict[str, int] = {}
+    lighting = None
+
+    # Primera pasada: mayúscula a mitad de frase = nombre propio ("Luna" es un personaje, no la luna)
+    proper_names = set()
+    sentence_start = True
+    for word in words:
+        if word in ".!?:\n":
+            sentence_start = True
+            continue
+        if word[0].isupper() and not sentence_start and word.lower() not in SPANISH_STOPWORDS:
+            proper_names.add(word)
+        sentence_start = False
+
+    for position, word in enumerate(words):
+        if word in ".!?:\n" or word in proper_names:
+            continue
+        lower = word.lower()
+        if lower in VISUAL_LIGHTING and lighting is None:
+            lighting = VISUAL_LIGHTING[lower]
+        if lower not in VISUAL_NOUNS:
+            continue
+
+        phrase = VISUAL_NOUNS[lower]
+        following = words[position + 1].lower() if position + 1 < len(words) else ""
+        if following in VISUAL_ADJECTIVES:
+            phrase = f"{VISUAL_ADJECTIVES[following]} {phrase}"
+        weight = 1.5 if position < first_paragraph_end else 1.0
+        scores[phrase] = scores.get(phrase, 0.0) + weight
+        first_position.setdefault(phrase, position)
+
+    # Un sintagma con adjetivo absorbe al sustantivo suelto ("dark forest" > "forest")
+    for phrase in list(scores):
+        noun = phrase.split()[-1]
+        if phrase != noun and noun in scores:
+            scores[phrase] += scores.pop(noun)
+            first_position[phrase] = min(first_position[phrase], first_position.pop(noun))
+
+    ranked = sorted(scores, key=lambda phrase: (-scores[phrase], first_position[phrase]))
+    return {"subjects": ranked[:limit], "lighting": lighting, "character_count": len(proper_names)}
+
+
+def build_local_visual_prompt(text_content: str, content_type: str, style: str) -> Optional[str]:
+    """
+    Construye el prompt visual en inglés sin llamar a Claude (modo rápido)
+
+    Combina los elementos extraídos del texto con la escena base del tipo de
+    contenido y el prefijo/sufijo del estilo. Si ningún sustantivo del texto
+    está en el léxico visual devuelve None: una escena genérica no describe
+    el contenido y el llamador debe pedir el prompt a Claude.
+    """
+    elements = extract_visual_elements(text_content)
+    subjects = elements["subjects"]
+    if not subjects:
+        return None
+    base_scene = LOCAL_BASE_SCENES.get(content_type, LOCAL_BASE_SCENES["texto"])
+
+    parts = [get_style_prefix(style)]
+    parts.append(f"{base_scene} featuring {', '.join(subjects[:3])}")
+    if len(subjects) > 3:
+        parts.append(f"with {', '.join(subjects[3:])} in the scene")
+    if elements["character_count"] >= 2 and not any(word in " ".join(subjects) for word in ("people", "friends", "family", "children", "crowd")):
+        parts.append("several characters interacting")
+    parts.append(elements["lighting"] or "natural lighting")
+    parts.append(get_style_suffix(style))
+    return ", ".join(parts)
+
+
+# Función para generar texto con Claude Sonnet 4
+def build_text_request(prompt: str, content_type: str, model: str, max_tokens: int) -> Dict[str, Any]:
+    """Payload de la Messages API para generar un contenido (llamada directa o por lotes)"""
+    # Prompts específicos y mejorados para Claude (AMPLIADOS)
+    system_prompts = {
+        "ejercicio": """Eres un experto educador con amplia experiencia pedagógica. Tu tarea es crear ejercicios educativos que sean:
+- Estructurados y progresivos
+- Adaptados al nivel apropiado
+- Incluyan explicaciones claras
+- Contengan ejemplos prácticos
+- Fomenten el pensamiento crítico
+Formato: Título, objetivos, desarrollo paso a paso, ejercicios prácticos y evaluación.""",
+        
+        "artículo": """Eres un periodista y escritor especializado en crear artículos informativos de alta calidad. Tu contenido debe ser:
+- Bien investigado y fundamentado
+- Estructurado con introducción, desarrollo y conclusión
+- Objetivo y equilibrado
+- Accesible para el público general
+- Incluir datos relevantes y contexto necesario
+Formato: Titular atractivo, lead informativo, desarrollo en secciones y conclusión impactante.""",
+        
+        "texto": """Eres un escritor creativo versátil. Tu objetivo es crear textos que sean:
+- Originales y creativos
+- Bien estructurados y fluidos
+- Adaptados al propósito específico
+- Engaging y memorable
+- Con estilo apropiado para el contenido
+Formato: Libre, adaptado al tipo de texto solicitado.""",
+        
+        "relato": """Eres un narrador experto en storytelling. Tus relatos deben incluir:
+- Desarrollo sólido de personajes
+- Trama envolvente con conflicto y resolución
+- Ambientación vivida y detallada
+- Diálogos naturales y efectivos
+- Ritmo narrativo apropiado
+- Final satisfactorio
+Formato: Estructura narrativa clásica con introducción, desarrollo, clímax y desenlace.""",
+        
+        "diálogo situacional": """Eres un experto en creación de contenido educativo para idiomas. Tu tarea es crear diálogos situacionales que sean:
+- Naturales y auténticos
+- Apropiados para el contexto
+- Con vocabulario cotidiano útil
+- Breves pero completos (6-10 líneas)
+- Incluyan expresiones idiomáticas comunes
+Formato: Diálogo breve + lista de 5-7 expresiones clave con explicación.""",
+        
+        "artículo cultural": """Eres un escritor especializado en divulgación cultural. Tu contenido debe ser:
+- Informativo y atractivo (120-150 palabras)
+- Claro y accesible
+- Con ejemplos concretos
+- Que despierte interés cultural
+- Educativo pero entretenido
+Formato: Artículo divulgativo + glosario de 5 palabras clave.""",
+        
+        "artículo de actualidad": """Eres un periodista especializado en adaptar noticias para diferentes audiencias. Tu contenido debe ser:
+- Claro y directo (80-120 palabras)
+- Con lenguaje sencillo
+- Bien estructurado
+- Objetivo y factual
+- Fácil de comprender
+Formato: Noticia simplificada + 2-3 preguntas de comprensión.""",
+        
+        "artículo biográfico": """Eres un biógrafo especializado en crear perfiles concisos. Tu contenido debe incluir:
+- Información esencial (100-120 palabras)
+- Fechas y logros clave
+- Relevancia cultural o histórica
+- Datos verificables
+- Un elemento curioso o interesante
+Formato: Mini-biografía + dato curioso final.""",
+        
+        "clip de noticias": """Eres un editor de noticias especializado en contenido ultrabreve. Tu tarea es crear:
+- Textos muy concisos (40-60 palabras por noticia)
+- Información directa y clara
+- Vocabulario comprensible
+- Estilo telegráfico pero completo
+- 5 noticias por tema
+Formato: 5 clips de noticias + frase resumen simple.""",
+        
+        "pregunta de debate": """Eres un moderador experto en generar debates constructivos. Tu contenido debe:
+- Plantear dilemas interesantes
+- Ser breve pero provocativo (2-3 frases)
+- Usar lenguaje sencillo
+- Estimular múltiples perspectivas
+- Terminar con pregunta abierta
+Formato: Introducción del tema + pregunta de debate abierta.""",
+        
+        "receta de cocina": """Eres un chef educador especializado en recetas sencillas. Tu contenido debe incluir:
+- Instrucciones claras (80-100 palabras)
+- Lista de ingredientes específica
+- Pasos en imperativo
+- Técnicas básicas explicadas
+- Consejos útiles
+Formato: Lista de ingredientes + 3-4 pasos de preparación.""",
+        
+        "post de redes sociales": """Eres un community manager especializado en contenido educativo para redes. Tu contenido debe ser:
+- Muy breve (40-60 palabras)
+- Tono informal y cercano
+- Incluir emojis apropiados
+- 1-2 hashtags relevantes
+- Lenguaje coloquial auténtico
+Formato: Post informal + traducción de expresiones coloquiales.""",
+        
+        "trivia cultural": """Eres un creador de contenido educativo especializado en preguntas de cultura general. Tu contenido debe incluir:
+- 6 preguntas de opción múltiple
+- 4 opciones (A-D) por pregunta
+- Respuesta correcta marcada
+- Explicación breve de cada respuesta
+- Nivel apropiado de dificultad
+Formato: Batería de preguntas + explicaciones de respuestas correctas."""
+    }
+    
+    # Instrucciones específicas según el tipo de contenido
+    def get_content_specific_instructions(content_type):
+        instructions = {
+            "ejercicio": "Crea un ejercicio educativo completo con estructura clara.",
+            
+            "artículo": "Redacta un artículo informativo completo y bien estructurado.",
+            
+            "texto": "Crea un texto apropiado para el tema y propósito indicado.",
+            
+            "relato": "Escribe un relato completo con estructura narrativa clásica.",
+            
+            "diálogo situacional": """Escribe un diálogo breve (6–10 líneas) entre dos personajes en el contexto indicado. Incluye expresiones naturales del idioma, vocabulario cotidiano y un tono realista. Añade debajo una lista con 5–7 expresiones clave con traducción sencilla.""",
+            
+            "artículo cultural": """Redacta un artículo cultural de 120–150 palabras sobre el tema indicado. Usa un estilo divulgativo, frases cortas y vocabulario accesible. Añade un pequeño glosario de 5 palabras con definición sencilla.""",
+            
+            "artículo de actualidad": """Escribe un artículo breve de actualidad de 80–120 palabras sobre el tema/noticia indicada. Usa un estilo sencillo y claro. Añade 2–3 preguntas de comprensión al final.""",
+            
+            "artículo biográfico": """Crea una biografía breve de 100–120 palabras sobre la persona indicada. Incluye 3–4 hechos clave (fechas, logros, importancia). Añade una línea final con 'Dato curioso'.""",
+            
+            "clip de noticias": """Escribe un clip de 5 noticias en 40–60 palabras cada una sobre el tema indicado. Debe ser directo, claro y con vocabulario comprensible. Añade una frase con la idea principal en lenguaje aún más simple.""",
+            
+            "pregunta de debate": """Plantea una pregunta de debate en 2–3 frases sobre el tema indicado. El texto debe introducir la situación brevemente y terminar con una pregunta abierta. Nivel de idioma sencillo, para fomentar conversación.""",
+            
+            "receta de cocina": """Escribe una receta breve de 80–100 palabras sobre cómo preparar el plato indicado. Incluye una lista corta de ingredientes y 3–4 pasos en imperativo (ej.: corta, mezcla, añade).""",
+            
+            "post de redes sociales": """Crea un post de redes sociales de 40–60 palabras sobre el tema indicado. Usa tono informal, emojis y 1–2 hashtags. Añade debajo la traducción literal de 3 expresiones coloquiales que aparezcan.""",
+            
+            "trivia cultural": """Escribe una batería de 6 preguntas de trivial cultural sobre el tema indicado. Ofrece 4 opciones (A–D) y marca la correcta. Añade una explicación breve (1 frase) de por qué la respuesta es la correcta."""
+        }
+        return instructions.get(content_type, instructions["texto"])
+    
+    user_message = f"""Crea un {content_type} sobre: {prompt}
+
+{get_content_specific_instructions(content_type)}
+
+Por favor, asegúrate de que el contenido sea:
+1. Completo y bien desarrollado según las especificaciones
+2. Apropiado para el tipo de contenido solicitado
+3. Interesante y bien escrito
+4. Listo para ser presentado como contenido final
+
+El {content_type} debe seguir exactamente el formato y extensión indicados."""
+    
+    data = {
+        "model": model,
+        "max_tokens": max_tokens,
+        "temperature": 0.7,
+        "system": system_prompts.get(content_type, system_prompts["texto"]),
+        "messages": [
+            {"role": "user", "content": user_message}
+        ]
+    }
+    
+    return data
+
+
+def generate_text_claude(prompt: str, content_type: str, api_key: str, model: str, max_tokens: int, ledger: Optional[TokenLedger] = None, cancel_token: Optional[CancellationToken] = None) -> Optional[str]:
+    """Genera contenido de texto usando Claude Sonnet 4 de Anthropic"""
+    try:
+        data = build_text_request(prompt, content_type, model, max_tokens)
+        
+        response = post_claude_messages(data, api_key, timeout=120, ledger=ledger, purpose="texto", cancel_token=cancel_token)
+        
+        if response.status_code == 200:
+            response_data = response.json()
+            if response_data.get("stop_reason") == "max_tokens":
+                ui().warning(f"⚠️ El texto se cortó al alcanzar el límite de {max_tokens} tokens; sube 'Max tokens Claude' si necesitas más extensión")
+            return response_data["content"][0]["text"]
+        else:
+            ui().error(f"Error generando texto con Claude: {response.status_code} - {response.text}")
+            return None
+            
+    except Exception as e:
+        ui().error(f"Error en la generación de texto con Claude: {str(e)}")
+        return None
+
+# Nueva función para generar prompt visual con Claude
+def generate_visual_prompt_with_claude(text_content: str, content_type: str, style: str, api_key: str, model: str, ledger: Optional[TokenLedger] = None, cancel_token: Optional[CancellationToken] = None) -> Optional[str]:
+    """Genera un prompt visual optimizado usando Claude basado en el contenido generado"""
+    try:
+        if ledger is not None:
+            text_content = ledger.fit(text_content, "prompt visual")
+
+        # System prompt especializado para generación de prompts visuales
+        system_prompt = """Eres un experto en generación de prompts para modelos de AI de imágenes, específicamente para Flux. Tu tarea es analizar contenido de texto y crear prompts visuales optimizados en inglés.
+
+REGLAS IMPORTANTES:
+1. El prompt DEBE estar en inglés perfecto
+2. Debe ser específico y descriptivo visualmente
+3. Incluir términos técnicos de fotografía/arte cuando sea apropiado
+4. Adaptar al estilo solicitado
+5. Ser conciso pero detallado (máximo 150 palabras)
+6. NO reproducir texto del contenido, solo elementos visuales
+
+ESTRUCTURA DEL PROMPT:
+[Descripción visual principal] + [Estilo técnico] + [Calidad/Resolución] + [Elementos compositivos]"""
+# Instrucciones específicas por tipo de contenido (AMPLIADAS)
+        content_instructions = {
+            "ejercicio": """Analiza este ejercicio educativo y crea un prompt visual que represente:
+- La materia/tema principal del ejercicio
+- Un ambiente educativo apropiado (aula, laboratorio, biblioteca, etc.)
+- Elementos visuales que complementen el aprendizaje
+- Personas estudiando o practicando el tema si es relevante
+- Materiales educativos relacionados
+
+Evita incluir texto específico del ejercicio, solo elementos visuales educativos.""",
+            
+            "artículo": """Analiza este artículo y crea un prompt visual que represente:
+- El tema central o concepto principal
+- Elementos que ilustren la información clave
+- Un contexto visual apropiado para el tema
+- Objetos, personas o lugares relevantes al contenido
+- Una composición que transmita el mensaje principal
+
+Evita texto específico, enfócate en elementos visuales informativos.""",
+            
+            "texto": """Analiza este texto y crea un prompt visual que capture:
+- El tema o concepto principal
+- El tono y ambiente del contenido
+- Elementos visuales que complementen el mensaje
+- Una composición apropiada para el propósito del texto
+- Elementos que refuercen visualmente la idea principal
+
+Enfócate en la esencia visual del contenido.""",
+            
+            "relato": """Analiza este relato y crea un prompt visual que capture:
+- La escena más representativa o impactante
+- Los personajes principales (sin nombres específicos)
+- La ambientación y época de la historia
+- El mood/atmósfera del relato
+- Elementos narrativos clave visualmente
+
+Crea una escena cinematográfica que represente el relato.""",
+            
+            "diálogo situacional": """Analiza este diálogo situacional y crea un prompt visual que muestre:
+- El contexto/lugar donde ocurre la conversación
+- Dos personas conversando de manera natural
+- El ambiente apropiado (cafetería, aeropuerto, oficina, etc.)
+- Elementos que refuercen el contexto situacional
+- Una escena realista y cotidiana
+
+Representa visualmente la situación del diálogo.""",
+            
+            "artículo cultural": """Analiza este artículo cultural y crea un prompt visual que represente:
+- La tradición, costumbre o elemento cultural principal
+- Escenas típicas relacionadas con la cultura descrita
+- Personas participando en actividades culturales
+- Elementos visuales representativos (objetos, lugares, vestimentas)
+- Un ambiente que refleje la identidad cultural
+
+Captura la esencia visual de la cultura descrita.""",
+            
+            "artículo de actualidad": """Analiza este artículo de actualidad y crea un prompt visual que muestre:
+- El tema principal de la noticia
+- Elementos visuales que ilustren la información
+- Un contexto actual y contemporáneo
+- Personas, lugares u objetos relacionados con la noticia
+- Una composición informativa y clara
+
+Representa visualmente el contenido noticioso.""",
+            
+            "artículo biográfico": """Analiza este artículo biográfico y crea un prompt visual que incluya:
+- Un retrato o representación de la época de la persona
+- Elementos relacionados con sus logros principales
+- El contexto histórico o profesional relevante
+- Objetos o símbolos asociados con su trabajo/vida
+- Una composición que honre su legado
+
+Crea una representación visual dignificante del personaje.""",
+            
+            "clip de noticias": """Analiza estos clips de noticias y crea un prompt visual que muestre:
+- Una composición estilo noticiero o medio de comunicación
+- Elementos gráficos informativos modernos
+- Un ambiente de sala de redacción o estudio de noticias
+- Personas trabajando en medios de comunicación
+- Una estética profesional y contemporánea
+
+Representa el mundo del periodismo y las noticias.""",
+            
+            "pregunta de debate": """Analiza esta pregunta de debate y crea un prompt visual que represente:
+- Personas en situación de diálogo o debate
+- Un ambiente apropiado para la discusión (aula, mesa redonda, etc.)
+- Elementos que sugieran intercambio de ideas
+- Una composición que invite al diálogo
+- Diversidad de perspectivas visuales
+
+Crea una escena que fomente la conversación.""",
+            
+            "receta de cocina": """Analiza esta receta y crea un prompt visual que muestre:
+- Los ingredientes principales de la receta
+- Una cocina acogedora y bien equipada
+- El proceso de cocinar o el plato terminado
+- Utensilios de cocina apropiados
+- Una presentación apetitosa y profesional
+
+Representa visualmente la experiencia culinaria.""",
+            
+            "post de redes sociales": """Analiza este post y crea un prompt visual que capture:
+- El estilo visual típico de redes sociales
+- Elementos modernos y contemporáneos
+- Una estética atractiva y "instagrameable"
+- Personas usando dispositivos móviles o en situaciones sociales
+- Colores vibrantes y composición dinámica
+
+Crea una imagen perfecta para redes sociales.""",
+            
+            "trivia cultural": """Analiza esta trivia cultural y crea un prompt visual que represente:
+- Un ambiente de quiz o juego educativo
+- Elementos relacionados con el tema de las preguntas
+- Personas participando en actividades de conocimiento
+- Libros, mapas, o símbolos culturales relevantes
+- Una composición educativa y atractiva
+
+Representa el mundo del conocimiento y la cultura general."""
+        }
+        
+        # Adaptaciones por estilo visual
+        # CAMBIAR de español a inglés:
+        style_adaptations = {
+        "photorealistic": "Professional realistic photography with natural lighting, high definition, sharp photographic composition, crisp details",
+        "digital-art": "High quality digital art, vibrant colors, artistic composition, modern illustrative style, professional design",
+        "cinematic": "Cinematic composition, dramatic lighting, depth of field, film atmosphere, high production quality",
+        "documentary": "Authentic documentary style, candid photography, natural lighting, real environment, journalistic quality",
+        "portrait": "Professional portrait photography, studio lighting, people-centered composition, professional quality",
+        "watercolor": "Artistic watercolor style, soft flowing colors, traditional painting technique, paper texture",
+        "oil-painting": "Classic oil painting, visible brushstrokes, rich colors, old masters technique",
+        "anime": "Japanese anime style, vibrant colors, clean lines, expressive character design",
+        "sketch": "Artistic pencil drawing, expressive lines, soft shading, sketch style",
+        "vintage": "Nostalgic vintage style, desaturated colors, aged effect, retro atmosphere", 
+        "minimalist": "Minimalist design, simple composition, neutral colors, negative spaces"
+        }
+        
+        user_message = f"""CONTENIDO A ANALIZAR:
+{text_content}
+
+TIPO DE CONTENIDO: {content_type}
+ESTILO DESEADO: {style}
+
+{content_instructions.get(content_type, content_instructions["texto"])}
+
+INSTRUCCIONES ADICIONALES PARA EL ESTILO:
+{style_adaptations.get(style, style_adaptations["photorealistic"])}
+
+Por favor, responde ÚNICAMENTE con el prompt visual en inglés optimizado para Flux, sin explicaciones adicionales."""
+        
+        data = {
+            "model": model,
+            "max_tokens": 200,
+            "temperature": 0.3,  # Menos temperatura para más consistencia
+            "system": system_prompt,
+            "messages": [
+                {"role": "user", "content": user_message}
+            ]
+        }
+        
+        response = post_claude_messages(data, api_key, timeout=60, ledger=ledger, purpose="prompt visual", cancel_token=cancel_token)
+        
+        if response.status_code == 200:
+            response_data = response.json()
+            visual_prompt = response_data["content"][0]["text"].strip()
+            return visual_prompt
+        else:
+            ui().error(f"Error generando prompt visual con Claude: {response.status_code} - {response.text}")
+            return None
+            
+    except Exception as e:
+        ui().error(f"Error en la generación de prompt visual con Claude: {str(e)}")
+        return None
+
+# Función para optimizar prompt para Flux (ahora simplificada ya que Claude genera el prompt completo)
+def optimize_prompt_for_flux(prompt, style="photorealistic"):
+    """Aplica optimizaciones finales al prompt ya generado por Claude"""
+    try:
+        # Agregar términos técnicos finales si no están presentes
+        quality_terms = "high quality, detailed, professional"
+        resolution_terms = "8K resolution, sharp focus"
+        
+        # Verificar si ya contiene términos de calidad
+        prompt_lower = prompt.lower()
+        if not any(term in prompt_lower for term in ["high quality", "8k", "detailed", "professional", "masterpiece"]):
+            prompt += f", {quality_terms}, {resolution_terms}"
+        
+        return prompt
+    except Exception as e:
+        ui().error(f"Error optimizando prompt: {str(e)}")
+        return prompt
+
+# Función para generar imagen con Flux Pro (basada en el archivo de referencia)
+def generate_image_flux_pro(prompt, width, height, steps, api_key, seed=None, style="photorealistic", show_progress=True, cancel_token=None, webhook=False, hedge=False):
+    """
+    Genera imagen usando Flux Pro 1.1 con guidance ajustado según el estilo
+    
+    Args:
+        prompt: Prompt de texto para la imagen
+        width: Ancho de la imagen
+        height: Alto de la imagen
+        steps: Número de pasos de generación
+        api_key: API key de Black Forest Labs
+        seed: Seed para reproducibilidad (opcional)
+        style: Estilo visual que afecta el valor de guidance
+        show_progress: Mostrar spinner/progreso en Streamlit (False en hilos)
+        webhook: Esperar el aviso de BFL en el receptor local en vez de consultar
+        hedge: Duplicar la solicitud en el backend de respaldo si tarda más que el p90
+    
+    Returns:
+        Imagen PIL o mensaje de error
+    """
+    
+    # Guidance más bajo = más libertad creativa, menos apegado al prompt
+    # Guidance más alto = más estricto con el prompt, fuerza el estilo
+    guidance_by_style = {
+        "photorealistic": 2.5,    # Default de Flux
+        "digital-art": 3.5,       # Más guidance para forzar estilo ilustrado
+        "cinematic": 2.5,         # Default - realista
+        "documentary": 2.5,       # Default - realista
+        "portrait": 2.5,          # Default - realista
+        "watercolor": 4.0,        # Alto para forzar estilo painted
+        "oil-painting": 4.0,      # Alto para forzar estilo painted
+        "anime": 4.5,             # Muy alto para forzar 2D anime
+        "sketch": 3.5,            # Alto para forzar estilo dibujado
+        "vintage": 2.5,           # Default - semi-realista
+        "minimalist": 3.0         # Moderado para estilo simple
+    }
+    
+    guidance_value = guidance_by_style.get(style, 2.5)
+    
+    json_data = {
+        'prompt': prompt,
+        'width': int(width),
+        'height': int(height),
+        'steps': int(steps),
+        'prompt_upsampling': False,
+        'seed': seed if seed is not None else 42,
+        'guidance': guidance_value,  # Ajustado según el estilo
+        'safety_tolerance': 2,
+        'interval': 2,
+        'output_format': 'jpeg'
+    }
+    
+    # Renders idénticos en curso (doble clic, otra sesión) comparten resultado
+    receiver = get_flux_webhook_receiver() if webhook else None
+    return do_flux_request(
+        {"endpoint": "flux-pro-1.1", **json_data},
+        lambda: hedged_call(
+            "imagen",
+            ("image", ("model", "flux-pro-1.1"), ("steps", int(steps)), ("width", int(width)), ("height", int(height))),
+            lambda backend, token: backend.render("flux-pro-1.1", json_data, api_key, show_progress, token, receiver),
+            (IMAGE_BACKENDS[0], IMAGE_BACKENDS[1] if hedge else None),
+            lambda result: isinstance(result, Image.Image),
+            cancel_token=cancel_token
+        ),
+        cancel_token,
+        api_key
+    )
+
+# Función para generar imagen con Flux Ultra (basada en el archivo de referencia)  
+def generate_image_flux_ultra(prompt, aspect_ratio, api_key, seed=None, show_progress=True, cancel_token=None, webhook=False, hedge=False):
+    """Genera imagen usando Flux Pro 1.1 Ultra"""
+    json_data = {
+        'prompt': prompt,
+        'seed': seed if seed is not None else 42,  # Usar seed proporcionado o default
+        'aspect_ratio': aspect_ratio,
+        'safety_tolerance': 2,
+        'output_format': 'jpeg',
+        'raw': False
+    }
+    
+    receiver = get_flux_webhook_receiver() if webhook else None
+    return do_flux_request(
+        {"endpoint": "flux-pro-1.1-ultra", **json_data},
+        lambda: hedged_call(
+            "imagen",
+            ("image", ("model", "flux-pro-1.1-ultra")),
+            lambda backend, token: backend.render("flux-pro-1.1-ultra", json_data, api_key, show_progress, token, receiver),
+            (IMAGE_BACKENDS[0], IMAGE_BACKENDS[1] if hedge else None),
+            lambda result: isinstance(result, Image.Image),
+            cancel_token=cancel_token
+        ),
+        cancel_token,
+        api_key
+    )
+
+def with_webhook(json_data, receiver):
+    """Cuerpo del envío a Flux con la URL de aviso del receptor local (si lo hay)"""
+    if receiver is None:
+        return json_data
+    return dict(json_data, webhook_url=receiver.url, webhook_secret=receiver.secret)
+
+# Agrupación de renders de Flux respetando la cancelación de cada sesión
+def do_flux_request(payload, request_fn, cancel_token=None, credential=""):
+    """
+    Lanza un render de Flux agrupado con los idénticos que ya estén en curso
+    con la misma clave (credential)
+
+    Si el render agrupado lo canceló otra sesión (con su token, no con el
+    nuestro) o venció su plazo, se repite: una cancelación ajena no debe
+    llegar aquí.
+    """
+    coalescer = get_request_coalescer()
+    result = coalescer.do("flux", payload, request_fn, credential, cancel_token)
+    if result in STOP_MESSAGES and not (cancel_token and cancel_token.cancelled):
+        result = coalescer.do("flux", payload, request_fn, credential, cancel_token)
+    return result
+
+# Función para procesar respuesta de Flux (basada en el archivo de referencia)
+def process_flux_response(response, api_key, show_progress=True, cancel_token=None, webhook_receiver=None, base_url=BFL_API_URL):
+    """
+    Procesa la respuesta de Flux y hace polling hasta obtener la imagen
+
+    Con show_progress=False no se usa la interfaz de Streamlit, lo que permite
+    llamarla desde hilos de trabajo (renderizado concurrente de escenas).
+    Con cancel_token, al cancelar (o vencer su plazo) se deja de consultar en
+    el acto y se devuelve su stop_message; cada consulta y la descarga llevan
+    timeouts recortados a ese plazo.
+    Con webhook_receiver (el render se envió con webhook_url) se espera el
+    aviso de BFL; si no llega en FLUX_WEBHOOK_TIMEOUT segundos se vuelve al
+    polling de siempre. base_url es la del backend al que se envió el render.
+    """
+    if response.status_code != 200:
+        return f"Error: {response.status_code} {response.text}"
+
+    request = response.json()
+    request_id = request.get("id")
+    if not request_id:
+        return "No se pudo obtener el ID de la solicitud."
+
+    if webhook_receiver is not None:
+        with st.spinner('Generando imagen con Flux...') if show_progress else contextlib.nullcontext():
+            notification = webhook_receiver.wait(request_id, FLUX_WEBHOOK_TIMEOUT, cancel_token)
+        if notification in STOP_MESSAGES:
+            return notification
+        if notification is not None:
+            status = notification.get("status")
+            if status in ("Ready", "SUCCESS"):
+                return fetch_flux_sample(notification.get("result") or {}, cancel_token)
+            if status in ("Failed", "FAILED", "Error", "Content Moderated", "Request Moderated"):
+                return "La generación de la imagen falló."
+        # Sin aviso (o con un estado desconocido): consultar como siempre
+
+    with st.spinner('Generando imagen con Flux...') if show_progress else contextlib.nullcontext():
+        max_attempts = max(1, int(300 / FLUX_POLL_INTERVAL))  # 5 minutos máximo
+        for attempt in range(max_attempts):
+            # Esperar entre consultas (5 segundos por defecto); cancelar despierta la espera
+            if cancel_token:
+                if cancel_token.wait(FLUX_POLL_INTERVAL):
+                    return cancel_token.stop_message
+            else:
+                time.sleep(FLUX_POLL_INTERVAL)
+
+            result_response = requests.get(
+                f'{base_url}/v1/get_result',
+                headers={
+                    'accept': 'application/json',
+                    'x-key': api_key,
+                },
+                params={
+                    'id': request_id,
+                },
+                timeout=http_timeout(cancel_token, FLUX_POLL_TIMEOUT),
+            )
+            
+            if result_response.status_code != 200:
+                return f"Error: {result_response.status_code} {result_response.text}"
+            
+            result = result_response.json()
+            status = result.get("status")
+            
+            if status == "Ready":
+                return fetch_flux_sample(result['result'], cancel_token)
+                
+            elif status == "Failed":
+                return "La generación de la imagen falló."
+            elif status == "Pending":
+                # Mostrar progreso
+                if show_progress:
+                    st.info(f"Procesando... Intento {attempt + 1}/{max_attempts}")
+            else:
+                return f"Estado inesperado: {status}"
+        
+        return "Timeout: La generación tomó demasiado tiempo."
+
+def fetch_flux_sample(result, cancel_token=None):
+    """Descarga la imagen de un resultado "Ready" de Flux (del polling o de un webhook)"""
+    image_url = result.get('sample')
+    if not image_url:
+        return "No se encontró URL de imagen en el resultado."
+    
+    image_response = requests.get(image_url, timeout=http_timeout(cancel_token, FLUX_DOWNLOAD_TIMEOUT))
+    if image_response.status_code != 200:
+        return f"Error al obtener la imagen: {image_response.status_code}"
+    
+    image = Image.open(BytesIO(image_response.content))
+    jpg_image = image.convert("RGB")
+    return jpg_image
+# Función principal para generar imagen con Flux (MEJORADA CON SOPORTE PARA SECUENCIAS)
+def generate_image_flux(text_content: str, content_type: str, api_key: str, model: str, width: int, height: int, steps: int, style: str = "photorealistic", custom_prompt: str = None, claude_api_key: str = None, claude_model: str = None, character_seed: int = None, fast_prompt: bool = False, timings: Optional[Dict[str, float]] = None, ledger: Optional[TokenLedger] = None, cancel_token: Optional[CancellationToken] = None, reuse_threshold: Optional[float] = None, reuse_info: Optional[Dict[str, Any]] = None, webhook: bool = False, hedge: bool = False) -> tuple[Optional[Image.Image], str, str]:
+    """
+    Genera imagen usando Flux con prompt inteligente generado por Claude
+
+    Con fast_prompt el prompt se construye localmente (sin llamada a Claude)
+    y Flux arranca de inmediato (si el texto no tiene ningún sustantivo del
+    léxico visual, el prompt se pide a Claude igualmente). Si se pasa
+    timings, se guarda en timings["prompt"] el tiempo de construcción del
+    prompt. No llama a Streamlit directamente (los mensajes van a ui()), así
+    que puede correr dentro de una GenerationTask.
+    Con reuse_threshold, si el índice local tiene una imagen de la misma
+    clave de Flux, estilo, modelo, pasos y tamaño con un prompt parecido, se
+    ofrece al usuario (offer_image_reuse); si la acepta se devuelve esa sin
+    llamar a Flux, y su entrada (con la similitud) se copia en reuse_info.
+
+    Returns:
+        (imagen o None, prompt final, origen del prompt: "personalizado",
+        "local", "inteligente" o "básico")
+    """
+    try:
+        prompt_start = time.perf_counter()
+        use_custom = bool(custom_prompt and custom_prompt.strip())
+        local_prompt = build_local_visual_prompt(text_content, content_type, style) if fast_prompt and not use_custom else None
+        # Determinar qué prompt usar
+        if use_custom:
+            # Usar el prompt personalizado del usuario (ya en inglés)
+            visual_prompt = custom_prompt.strip()
+            final_prompt = optimize_prompt_for_flux(visual_prompt, style)
+            ui().info(f"🎨 Usando prompt personalizado para la imagen")
+            prompt_source = "personalizado"
+        elif local_prompt:
+            visual_prompt = local_prompt
+            final_prompt = optimize_prompt_for_flux(visual_prompt, style)
+            ui().info(f"⚡ Prompt visual construido localmente en {(time.perf_counter() - prompt_start) * 1000:.1f} ms")
+            prompt_source = "local"
+        else:
+            # Generar prompt automáticamente usando Claude
+            if fast_prompt:
+                ui().info("⚡ El texto no tiene elementos visuales reconocibles: el prompt lo genera Claude")
+            ui().info(f"🤖 Analizando contenido con Claude para generar prompt visual...")
+            
+            if not claude_api_key:
+                # Fallback al método anterior si no hay API de Claude
+                content_preview = ' '.join(text_content.split()[:80])
+                visual_prompt = f"A realistic scene representing: {content_preview}. Real world setting, natural environment, authentic details"
+                ui().warning("⚠️ Usando método básico (falta Claude API key para análisis inteligente)")
+                prompt_source = "básico"
+            else:
+                # Usar Claude para generar prompt inteligente
+                visual_prompt = generate_visual_prompt_with_claude(
+                    text_content, content_type, style, claude_api_key, claude_model, ledger, cancel_token
+                )
+                
+                if visual_prompt:
+                    record_render_sample("visual_prompt", time.perf_counter() - prompt_start, model=claude_model)
+                    ui().success(f"✅ Claude analizó el {content_type} y generó prompt visual optimizado")
+                    prompt_source = "inteligente"
+                else:
+                    # Fallback si Claude falla
+                    content_preview = ' '.join(text_content.split()[:80])
+                    visual_prompt = f"A realistic scene representing: {content_preview}. Real world setting, natural environment, authentic details"
+                    ui().warning("⚠️ Usando método básico (error en análisis de Claude)")
+                    prompt_source = "básico"
+            
+            final_prompt = optimize_prompt_for_flux(visual_prompt, style)
+        
+        if timings is not None:
+            timings["prompt"] = time.perf_counter() - prompt_start
+        
+        reusable = find_reusable_image(final_prompt, style, model, steps, width, height, reuse_threshold, api_key)
+        if reusable and offer_image_reuse(
+            f"♻️ Hay una imagen parecida de una generación anterior (similitud {reusable[2]['similarity']:.0%}): "
+            "¿usarla en lugar de renderizar una nueva?",
+            [(reusable[0], reuse_summary(reusable[2]))]
+        ):
+            image, _, match = reusable
+            if reuse_info is not None:
+                reuse_info.update(match)
+            ui().info(reuse_summary(match))
+            return image, final_prompt, prompt_source
+        
+        # Generar imagen según el modelo con seed opcional (el prompt usado se
+        # muestra junto a la imagen en los resultados)
+        render_start = time.perf_counter()
+        if model == "flux-pro-1.1-ultra":
+            # Usar Ultra con aspect ratio
+            aspect_ratio = f"{width}:{height}" if width == height else "16:9"
+            result = generate_image_flux_ultra(final_prompt, aspect_ratio, api_key, character_seed,
+                                               show_progress=False, cancel_token=cancel_token, webhook=webhook, hedge=hedge)
+        else:
+            # Usar Pro normal
+            result = generate_image_flux_pro(final_prompt, width, height, steps, api_key, character_seed, style,
+                                             show_progress=False, cancel_token=cancel_token, webhook=webhook, hedge=hedge)
+        
+        if isinstance(result, Image.Image):
+            record_render_sample("image", time.perf_counter() - render_start, model=model, steps=steps, width=width, height=height)
+            return result, final_prompt, prompt_source
+        else:
+            if result not in STOP_MESSAGES:
+                ui().error(f"Error en Flux: {result}")
+            return None, final_prompt, prompt_source
+            
+    except Exception as e:
+        ui().error(f"Error en la generación de imagen con Flux: {str(e)}")
+        import traceback
+        ui().error(f"Traceback: {traceback.format_exc()}")
+        return None, "", ""
+
+# Renderizar una escena sin interfaz (apto para hilos de trabajo)
+def render_scene_image(scene_prompt: str, seed: int, flux_config: Dict[str, Any]):
+    """
+    Renderiza una escena con Flux sin llamar a Streamlit y registra su latencia
+
+    Si flux_config["cancel_token"] ya está cancelado (o vencido) no se envía nada a Flux.
+
+    Returns:
+        Imagen PIL o mensaje de error (igual que process_flux_response)
+    """
+    cancel_token = flux_config.get("cancel_token")
+    if cancel_token and cancel_token.cancelled:
+        return cancel_token.stop_message
+    start = time.perf_counter()
+    if flux_config["model"] == "flux-pro-1.1-ultra":
+        aspect_ratio = f"{flux_config['width']}:{flux_config['height']}" if flux_config['width'] == flux_config['height'] else "16:9"
+        result = generate_image_flux_ultra(
+            scene_prompt,
+            aspect_ratio,
+            flux_config["api_key"],
+            seed,
+            show_progress=False,
+            cancel_token=cancel_token,
+            webhook=flux_config.get("webhook", False),
+            hedge=flux_config.get("hedge", False)
+        )
+    else:
+        result = generate_image_flux_pro(
+            scene_prompt,
+            flux_config["width"],
+            flux_config["height"],
+            flux_config["steps"],
+            flux_config["api_key"],
+            seed,
+            flux_config["style"],  # Pasar estilo para guidance ajustado
+            show_progress=False,
+            cancel_token=cancel_token,
+            webhook=flux_config.get("webhook", False),
+            hedge=flux_config.get("hedge", False)
+        )
+
+    if isinstance(result, Image.Image):
+        record_render_sample(
+            "image",
+            time.perf_counter() - start,
+            model=flux_config["model"],
+            steps=flux_config["steps"],
+            width=flux_config["width"],
+            height=flux_config["height"]
+        )
+    return result
+
+# Parámetros de la pasada de borrador (previsualización rápida)
+DRAFT_STEPS = 8
+DRAFT_MAX_SIDE = 512
+
+def make_draft_flux_config(flux_config: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Deriva la configuración de borrador: pocos pasos y baja resolución
+
+    Mantiene seed, prompt y proporción. Los borradores siempre usan Flux Pro 1.1
+    porque Ultra no permite controlar pasos ni dimensiones.
+    """
+    draft_config = dict(flux_config)
+    longest = max(flux_config["width"], flux_config["height"])
+    scale = min(1.0, DRAFT_MAX_SIDE / longest)
+    draft_config["model"] = "flux-pro-1.1"
+    draft_config["steps"] = min(flux_config["steps"], DRAFT_STEPS)
+    draft_config["width"] = max(256, int(flux_config["width"] * scale) // 32 * 32)
+    draft_config["height"] = max(256, int(flux_config["height"] * scale) // 32 * 32)
+    draft_config["draft"] = True
+    return draft_config
+
+def cards_with_scenes(character_cards: List[Dict[str, Any]], completed: Dict[tuple, Optional[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    """Copia de las tarjetas con las escenas terminadas, en el orden del relato (personaje y escena)"""
+    cards = [dict(card, images=list(card["images"])) for card in character_cards]
+    for (i, j) in sorted(completed):
+        if completed[(i, j)]:
+            cards[i]["images"].append(completed[(i, j)])
+    return cards
+
+# NUEVA FUNCIÓN: Generar secuencia de imágenes con personajes consistentes
+def generate_character_sequence(character_analysis: Dict[str, Any], flux_config: Dict[str, Any], task: "GenerationTask", profiler: Optional["MemoryProfiler"] = None, storyboard: Optional["StoryboardWriter"] = None, progress_range: tuple = (0.0, 1.0)) -> Dict[str, Any]:
+    """
+    Genera múltiples imágenes con personajes consistentes usando seeds variables por escena
+
+    Corre dentro de una GenerationTask, sin llamar a Streamlit. Las escenas se
+    envían a Flux en paralelo (flux_config["concurrency"] renders simultáneos)
+    en orden de anchura: primero la escena 1 de todos los personajes, luego
+    la 2, etc., para tener cuanto antes una vista previa de cada personaje.
+    Cada escena tiene su hueco en la tarea, que el fragmento de progreso
+    rellena en cuanto termina su render, sea cual sea el orden.
+    Con flux_config["draft"] se hace solo la pasada rápida de borrador.
+
+    Las escenas terminadas se publican en la tarea (character_images) sobre
+    la marcha, para conservarlas si se cancela. Con el token de la tarea
+    cancelado no se lanzan más escenas y las que esperan a Flux paran.
+
+    Con flux_config["reuse_threshold"] las escenas con una imagen parecida en
+    el índice local (con la misma clave de Flux y el modelo, los pasos y el
+    tamaño finales, aunque se pidan borradores) se ofrecen al usuario antes
+    de renderizar; si las acepta se toman de ahí sin llamar a Flux. Los
+    renders finales nuevos se añaden al índice.
+    """
+    final_model, final_steps = flux_config["model"], flux_config["steps"]
+    final_width, final_height = flux_config["width"], flux_config["height"]
+    if flux_config.get("draft"):
+        flux_config = make_draft_flux_config(flux_config)
+    
+    sequence_results = {
+        "success": True,
+        "character_cards": [],
+        "total_images": 0,
+        "errors": []
+    }
+    
+    if flux_config.get("draft"):
+        task.info(f"📝 Generando borradores ({flux_config['steps']} pasos, {flux_config['width']}x{flux_config['height']}px)...")
+    else:
+        task.info("🎭 Iniciando generación de secuencia de personajes...")
+    
+    characters = character_analysis["characters"]
+    total_scenes = sum(len(char["suggested_scenes"]) for char in characters)
+    progress_start, progress_end = progress_range
+    scene_counter = 0
+    sequence_start = time.perf_counter()
+    concurrency = max(1, int(flux_config.get("concurrency", 1)))
+    
+    # Reservar primero el hueco de cada escena de cada personaje
+    scene_jobs: Dict[tuple, Dict[str, Any]] = {}
+    for i, character in enumerate(characters):
+        # Generar seed base para este personaje (sin escena específica)
+        base_character_seed = generate_character_seed(character["name"])
+        
+        sequence_results["character_cards"].append({
+            "name": character["name"],
+            "type": character["type"],
+            "description": character["physical_description"],
+            "seed": base_character_seed,  # Seed base para referencia
+            "images": []
+        })
+        
+        for j, scene in enumerate(character["suggested_scenes"]):
+            # Generar seed específico para esta escena CON offset de estilo
+            character_seed = generate_character_seed(
+                character["name"],
+                scene["action"],
+                j,  # scene_index
+                flux_config["style"]  # Pasar el estilo para aplicar offset
+            )
+            
+            # Crear prompt específico para esta escena
+            scene_prompt = create_character_prompt(character, scene, flux_config["style"])
+            scene_jobs[(i, j)] = {"scene": scene, "seed": character_seed, "prompt": scene_prompt}
+            task.add_scene((i, j), f"{character['name']} - {scene['action']}", character_seed)
+    
+    # Orden de anchura: índice de escena primero, personaje después
+    schedule = sorted(scene_jobs, key=lambda key: (key[1], key[0]))
+    completed: Dict[tuple, Dict[str, Any]] = {}
+    storyboard_cursor = 0
+    
+    def flush_storyboard():
+        # Storyboard en el mismo orden de anchura, a medida que se completa cada tramo
+        nonlocal storyboard_cursor
+        while storyboard and storyboard_cursor < len(schedule) and schedule[storyboard_cursor] in completed:
+            key = schedule[storyboard_cursor]
+            if completed[key]:
+                storyboard.add_scene(completed[key]["image_obj"], f"{characters[key[0]]['name']} - {completed[key]['scene']}")
+            storyboard_cursor += 1
+    
+    # Escenas que ya existen en el índice de imágenes: se ofrecen todas a la
+    # vez y, si el usuario las acepta, no se envían a Flux
+    reuse_threshold = flux_config.get("reuse_threshold")
+    reusable_scenes = {}
+    for key in schedule if reuse_threshold is not None else []:
+        reusable = find_reusable_image(scene_jobs[key]["prompt"], flux_config["style"], final_model, final_steps,
+                                       final_width, final_height, reuse_threshold, flux_config["api_key"])
+        if reusable:
+            reusable_scenes[key] = reusable
+    if reusable_scenes and not task.offer_reuse(
+        f"♻️ {len(reusable_scenes)} escenas tienen una imagen parecida de una generación anterior: "
+        "¿usarlas en lugar de renderizarlas?",
+        [(image, f"{characters[key[0]]['name']} • similitud {match['similarity']:.0%}")
+         for key, (image, _, match) in reusable_scenes.items()]
+    ):
+        reusable_scenes = {}
+    for key, (image, image_bytes, match) in reusable_scenes.items():
+        job = scene_jobs[key]
+        completed[key] = {
+            "scene": job["scene"]["action"],
+            "prompt": job["prompt"],
+            "seed": job["seed"],
+            "image_bytes": image_bytes,
+            "image_obj": image,
+            "timestamp": int(time.time()),
+            "character_name": characters[key[0]]["name"],
+            "is_draft": False,
+            "reused": match
+        }
+        sequence_results["total_images"] += 1
+        scene_counter += 1
+        task.scene_done(key, image)
+    if completed:
+        task.info(f"♻️ {len(completed)} escenas reutilizadas del índice de imágenes")
+        flush_storyboard()
+        task.publish(character_images=cards_with_scenes(sequence_results["character_cards"], completed))
+        task.set_progress(progress_start + (progress_end - progress_start) * scene_counter / total_scenes)
+    
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    try:
+        futures = {
+            executor.submit(render_scene_image, scene_jobs[key]["prompt"], scene_jobs[key]["seed"], flux_config): key
+            for key in schedule
+            if key not in completed
+        }
+        
+        for future in as_completed(futures):
+            i, j = futures[future]
+            character = characters[i]
+            job = scene_jobs[(i, j)]
+            scene = job["scene"]
+            try:
+                image_result = future.result()
+                
+                if isinstance(image_result, Image.Image):
+                    # Guardar imagen como PNG para la sesión
+                    img_buffer = io.BytesIO()
+                    image_result.save(img_buffer, format="PNG", quality=95)
+                    img_bytes = img_buffer.getvalue()
+                    
+                    # Metadata de la imagen
+                    completed[(i, j)] = {
+                        "scene": scene["action"],
+                        "prompt": job["prompt"],
+                        "seed": job["seed"],  # Usar el seed específico de la escena
+                        "image_bytes": img_bytes,
+                        "image_obj": image_result,
+                        "timestamp": int(time.time()),
+                        "character_name": character["name"],
+                        "is_draft": bool(flux_config.get("draft"))
+                    }
+                    sequence_results["total_images"] += 1
+                    task.scene_done((i, j), image_result)
+                    if not flux_config.get("draft"):
+                        index_rendered_image(
+                            img_bytes, job["prompt"], flux_config["style"], job["seed"], flux_config["model"],
+                            flux_config["steps"], flux_config["width"], flux_config["height"], flux_config["api_key"], kind="scene",
+                            character_name=character["name"], scene=scene["action"],
+                            user_prompt=flux_config.get("user_prompt", "")
+                        )
+                
+                elif image_result in STOP_MESSAGES:
+                    task.scene_failed((i, j), image_result, cancelled=True)
+                    completed[(i, j)] = None
+                
+                else:
+                    error_msg = f"Error generando imagen para {character['name']} - {scene['action']}: {image_result}"
+                    task.scene_failed((i, j), error_msg)
+                    sequence_results["errors"].append(error_msg)
+                    completed[(i, j)] = None
+                    
+            except Exception as e:
+                error_msg = f"Excepción generando imagen para {character['name']} - {scene['action']}: {str(e)}"
+                task.scene_failed((i, j), error_msg)
+                sequence_results["errors"].append(error_msg)
+                completed[(i, j)] = None
+            
+            flush_storyboard()
+            
+            # Publicar lo terminado hasta ahora: es lo que se conserva si se cancela
+            task.publish(character_images=cards_with_scenes(sequence_results["character_cards"], completed))
+            
+            scene_counter += 1
+            task.set_progress(progress_start + (progress_end - progress_start) * scene_counter / total_scenes)
+            if profiler:
+                profiler.checkpoint(f"escena: {character['name']} - {scene['action']}")
+    finally:
+        # Si algo falla, las escenas en cola se descartan sin esperar a Flux
+        executor.shutdown(wait=False, cancel_futures=True)
+    
+    # Tarjetas en el orden del relato (personaje y escena)
+    sequence_results["character_cards"] = cards_with_scenes(sequence_results["character_cards"], completed)
+    
+    sequence_results["elapsed_seconds"] = time.perf_counter() - sequence_start
+    if storyboard:
+        sequence_results["storyboard"] = storyboard.close()
+    
+    stopped = bool(flux_config.get("cancel_token") and flux_config["cancel_token"].cancelled)
+    if sequence_results["total_images"] > 0:
+        task.success(f"🎉 Secuencia completada: {sequence_results['total_images']} imágenes generadas")
+        if not stopped:
+            record_render_sample("sequence", sequence_results["elapsed_seconds"], characters=len(characters))
+    elif not stopped:
+        task.error("❌ No se pudo generar ninguna imagen de la secuencia")
+        sequence_results["success"] = False
+    else:
+        sequence_results["success"] = False
+    
+    return sequence_results
+
+# Segunda pasada: renderizar a calidad completa solo los borradores aprobados
+def render_final_scenes(character_cards: List[Dict[str, Any]], approved: List[tuple], flux_config: Dict[str, Any], task: "GenerationTask") -> Dict[str, Any]:
+    """
+    Renderiza a calidad completa los borradores aprobados y los sustituye en su sitio
+
+    Corre dentro de una GenerationTask: trabaja sobre una copia de las
+    tarjetas y la publica en la tarea tras cada escena, así que las ya
+    terminadas se conservan aunque se cancele.
+
+    Args:
+        character_cards: Tarjetas de personaje con sus imágenes (no se modifican)
+        approved: Lista de (índice_personaje, índice_imagen) aprobados
+        flux_config: Configuración completa de Flux (sin "draft")
+
+    Returns:
+        Diccionario con las tarjetas actualizadas, el número de imágenes finales y los errores
+    """
+    cards = [dict(card, images=[dict(image_data) for image_data in card["images"]]) for card in character_cards]
+    results = {"character_cards": cards, "rendered": 0, "errors": []}
+    if not approved:
+        return results
+    
+    concurrency = max(1, int(flux_config.get("concurrency", 1)))
+    for i, j in approved:
+        image_data = cards[i]["images"][j]
+        task.add_scene((i, j), f"{image_data['character_name']} - {image_data['scene']}", image_data["seed"])
+    
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    try:
+        futures = {
+            executor.submit(
+                render_scene_image,
+                cards[i]["images"][j]["prompt"],
+                cards[i]["images"][j]["seed"],  # Mismo seed que el borrador
+                flux_config
+            ): (i, j)
+            for i, j in approved
+        }
+        
+        for done, future in enumerate(as_completed(futures), start=1):
+            i, j = futures[future]
+            image_data = cards[i]["images"][j]
+            try:
+                image_result = future.result()
+                if isinstance(image_result, Image.Image):
+                    img_buffer = io.BytesIO()
+                    image_result.save(img_buffer, format="PNG", quality=95)
+                    image_data["image_bytes"] = img_buffer.getvalue()
+                    image_data["image_obj"] = image_result
+                    image_data["timestamp"] = int(time.time())
+                    image_data["is_draft"] = False
+                    image_data.pop("reused", None)
+                    results["rendered"] += 1
+                    task.scene_done((i, j), image_result)
+                    index_rendered_image(
+                        image_data["image_bytes"], image_data["prompt"], flux_config["style"], image_data["seed"],
+                        flux_config["model"], flux_config["steps"], flux_config["width"], flux_config["height"],
+                        flux_config["api_key"], kind="scene",
+                        character_name=image_data["character_name"], scene=image_data["scene"],
+                        user_prompt=flux_config.get("user_prompt", "")
+                    )
+                elif image_result in STOP_MESSAGES:
+                    task.scene_failed((i, j), image_result, cancelled=True)
+                else:
+                    error_msg = f"Error en la versión final de {image_data['character_name']} - {image_data['scene']}: {image_result}"
+                    results["errors"].append(error_msg)
+                    task.scene_failed((i, j), error_msg)
+            except Exception as e:
+                error_msg = f"Excepción en la versión final de {image_data['character_name']} - {image_data['scene']}: {str(e)}"
+                results["errors"].append(error_msg)
+                task.scene_failed((i, j), error_msg)
+            task.publish(character_images=cards)
+            task.set_progress(done / len(futures))
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    
+    return results
+
+# Función para generar audio con OpenAI TTS (mantenemos la misma)
+def request_speech(text: str, voice: str, api_key: str, hedge: bool = False,
+                   cancel_token: Optional[CancellationToken] = None,
+                   sentence_cache: bool = False, latency_kind: str = "speech") -> tuple[Optional[bytes], Optional[str]]:
+    """
+    Pide el audio a OpenAI Text-to-Speech sin tocar la interfaz (apto para hilos)
+
+    Con hedge, si tarda más que el p90 (por cada mil caracteres) se duplica
+    en el backend de voz de respaldo. Con sentence_cache se narra frase a
+    frase reutilizando las ya sintetizadas (ver request_sentence_speech).
+    latency_kind separa las latencias de las frases sueltas ("speech-sentence")
+    de las de narraciones completas: cada tipo tiene su propio p90.
+
+    Returns:
+        (bytes MP3 o None, mensaje de error o None)
+    """
+    if sentence_cache:
+        audio, error, _ = request_sentence_speech(text, voice, api_key, hedge, cancel_token)
+        return audio, error
+    try:
+        # Limpiar y preparar el texto para TTS
+        clean_text = text.replace('\n\n', '. ').replace('\n', ' ').strip()
+        if len(clean_text) > 4000:
+            clean_text = clean_text[:4000] + "..."
+        
+        data = {
+            "model": TTS_MODEL,
+            "input": clean_text,
+            "voice": voice,
+            "response_format": "mp3"
+        }
+        
+        return hedged_call(
+            "voz",
+            (latency_kind, ("model", data["model"])),
+            lambda backend, token: backend.synthesize(data, api_key, token),
+            (SPEECH_BACKENDS[0], SPEECH_BACKENDS[1] if hedge else None),
+            lambda result: result[0] is not None,
+            scale=max(1.0, len(clean_text) / 1000),
+            cancel_token=cancel_token
+        )
+            
+    except Exception as e:
+        if cancel_token and cancel_token.cancelled:
+            return None, cancel_token.stop_message
+        return None, f"Error en la generación de audio: {str(e)}"
+
+
+def generate_audio(text: str, voice: str, api_key: str, hedge: bool = False,
+                   cancel_token: Optional[CancellationToken] = None, sentence_cache: bool = False) -> Optional[bytes]:
+    """Genera audio usando OpenAI Text-to-Speech"""
+    audio, error = request_speech(text, voice, api_key, hedge, cancel_token, sentence_cache)
+    if error and error not in STOP_MESSAGES:
+        ui().error(error)
+    return audio
+
+# ===============================
+# CACHÉ DE FRASES NARRADAS (TTS INCREMENTAL)
+# ===============================
+
+TTS_MODEL = "tts-1-hd"  # Modelo HD para mejor calidad
+# Caché local de frases ya sintetizadas (compartida entre sesiones)
+TTS_CACHE_DIR = os.environ.get(
+    "TTS_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".tts_cache")
+)
+TTS_CACHE_MAX_SEGMENTS = 5000
+# Al llenarse se vacía de una vez hasta esta fracción (no en cada frase nueva)
+TTS_CACHE_LOW_WATER = 0.9
+# Frases que se sintetizan a la vez como máximo
+TTS_SEGMENT_CONCURRENCY = 8
+# Mismo límite de texto que la narración en una sola solicitud
+TTS_MAX_CHARS = 4000
+
+
+def strip_id3(mp3: bytes) -> bytes:
+    """Quita la etiqueta ID3v2 inicial y la ID3v1 final: deja solo las tramas MPEG"""
+    if mp3[:3] == b"ID3" and len(mp3) >= 10:
+        # Tamaño "syncsafe" (7 bits por byte) + cabecera, y pie si el flag lo indica
+        size = (mp3[6] << 21) | (mp3[7] << 14) | (mp3[8] << 7) | mp3[9]
+        mp3 = mp3[10 + size + (10 if mp3[5] & 0x10 else 0):]
+    if len(mp3) >= 128 and mp3[-128:-125] == b"TAG":
+        mp3 = mp3[:-128]
+    return mp3
+
+
+# Bitrates (kbps) de la capa III por índice: MPEG-1 y MPEG-2/2.5
+MP3_BITRATES = {
+    "1": [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    "2": [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160]
+}
+# Frecuencias de muestreo por bits de versión (3: MPEG-1, 2: MPEG-2, 0: MPEG-2.5)
+MP3_SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+
+
+def mp3_frame_length(frame: bytes) -> Optional[int]:
+    """Bytes de la trama MPEG capa III que empieza en frame (None si no hay cabecera válida)"""
+    if len(frame) < 4 or frame[0] != 0xFF or frame[1] & 0xE0 != 0xE0 or (frame[1] >> 1) & 3 != 1:
+        return None
+    version = (frame[1] >> 3) & 3
+    bitrate_index, rate_index = frame[2] >> 4, (frame[2] >> 2) & 3
+    if version == 1 or not 0 < bitrate_index < 15 or rate_index == 3:
+        return None
+    bitrate = MP3_BITRATES["1" if version == 3 else "2"][bitrate_index] * 1000
+    return (144 if version == 3 else 72) * bitrate // MP3_SAMPLE_RATES[version][rate_index] + ((frame[2] >> 1) & 1)
+
+
+def strip_vbr_header(mp3: bytes) -> bytes:
+    """
+    Quita la trama Xing/Info (o VBRI) inicial: describe la duración y el
+    número de tramas de su segmento, no las del archivo unido
+    """
+    frame_length = mp3_frame_length(mp3)
+    if not frame_length:
+        return mp3
+    version, mono = (mp3[1] >> 3) & 3, (mp3[3] >> 6) & 3 == 3
+    side_info = (17 if mono else 32) if version == 3 else (9 if mono else 17)
+    if mp3[4 + side_info:8 + side_info] in (b"Xing", b"Info") or mp3[36:40] == b"VBRI":
+        return mp3[frame_length:]
+    return mp3
+
+
+def join_mp3_segments(segments: List[bytes]) -> bytes:
+    """
+    Une MP3 del mismo codificador sin recodificar
+
+    Las tramas MPEG son independientes, así que basta concatenarlas; las
+    etiquetas ID3 de cada segmento sobran (en medio del flujo, los
+    reproductores las interpretan como ruido o cortes), y también la trama
+    Xing/Info de cada uno: con ella los reproductores toman la duración del
+    primer segmento por la de todo el archivo.
+    """
+    if len(segments) == 1:
+        return segments[0]
+    return b"".join(strip_vbr_header(strip_id3(segment)) for segment in segments)
+
+
+def normalize_sentence(sentence: str) -> str:
+    """Forma canónica de una frase para la caché: Unicode NFC y espacios simples"""
+    return " ".join(unicodedata.normalize("NFC", sentence).split())
+
+
+def split_sentences(text: str, max_chars: int = TTS_MAX_CHARS) -> List[str]:
+    """
+    Frases de un texto en orden (cada línea se corta tras . ! ? o …)
+
+    Se detiene al llegar a max_chars en total, como la narración de una sola
+    solicitud.
+    """
+    sentences, total = [], 0
+    for line in text.splitlines():
+        for sentence in re.split(r"(?<=[.!?…])\s+", line):
+            sentence = normalize_sentence(sentence)
+            if not sentence:
+                continue
+            if total + len(sentence) > max_chars:
+                return sentences
+            sentences.append(sentence)
+            total += len(sentence)
+    return sentences
+
+
+class TtsSegmentCache:
+    """
+    Caché en disco de frases narradas, direccionada por contenido
+
+    La clave es el hash de (modelo, voz, frase normalizada): la misma frase
+    con la misma voz es el mismo MP3 venga de donde venga (otra generación,
+    otra sesión, un texto editado). El orden de uso se lleva en memoria (un
+    LRU que se carga del disco una vez, por fecha de archivo; cada acierto
+    la renueva para el próximo arranque). Al pasar de TTS_CACHE_MAX_SEGMENTS
+    se borran de una vez las menos usadas hasta TTS_CACHE_LOW_WATER, y el
+    borrado en disco se hace fuera del lock.
+    """
+
+    def __init__(self, directory: str, max_segments: int = TTS_CACHE_MAX_SEGMENTS):
+        self.directory = directory
+        self.max_segments = max_segments
+        self._lock = threading.Lock()
+        self._lru: Optional["OrderedDict[str, None]"] = None
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(model: str, voice: str, sentence: str) -> str:
+        return hashlib.sha256(f"{model}\0{voice}\0{normalize_sentence(sentence)}".encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.mp3")
+
+    def _files(self) -> List[str]:
+        return [
+            os.path.join(root, name)
+            for root, _, names in os.walk(self.directory)
+            for name in names if name.endswith(".mp3")
+        ]
+
+    def _loaded_lru(self) -> "OrderedDict[str, None]":
+        # Con el lock tomado; solo la primera vez recorre el directorio
+        if self._lru is None:
+            files = []
+            for name in self._files():
+                with contextlib.suppress(OSError):
+                    files.append((os.path.getmtime(name), os.path.basename(name)[:-len(".mp3")]))
+            self._lru = OrderedDict((key, None) for _, key in sorted(files))
+        return self._lru
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            with contextlib.suppress(OSError):
+                os.utime(path)
+        except OSError:
+            data = None
+        with self._lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                lru = self._loaded_lru()
+                lru[key] = None
+                lru.move_to_end(key)
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            # La caché es una ayuda: nunca debe romper la narración
+            return
+        evicted = []
+        with self._lock:
+            lru = self._loaded_lru()
+            lru[key] = None
+            lru.move_to_end(key)
+            if len(lru) > self.max_segments:
+                low_water = int(self.max_segments * TTS_CACHE_LOW_WATER)
+                while len(lru) > low_water:
+                    evicted.append(lru.popitem(last=False)[0])
+        for old_key in evicted:
+            with contextlib.suppress(OSError):
+                os.remove(self._path(old_key))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"segments": len(self._loaded_lru()), "hits": self.hits, "misses": self.misses}
+
+
+@st.cache_resource
+def get_tts_cache() -> TtsSegmentCache:
+    """Caché compartida por todas las sesiones del proceso"""
+    return TtsSegmentCache(TTS_CACHE_DIR)
+
+
+def request_sentence_speech(text: str, voice: str, api_key: str, hedge: bool = False,
+                            cancel_token: Optional[CancellationToken] = None) -> tuple[Optional[bytes], Optional[str], Dict[str, int]]:
+    """
+    Narración frase a frase: solo van a la API las frases que no están en la caché
+
+    Las que faltan se sintetizan a la vez y el MP3 final se monta con las
+    guardadas y las nuevas en el orden del texto (join_mp3_segments).
+
+    Returns:
+        (bytes MP3 o None, mensaje de error o None, {"sentences", "cached"})
+    """
+    return request_voiced_sentence_speech([(voice, text)], api_key, hedge, cancel_token)
+
+
+def request_voiced_sentence_speech(parts: List[tuple], api_key: str, hedge: bool = False,
+                                   cancel_token: Optional[CancellationToken] = None) -> tuple[Optional[bytes], Optional[str], Dict[str, int]]:
+    """
+    Como request_sentence_speech, pero con una voz por fragmento (voz, texto)
+
+    Las frases de todos los fragmentos comparten un solo grupo de
+    TTS_SEGMENT_CONCURRENCY hilos: un diálogo largo no multiplica las
+    solicitudes simultáneas contra la misma clave. Si una frase falla, las
+    pendientes no se envían, pero las que ya estaban en curso se esperan y
+    se guardan en la caché antes de devolver el error.
+    """
+    voiced = [(voice, sentence) for voice, text in parts for sentence in split_sentences(text)]
+    info = {"sentences": len(voiced), "cached": 0}
+    if not voiced:
+        return None, "No hay texto que narrar.", info
+    cache = get_tts_cache()
+    keys = [TtsSegmentCache.key(TTS_MODEL, voice, sentence) for voice, sentence in voiced]
+    segments = {}
+    for key in dict.fromkeys(keys):
+        data = cache.get(key)
+        if data is not None:
+            segments[key] = data
+    info["cached"] = sum(1 for key in keys if key in segments)
+    
+    missing = {key: voiced_sentence for key, voiced_sentence in zip(keys, voiced) if key not in segments}
+    if missing:
+        executor = ThreadPoolExecutor(max_workers=min(len(missing), TTS_SEGMENT_CONCURRENCY))
+        try:
+            futures = {
+                executor.submit(request_speech, sentence, voice, api_key, hedge, cancel_token,
+                                latency_kind="speech-sentence"): key
+                for key, (voice, sentence) in missing.items()
+            }
+            first_error = None
+            for future in as_completed(futures):
+                if future.cancelled():
+                    continue
+                audio, error = future.result()
+                if error:
+                    if first_error is None:
+                        # No se envían más frases, pero las que ya están en
+                        # curso se pagan igual: se esperan y se guardan
+                        first_error = error
+                        for pending in futures:
+                            pending.cancel()
+                    continue
+                segments[futures[future]] = audio
+                cache.put(futures[future], audio)
+            if first_error is not None:
+                return None, first_error, info
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+    return join_mp3_segments([segments[key] for key in keys]), None, info
+
+# ===============================
+# AUDIO DE DIÁLOGOS A VARIAS VOCES
+# ===============================
+
+# "Nombre: frase" (también "- Nombre:" y "**Nombre:**"); el nombre, de una a
+# tres palabras que empiezan en mayúscula
+DIALOGUE_TURN_PATTERN = re.compile(
+    r"^\s*(?:[-–—•]\s*)?([A-ZÁÉÍÓÚÑ][\wáéíóúñü.'-]*(?:\s+[A-ZÁÉÍÓÚÑ][\wáéíóúñü.'-]*){0,2})\s*:\s*(\S.*)$"
+)
+# Turnos que se sintetizan a la vez como máximo
+DIALOGUE_TTS_CONCURRENCY = 8
+
+
+def parse_dialogue_turns(text: str) -> tuple[List[tuple], List[str]]:
+    """
+    Divide un diálogo en segmentos (interlocutor o None, texto) en orden
+
+    Solo cuenta como interlocutor quien tiene al menos dos turnos: así las
+    líneas "Expresión: explicación" de la lista de expresiones clave no se
+    confunden con personajes. Todo lo demás (título, acotaciones, la lista)
+    son segmentos de narración (None), unidos mientras sean consecutivos.
+
+    Returns:
+        (segmentos, interlocutores en orden de aparición)
+    """
+    lines = [line.replace("**", "").strip() for line in text.splitlines()]
+    matches = [DIALOGUE_TURN_PATTERN.match(line) for line in lines]
+    turn_counts: Dict[str, int] = {}
+    for match in matches:
+        if match:
+            turn_counts[match.group(1)] = turn_counts.get(match.group(1), 0) + 1
+    speakers = [name for name in dict.fromkeys(m.group(1) for m in matches if m) if turn_counts[name] >= 2]
+    
+    segments: List[tuple] = []
+    for line, match in zip(lines, matches):
+        if not line:
+            continue
+        if match and match.group(1) in speakers:
+            segments.append((match.group(1), match.group(2).strip()))
+        elif segments and segments[-1][0] is None:
+            segments[-1] = (None, f"{segments[-1][1]}\n{line}")
+        else:
+            segments.append((None, line))
+    return segments, speakers
+
+
+def assign_dialogue_voices(speakers: List[str], narrator_voice: str) -> Dict[str, str]:
+    """Una voz distinta de la del narrador para cada interlocutor (se repiten si hay más de cinco)"""
+    available = [voice for voice in TTS_VOICES if voice != narrator_voice] or [narrator_voice]
+    return {speaker: available[index % len(available)] for index, speaker in enumerate(speakers)}
+
+
+def request_dialogue_speech(text: str, narrator_voice: str, api_key: str, hedge: bool = False,
+                            cancel_token: Optional[CancellationToken] = None,
+                            sentence_cache: bool = False) -> tuple[Optional[bytes], Dict[str, str], Optional[str]]:
+    """
+    Audio de un diálogo con una voz por interlocutor (apto para hilos)
+
+    Cada segmento es una solicitud de TTS y todas corren a la vez: la
+    latencia es la del turno más largo, no la del guion entero. Con
+    sentence_cache, las frases de todos los turnos van a un único grupo de
+    hilos (request_voiced_sentence_speech) en lugar de abrir uno por turno.
+
+    Returns:
+        (bytes MP3 o None, interlocutor → voz, mensaje de error o None). Sin
+        al menos dos interlocutores devuelve (None, {}, None) y el llamador
+        lee el texto con una sola voz
+    """
+    segments, speakers = parse_dialogue_turns(text)
+    if len(speakers) < 2:
+        return None, {}, None
+    voices = assign_dialogue_voices(speakers, narrator_voice)
+    if sentence_cache:
+        audio, error, _ = request_voiced_sentence_speech(
+            [(voices.get(speaker, narrator_voice), segment_text) for speaker, segment_text in segments],
+            api_key, hedge, cancel_token
+        )
+        return (None, voices, error) if error else (audio, voices, None)
+    
+    executor = ThreadPoolExecutor(max_workers=min(len(segments), DIALOGUE_TTS_CONCURRENCY))
+    try:
+        futures = [
+            executor.submit(request_speech, segment_text, voices.get(speaker, narrator_voice), api_key, hedge, cancel_token)
+            for speaker, segment_text in segments
+        ]
+        audio_segments = []
+        for future in futures:
+            audio, error = future.result()
+            if error:
+                return None, voices, error
+            audio_segments.append(audio)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    return join_mp3_segments(audio_segments), voices, None
+
+
+def generate_dialogue_audio(text: str, narrator_voice: str, api_key: str, hedge: bool = False,
+                            cancel_token: Optional[CancellationToken] = None,
+                            sentence_cache: bool = False) -> tuple[Optional[bytes], Dict[str, str]]:
+    """
+    Genera el audio de un diálogo a varias voces
+
+    Si no se reconocen turnos, o falla algún segmento, se lee entero con la
+    voz del narrador como antes.
+    """
+    audio, voices, error = request_dialogue_speech(text, narrator_voice, api_key, hedge, cancel_token, sentence_cache)
+    if audio:
+        return audio, voices
+    if error in STOP_MESSAGES:
+        return None, {}
+    if error:
+        ui().warning(f"⚠️ Audio a varias voces no disponible ({error}); se usa una sola voz")
+    return generate_audio(text, narrator_voice, api_key, hedge, cancel_token, sentence_cache), {}
+
+# ===============================
+# VARIANTES EN VARIOS IDIOMAS
+# ===============================
+
+# TARGET_LANGUAGES está al principio del script (lo usa la barra lateral)
+
+
+def build_language_adaptation_request(text_content: str, content_type: str, language: str, model: str, max_tokens: int) -> Dict[str, Any]:
+    """Payload de la Messages API para adaptar un contenido ya generado a otro idioma"""
+    language_name = TARGET_LANGUAGES.get(language, language)
+    system_prompt = f"""Eres un traductor y adaptador de materiales didácticos. Adaptas contenidos en español al {language_name} para alumnos de ese idioma.
+
+REGLAS:
+1. Conserva exactamente la estructura, el formato, la extensión y el nivel de dificultad
+2. Adapta expresiones y ejemplos para que suenen naturales en {language_name}, sin traducir palabra por palabra
+3. Mantén los nombres de los personajes y los elementos culturales del original
+4. Responde ÚNICAMENTE con el contenido adaptado, sin comentarios"""
+    return {
+        "model": model,
+        "max_tokens": max_tokens,
+        "temperature": 0.3,
+        "system": system_prompt,
+        "messages": [
+            {"role": "user", "content": f"Adapta este {content_type} al {language_name}:\n\n{text_content}"}
+        ]
+    }
+
+
+def generate_language_variant(text_content: str, content_type: str, language: str, claude_api_key: str, model: str,
+                              max_tokens: int, voice: str, openai_api_key: str, ledger: Optional[TokenLedger] = None,
+                              cancel_token: Optional[CancellationToken] = None, hedge: bool = False,
+                              sentence_cache: bool = False) -> Dict[str, Any]:
+    """
+    Genera una variante en otro idioma: adaptación del texto con Claude y su TTS
+
+    Sin llamadas a Streamlit (se ejecuta en hilos, una variante por idioma).
+    La imagen o la secuencia no se repiten: son comunes a todas las variantes.
+    Con cancel_token cancelado no se lanza la siguiente solicitud (Claude o TTS).
+
+    Returns:
+        Diccionario con language, text, audio, error y seconds
+    """
+    start = time.perf_counter()
+    variant = {"language": language, "text": None, "audio": None, "error": None}
+    try:
+        if cancel_token and cancel_token.cancelled:
+            variant["error"] = cancel_token.stop_message
+        else:
+            data = build_language_adaptation_request(text_content, content_type, language, model, max_tokens)
+            response = post_claude_messages(data, claude_api_key, timeout=120, ledger=ledger, purpose=f"idioma {language}",
+                                            cancel_token=cancel_token)
+            if response.status_code != 200:
+                variant["error"] = f"Error adaptando al {TARGET_LANGUAGES.get(language, language)}: {response.status_code}"
+            else:
+                variant["text"] = response.json()["content"][0]["text"]
+                if cancel_token and cancel_token.cancelled:
+                    variant["error"] = cancel_token.stop_message
+                else:
+                    variant["audio"], variant["error"] = request_speech(variant["text"], voice, openai_api_key, hedge, cancel_token, sentence_cache)
+    except Exception as e:
+        variant["error"] = cancel_token.stop_message if cancel_token and cancel_token.cancelled else f"Error en la variante {language}: {str(e)}"
+    variant["seconds"] = time.perf_counter() - start
+    return variant
+
+# ===============================
+# PERFILADO DE MEMORIA POR ETAPA
+# ===============================
+
+class TracemallocUsers:
+    """
+    Perfiladores activos en el proceso: tracemalloc es global, así que lo
+    arranca el primero y lo para el último (no la sesión que acabe antes)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._users = 0
+        self._started_here = False
+
+    def acquire(self) -> None:
+        with self._lock:
+            if self._users == 0 and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_here = True
+            self._users += 1
+
+    def release(self) -> None:
+        with self._lock:
+            self._users = max(0, self._users - 1)
+            if self._users == 0 and self._started_here:
+                tracemalloc.stop()
+                self._started_here = False
+
+
+@st.cache_resource
+def get_tracemalloc_users() -> TracemallocUsers:
+    """Contador único por proceso, compartido por todas las sesiones"""
+    return TracemallocUsers()
+
+
+class MemoryProfiler:
+    """
+    Perfilador de memoria opcional basado en tracemalloc
+
+    En cada punto de control (fin de etapa) registra el pico desde el punto
+    anterior, la memoria retenida y las líneas que más memoria han sumado.
+    tracemalloc es global al proceso: con varias sesiones a la vez las cifras
+    incluyen también su actividad. Las etapas del pipeline corren en
+    paralelo, así que los puntos de control (protegidos con un lock) miden
+    el intervalo desde el anterior, sea de la etapa que sea: cada cifra
+    acumula todo lo que corría a la vez, no solo la etapa que la nombra.
+    """
+
+    def __init__(self, top_n: int = 5):
+        self.top_n = top_n
+        self.stages: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+        self._tracing = False
+        self._previous_snapshot = None
+        self._previous_current = 0
+
+    def _snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>")
+        ))
+
+    def start(self) -> None:
+        if not self._tracing:
+            get_tracemalloc_users().acquire()
+            self._tracing = True
+        tracemalloc.reset_peak()
+        self._previous_current = tracemalloc.get_traced_memory()[0]
+        self._previous_snapshot = self._snapshot()
+
+    def checkpoint(self, stage: str) -> None:
+        """Cierra una etapa: pico, memoria retenida y principales sitios de asignación"""
+        with self._lock:
+            self._checkpoint(stage)
+
+    def _checkpoint(self, stage: str) -> None:
+        if not tracemalloc.is_tracing() or self._previous_snapshot is None:
+            return
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = self._snapshot()
+        top_stats = snapshot.compare_to(self._previous_snapshot, "lineno")[:self.top_n]
+        self.stages.append({
+            "stage": stage,
+            "peak_bytes": peak,
+            "retained_bytes": current,
+            "delta_bytes": current - self._previous_current,
+            "top_allocations": [
+                {
+                    "site": f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+                    "size_diff": stat.size_diff,
+                    "size": stat.size,
+                    "count_diff": stat.count_diff
+                }
+                for stat in top_stats
+            ]
+        })
+        self._previous_snapshot = snapshot
+        self._previous_current = current
+        tracemalloc.reset_peak()
+
+    def stop(self) -> None:
+        with self._lock:
+            self._previous_snapshot = None
+            tracing, self._tracing = self._tracing, False
+        if tracing:
+            get_tracemalloc_users().release()
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            "stages": self.stages,
+            "overall_peak_bytes": max((stage["peak_bytes"] for stage in self.stages), default=0)
+        }
+
+# ===============================
+# STORYBOARD INCREMENTAL (PDF + HOJA DE CONTACTOS)
+# ===============================
+
+class StoryboardWriter:
+    """
+    Construye el storyboard en disco a medida que llegan las escenas
+
+    Solo mantiene en memoria la página en curso (se añade al PDF en cuanto se
+    llena) y la hoja de contactos en miniatura, así el consumo no crece con
+    la longitud de la secuencia.
+    """
+
+    PAGE_SIZE = (1240, 1754)  # A4 a 150 dpi
+    PAGE_MARGIN = 60
+    PAGE_COLUMNS = 2
+    PAGE_ROWS = 3
+    CAPTION_HEIGHT = 50
+    THUMB_SIZE = 192
+    SHEET_COLUMNS = 6
+
+    @staticmethod
+    def _load_font(size: int):
+        # load_default(size=...) es de Pillow 10.1; antes solo hay la fuente de mapa de bits fija
+        try:
+            return ImageFont.load_default(size=size)
+        except TypeError:
+            return ImageFont.load_default()
+
+    def __init__(self, output_dir: str, total_scenes: int, title: str = "Storyboard"):
+        self.output_dir = output_dir
+        self.title = title
+        self.pdf_path = os.path.join(output_dir, "storyboard.pdf")
+        self.contact_sheet_path = os.path.join(output_dir, "hoja_de_contactos.png")
+        self.pages_written = 0
+        self.scenes_added = 0
+        self._page = None
+        self._page_slot = 0
+        self._font = self._load_font(22)
+        self._small_font = self._load_font(12)
+
+        # La hoja de contactos tiene tamaño fijo (miniaturas) conocido de antemano
+        sheet_rows = max(1, math.ceil(total_scenes / self.SHEET_COLUMNS))
+        self._cell = self.THUMB_SIZE + 16
+        self._sheet = Image.new(
+            "RGB",
+            (self.SHEET_COLUMNS * self._cell + 16, sheet_rows * (self._cell + 16) + 16),
+            "white"
+        )
+
+    @property
+    def scenes_per_page(self) -> int:
+        return self.PAGE_COLUMNS * self.PAGE_ROWS
+
+    def _new_page(self) -> None:
+        self._page = Image.new("RGB", self.PAGE_SIZE, "white")
+        draw = ImageDraw.Draw(self._page)
+        draw.text((self.PAGE_MARGIN, 20), f"{self.title} — página {self.pages_written + 1}", fill="black", font=self._font)
+        self._page_slot = 0
+
+    def add_scene(self, image: Image.Image, caption: str) -> None:
+        """Coloca la escena en la página en curso y en la hoja de contactos"""
+        if self._page is None:
+            self._new_page()
+
+        # Celda de la página
+        usable_width = self.PAGE_SIZE[0] - 2 * self.PAGE_MARGIN
+        usable_height = self.PAGE_SIZE[1] - 2 * self.PAGE_MARGIN - 40
+        cell_width = usable_width // self.PAGE_COLUMNS
+        cell_height = usable_height // self.PAGE_ROWS
+        column = self._page_slot % self.PAGE_COLUMNS
+        row = self._page_slot // self.PAGE_COLUMNS
+        cell_x = self.PAGE_MARGIN + column * cell_width
+        cell_y = self.PAGE_MARGIN + 40 + row * cell_height
+
+        # ImageOps.contain devuelve una copia reducida sin duplicar el original a tamaño completo
+        page_image = ImageOps.contain(image.convert("RGB"), (cell_width - 20, cell_height - self.CAPTION_HEIGHT - 10))
+        self._page.paste(page_image, (cell_x + (cell_width - page_image.width) // 2, cell_y))
+        ImageDraw.Draw(self._page).text(
+            (cell_x + 10, cell_y + page_image.height + 8),
+            caption[:60],
+            fill="black",
+            font=self._small_font
+        )
+        del page_image
+
+        # Miniatura en la hoja de contactos
+        thumb = ImageOps.contain(image.convert("RGB"), (self.THUMB_SIZE, self.THUMB_SIZE))
+        sheet_x = 16 + (self.scenes_added % self.SHEET_COLUMNS) * self._cell
+        sheet_y = 16 + (self.scenes_added // self.SHEET_COLUMNS) * (self._cell + 16)
+        self._sheet.paste(thumb, (sheet_x, sheet_y))
+        ImageDraw.Draw(self._sheet).text((sheet_x, sheet_y + self.THUMB_SIZE + 2), caption[:28], fill="black", font=self._small_font)
+
+        self.scenes_added += 1
+        self._page_slot += 1
+        if self._page_slot == self.scenes_per_page:
+            self._flush_page()
+
+    def _flush_page(self) -> None:
+        """Añade la página al PDF en disco y la libera"""
+        if self._page is None:
+            return
+        self._page.save(self.pdf_path, "PDF", resolution=150, append=self.pages_written > 0)
+        self.pages_written += 1
+        self._page = None
+        self._page_slot = 0
+
+    def close(self) -> Dict[str, Any]:
+        """Escribe la última página y la hoja de contactos; devuelve las rutas"""
+        self._flush_page()
+        self._sheet.save(self.contact_sheet_path, format="PNG", optimize=True)
+        self._sheet = None
+        return {
+            "output_dir": self.output_dir,
+            "pdf_path": self.pdf_path if self.pages_written else None,
+            "contact_sheet_path": self.contact_sheet_path,
+            "pages": self.pages_written,
+            "scenes": self.scenes_added
+        }
+
+
+def discard_session_storyboard() -> None:
+    """Borra del disco el storyboard de la sesión y lo olvida"""
+    previous = st.session_state.get("storyboard_files")
+    if previous:
+        shutil.rmtree(previous.get("output_dir", ""), ignore_errors=True)
+    st.session_state.storyboard_files = None
+
+
+def create_storyboard_writer(total_scenes: int, title: str = "Storyboard") -> StoryboardWriter:
+    """Crea un StoryboardWriter en un directorio nuevo (no toca la sesión: se usa desde GenerationTask)"""
+    return StoryboardWriter(tempfile.mkdtemp(prefix="storyboard_"), total_scenes, title)
+
+
+def build_storyboard_from_session(character_cards: List[Dict[str, Any]], title: str = "Storyboard") -> Dict[str, Any]:
+    """Reconstruye el storyboard desde st.session_state.character_images (p. ej. tras la pasada final)"""
+    total_scenes = sum(len(card["images"]) for card in character_cards)
+    discard_session_storyboard()
+    writer = create_storyboard_writer(total_scenes, title)
+    # Mismo orden que la generación: escena 1 de todos los personajes, luego la 2...
+    scene_order = sorted(
+        ((index, card_index) for card_index, card in enumerate(character_cards) for index in range(len(card["images"])))
+    )
+    for index, card_index in scene_order:
+        card = character_cards[card_index]
+        image_data = card["images"][index]
+        writer.add_scene(image_data["image_obj"], f"{card['name']} - {image_data['scene']}")
+    return writer.close()
+
+# ===============================
+# EXPORTACIÓN OPTIMIZADA (WEBP / AVIF / JPEG PROGRESIVO / PNG)
+# ===============================
+
+@st.cache_resource
+def get_export_pool():
+    """Pool de procesos compartido para codificar exportaciones (se crea una vez por servidor)"""
+    return codificador_exportacion.create_export_pool()
+
+
+def render_export_panel(items: List[tuple], key_prefix: str) -> None:
+    """
+    Panel para codificar un conjunto de imágenes en varios formatos en paralelo
+
+    Args:
+        items: Lista de (nombre_base, bytes PNG)
+        key_prefix: Prefijo para las keys de widgets y del resultado en session state
+    """
+    export_formats = codificador_exportacion.EXPORT_FORMATS
+    with st.expander("📤 Exportación optimizada (WebP / AVIF / JPEG progresivo / PNG)"):
+        formats = codificador_exportacion.available_formats()
+        if "avif" not in formats:
+            st.caption("ℹ️ AVIF no disponible en esta instalación de Pillow")
+        selected_formats = st.multiselect(
+            "Formatos",
+            formats,
+            default=["webp"] if "webp" in formats else formats[:1],
+            format_func=lambda fmt: export_formats[fmt]["label"],
+            key=f"{key_prefix}_export_formats"
+        )
+        quality = st.slider("Calidad", 40, 100, 80, key=f"{key_prefix}_export_quality", help="PNG ignora la calidad (sin pérdida)")
+        
+        # Firma de las imágenes para no mostrar exportaciones de un contenido anterior
+        signature = [(name, len(image_bytes)) for name, image_bytes in items]
+        
+        if st.button("⚙️ Codificar exportación", key=f"{key_prefix}_export_button", disabled=not selected_formats):
+            with st.spinner(f"Codificando {len(items)} imágenes en {len(selected_formats)} formatos..."):
+                results, wall_seconds = codificador_exportacion.encode_batch(get_export_pool(), items, selected_formats, quality)
+            st.session_state[f"{key_prefix}_export"] = {
+                "signature": signature,
+                "results": results,
+                "wall_seconds": wall_seconds,
+                "quality": quality,
+                "original_bytes": sum(len(image_bytes) for _, image_bytes in items)
+            }
+        
+        export = st.session_state.get(f"{key_prefix}_export")
+        if not export or export["signature"] != signature:
+            return
+        
+        st.table([
+            {
+                "Formato": export_formats[fmt]["label"],
+                "Tamaño (KB)": round(entry["total_bytes"] / 1024, 1),
+                "vs PNG original": f"{entry['total_bytes'] / export['original_bytes']:.0%}",
+                "Codificación (s)": round(entry["encode_seconds"], 2)
+            }
+            for fmt, entry in export["results"].items()
+        ])
+        st.caption(f"⏱️ Lote completo en {export['wall_seconds']:.2f}s con procesos en paralelo • calidad {export['quality']}")
+        
+        for fmt, entry in export["results"].items():
+            if len(entry["files"]) == 1:
+                filename, data = entry["files"][0]
+                mime = export_formats[fmt]["mime"]
+            else:
+                filename = f"{key_prefix}_{export_formats[fmt]['extension']}.zip"
+                data = codificador_exportacion.build_zip(entry["files"])
+                mime = "application/zip"
+            st.download_button(
+                label=f"📥 Descargar {export_formats[fmt]['label']}",
+                data=data,
+                file_name=filename,
+                mime=mime,
+                key=f"{key_prefix}_export_download_{fmt}"
+            )
+
+# ===============================
+# PLANIFICADOR DE RENDERIZADO POR PLAZO
+# ===============================
+
+# Historial de latencias compartido entre sesiones (se aprende de ejecuciones pasadas)
+RENDER_HISTORY_PATH = os.environ.get(
+    "RENDER_HISTORY_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".render_history.json")
+)
+RENDER_HISTORY_MAX_SAMPLES = 500
+
+# Latencias a priori (segundos) mientras no haya historial propio
+# Imagen: base + per_step_mp * pasos * megapíxeles
+IMAGE_LATENCY_PRIORS = {
+    "flux-pro-1.1": {"base": 4.0, "per_step_mp": 0.25},
+    "flux-pro-1.1-ultra": {"base": 12.0, "per_step_mp": 0.0}
+}
+STAGE_LATENCY_PRIORS = {
+    "text": 20.0,
+    "analysis": 35.0,
+    "visual_prompt": 6.0,
+    "audio": 12.0
+}
+PLANNER_STEP_OPTIONS = [50, 40, 30, 25, 20, 16, 12, 8]
+PLANNER_RESOLUTION_OPTIONS = [1344, 1024, 768, 512]
+
+
+class RenderHistory:
+    """
+    Historial de latencias en memoria, volcado al disco una vez por generación
+
+    record_render_sample solo añade a la lista en memoria (los hilos de una
+    generación no reescriben el JSON en cada escena); flush() suma las
+    muestras nuevas a lo que haya en el archivo (puede escribirlo otro
+    proceso) y lo reemplaza de forma atómica.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._samples: Optional[List[Dict[str, Any]]] = None
+        self._pending: List[Dict[str, Any]] = []
+
+    def _read(self) -> List[Dict[str, Any]]:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                history = json.load(f)
+            return history if isinstance(history, list) else []
+        except (OSError, ValueError):
+            return []
+
+    def samples(self) -> List[Dict[str, Any]]:
+        """Muestras del disco (leído una sola vez) más las aún no volcadas"""
+        with self._lock:
+            loaded = self._samples is not None
+        if not loaded:
+            history = self._read()
+            with self._lock:
+                if self._samples is None:
+                    self._samples = history
+        with self._lock:
+            return (self._samples + self._pending)[-RENDER_HISTORY_MAX_SAMPLES:]
+
+    def append(self, sample: Dict[str, Any]) -> None:
+        with self._lock:
+            self._pending.append(sample)
+
+    def flush(self) -> None:
+        """Escribe las muestras pendientes (nada si no las hay)"""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, []
+                if self._samples is not None:
+                    self._samples = (self._samples + pending)[-RENDER_HISTORY_MAX_SAMPLES:]
+            if not pending:
+                return
+            history = (self._read() + pending)[-RENDER_HISTORY_MAX_SAMPLES:]
+            tmp_path = f"{self.path}.{uuid.uuid4().hex}.tmp"
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(history, f)
+                os.replace(tmp_path, self.path)
+            except OSError:
+                # El historial es una ayuda para estimar: nunca debe romper la generación
+                with contextlib.suppress(OSError):
+                    os.remove(tmp_path)
+                return
+            with self._lock:
+                self._samples = history
+
+
+@st.cache_resource
+def get_render_history() -> RenderHistory:
+    """Historial único por proceso, compartido por todas las sesiones y sus hilos"""
+    return RenderHistory(RENDER_HISTORY_PATH)
+
+
+def load_render_history() -> List[Dict[str, Any]]:
+    """Historial de latencias (lista vacía si no existe o está corrupto)"""
+    return get_render_history().samples()
+
+
+def record_render_sample(kind: str, seconds: float, **attributes) -> None:
+    """
+    Añade una muestra de latencia al historial (en memoria; ver flush_render_history)
+
+    Args:
+        kind: Tipo de muestra (image, text, analysis, visual_prompt, audio, sequence)
+        seconds: Duración medida
+        attributes: Datos adicionales (model, steps, width, height, characters...)
+    """
+    sample = {"kind": kind, "seconds": round(float(seconds), 3), "timestamp": int(time.time())}
+    sample.update(attributes)
+    get_render_history().append(sample)
+
+
+def flush_render_history() -> None:
+    """Vuelca al disco las muestras de la generación que acaba de terminar"""
+    get_render_history().flush()
+
+
+def prior_image_seconds(model: str, steps: int, width: int, height: int) -> float:
+    """Latencia a priori de una imagen según modelo, pasos y resolución"""
+    prior = IMAGE_LATENCY_PRIORS.get(model, IMAGE_LATENCY_PRIORS["flux-pro-1.1"])
+    megapixels = (width * height) / 1_000_000
+    return prior["base"] + prior["per_step_mp"] * steps * megapixels
+
+
+def estimate_image_seconds(model: str, steps: int, width: int, height: int, history: List[Dict[str, Any]]) -> float:
+    """
+    Estima la latencia de una imagen corrigiendo el modelo a priori con el historial
+
+    La corrección es la mediana de (observado / a priori) de las últimas
+    muestras del mismo modelo, así se aprende la escala real por pasos y
+    resolución sin necesitar muestras exactas de cada combinación.
+    """
+    ratios = [
+        sample["seconds"] / prior_image_seconds(model, sample.get("steps", steps), sample.get("width", width), sample.get("height", height))
+        for sample in history
+        if sample.get("kind") == "image" and sample.get("model") == model
+    ][-50:]
+    correction = statistics.median(ratios) if ratios else 1.0
+    return prior_image_seconds(model, steps, width, height) * correction
+
+
+def estimate_stage_seconds(kind: str, history: List[Dict[str, Any]]) -> float:
+    """Mediana de las últimas duraciones de una etapa (o el valor a priori)"""
+    samples = [sample["seconds"] for sample in history if sample.get("kind") == kind][-20:]
+    return statistics.median(samples) if samples else STAGE_LATENCY_PRIORS.get(kind, 0.0)
+
+
+def estimate_character_count(history: List[Dict[str, Any]], default: int = 2) -> int:
+    """Número típico de personajes detectados en secuencias anteriores"""
+    counts = [sample.get("characters", default) for sample in history if sample.get("kind") == "sequence"][-20:]
+    return max(1, round(statistics.median(counts))) if counts else default
+
+
+def plan_render(num_images: int, deadline_seconds: float, model: str, steps: int, width: int, height: int,
+                max_concurrency: int, history: List[Dict[str, Any]], stages: List[str],
+                allow_step_reduction: bool = False, allow_resolution_reduction: bool = False) -> Dict[str, Any]:
+    """
+    Calcula un plan de renderizado que intente cumplir el plazo indicado
+
+    Estrategia (de menor a mayor impacto en calidad):
+    1. Menor concurrencia que cumpla el plazo (no gastar cuota de más)
+    2. Concurrencia máxima
+    3. Reducir pasos y/o resolución (solo Flux Pro, si se permite): la
+       combinación que cumpla con más pasos × píxeles; si ninguna cumple,
+       se mantienen los ajustes del usuario
+
+    Returns:
+        Diccionario con concurrency, steps, width, height, estimated_seconds,
+        meets_deadline, adjustments y el desglose por etapas
+    """
+    fixed_seconds = sum(estimate_stage_seconds(stage, history) for stage in stages)
+    image_budget = deadline_seconds - fixed_seconds
+    num_images = max(0, int(num_images))
+    max_concurrency = max(1, int(max_concurrency))
+
+    def images_seconds(concurrency, plan_steps, plan_width, plan_height):
+        if num_images == 0:
+            return 0.0
+        waves = math.ceil(num_images / concurrency)
+        return waves * estimate_image_seconds(model, plan_steps, plan_width, plan_height, history)
+
+    def build_plan(concurrency, plan_steps, plan_width, plan_height, adjustments):
+        image_seconds = images_seconds(concurrency, plan_steps, plan_width, plan_height)
+        return {
+            "num_images": num_images,
+            "concurrency": concurrency,
+            "steps": plan_steps,
+            "width": plan_width,
+            "height": plan_height,
+            "per_image_seconds": estimate_image_seconds(model, plan_steps, plan_width, plan_height, history),
+            "fixed_seconds": fixed_seconds,
+            "estimated_seconds": fixed_seconds + image_seconds,
+            "deadline_seconds": deadline_seconds,
+            "meets_deadline": fixed_seconds + image_seconds <= deadline_seconds,
+            "adjustments": adjustments
+        }
+
+    # 1-2. Solo concurrencia
+    for concurrency in range(1, min(max_concurrency, max(num_images, 1)) + 1):
+        if images_seconds(concurrency, steps, width, height) <= image_budget:
+            return build_plan(concurrency, steps, width, height, [])
+    concurrency = min(max_concurrency, max(num_images, 1))
+
+    # Flux Ultra no admite pasos ni dimensiones: no hay más palancas
+    if model == "flux-pro-1.1-ultra":
+        return build_plan(concurrency, steps, width, height, [])
+
+    # 3-4. Reducir pasos y/o resolución (manteniendo la proporción): de todas
+    # las combinaciones que cumplen, la de más pasos × píxeles
+    step_options = [steps] + ([option for option in PLANNER_STEP_OPTIONS if option < steps] if allow_step_reduction else [])
+    sizes = [(width, height)]
+    if allow_resolution_reduction:
+        longest = max(width, height)
+        for candidate in [option for option in PLANNER_RESOLUTION_OPTIONS if option < longest]:
+            sizes.append((max(256, int(width * candidate / longest) // 32 * 32),
+                          max(256, int(height * candidate / longest) // 32 * 32)))
+    fitting = [
+        (plan_steps, plan_width, plan_height)
+        for plan_steps in step_options
+        for plan_width, plan_height in sizes
+        if images_seconds(concurrency, plan_steps, plan_width, plan_height) <= image_budget
+    ]
+    if not fitting:
+        # Ninguna combinación llega: no se sacrifica calidad a cambio de nada
+        return build_plan(concurrency, steps, width, height, [])
+    plan_steps, plan_width, plan_height = max(
+        fitting, key=lambda option: (option[0] * option[1] * option[2], option[0]))
+    adjustments = []
+    if plan_steps != steps:
+        adjustments.append(f"pasos {steps} → {plan_steps}")
+    if (plan_width, plan_height) != (width, height):
+        adjustments.append(f"resolución {width}x{height} → {plan_width}x{plan_height}")
+    return build_plan(concurrency, plan_steps, plan_width, plan_height, adjustments)
+
+
+def render_plan_summary(plan: Dict[str, Any]) -> None:
+    """Muestra el plan estimado en la interfaz (antes de llamar a ninguna API)"""
+    estimated_minutes = plan["estimated_seconds"] / 60
+    deadline_minutes = plan["deadline_seconds"] / 60
+    summary = (
+        f"⏱️ **Plan estimado:** ~{estimated_minutes:.1f} min (objetivo {deadline_minutes:.1f} min)\n\n"
+        f"🖼️ {plan['num_images']} imágenes • ⚡ {plan['concurrency']} simultáneas • "
+        f"~{plan['per_image_seconds']:.0f} s/imagen\n\n"
+        f"⚙️ {plan['steps']} pasos • {plan['width']}x{plan['height']}px"
+    )
+    if plan["adjustments"]:
+        summary += "\n\n🔧 Ajustes: " + ", ".join(plan["adjustments"])
+    if plan["meets_deadline"]:
+        st.success(summary)
+    else:
+        st.warning(summary + "\n\n⚠️ No se alcanza el objetivo con los ajustes permitidos")
+
+# ===============================
+# PROCESAMIENTO POR LOTES (MESSAGE BATCHES API)
+# ===============================
+
+# Los lotes tardan de minutos a horas: no tiene sentido consultar más a menudo
+BATCH_POLL_INTERVAL = float(os.environ.get("BATCH_POLL_INTERVAL", 30))
+# Manifiestos de los lotes enviados (para reanudar desde otra sesión o al día siguiente)
+BATCH_MANIFEST_DIR = os.environ.get(
+    "BATCH_MANIFEST_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".batches")
+)
+
+
+def create_message_batch(requests_by_id: Dict[str, Dict[str, Any]], api_key: str) -> Dict[str, Any]:
+    """
+    Envía un lote a la Message Batches API
+
+    Args:
+        requests_by_id: custom_id → payload de la Messages API (ver build_text_request)
+
+    Returns:
+        Objeto message_batch (id, processing_status, request_counts...)
+    """
+    response = requests.post(
+        f"{ANTHROPIC_API_URL}/v1/messages/batches",
+        headers=claude_headers(api_key),
+        json={"requests": [{"custom_id": custom_id, "params": params} for custom_id, params in requests_by_id.items()]},
+        timeout=(HTTP_CONNECT_TIMEOUT, 120)
+    )
+    response.raise_for_status()
+    return response.json()
+
+
+def get_message_batch(batch_id: str, api_key: str) -> Dict[str, Any]:
+    """Estado actual de un lote"""
+    response = requests.get(f"{ANTHROPIC_API_URL}/v1/messages/batches/{batch_id}", headers=claude_headers(api_key), timeout=(HTTP_CONNECT_TIMEOUT, 30))
+    response.raise_for_status()
+    return response.json()
+
+
+def wait_for_message_batch(batch_id: str, api_key: str, timeout: float = 3600, poll_interval: float = BATCH_POLL_INTERVAL, on_progress=None,
+                           cancel_token: Optional[CancellationToken] = None) -> Dict[str, Any]:
+    """
+    Consulta el lote hasta que termina (processing_status == "ended")
+
+    Args:
+        on_progress: Función opcional que recibe el lote en cada consulta
+        cancel_token: Al cancelarse se deja de esperar y se devuelve el último estado
+
+    Raises:
+        TimeoutError si no termina dentro del plazo (el lote sigue en Anthropic)
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        batch = get_message_batch(batch_id, api_key)
+        if on_progress:
+            on_progress(batch)
+        if batch.get("processing_status") == "ended":
+            return batch
+        if time.monotonic() + poll_interval > deadline:
+            raise TimeoutError(f"El lote {batch_id} sigue en proceso")
+        if cancel_token is not None:
+            if cancel_token.wait(poll_interval):
+                return batch
+        else:
+            time.sleep(poll_interval)
+
+
+def fetch_message_batch_results(batch: Dict[str, Any], api_key: str) -> Dict[str, Dict[str, Any]]:
+    """
+    Descarga los resultados (JSONL) de un lote terminado
+
+    Returns:
+        custom_id → result ({"type": "succeeded", "message": {...}} o errored/canceled/expired)
+    """
+    response = requests.get(batch["results_url"], headers=claude_headers(api_key), timeout=(HTTP_CONNECT_TIMEOUT, 300))
+    response.raise_for_status()
+    results = {}
+    for line in response.text.splitlines():
+        if line.strip():
+            entry = json.loads(line)
+            results[entry["custom_id"]] = entry["result"]
+    return results
+
+
+def save_batch_manifest(manifest: Dict[str, Any]) -> None:
+    """Guarda en disco qué trabajo corresponde a cada custom_id del lote"""
+    os.makedirs(BATCH_MANIFEST_DIR, exist_ok=True)
+    path = os.path.join(BATCH_MANIFEST_DIR, f"{manifest['batch_id']}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False)
+
+
+def load_batch_manifest(batch_id: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(os.path.join(BATCH_MANIFEST_DIR, f"{batch_id}.json"), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def submit_batch_jobs(kind: str, jobs: Dict[str, Dict[str, Any]], api_key: str) -> Dict[str, Any]:
+    """
+    Envía los trabajos como un lote y guarda su manifiesto
+
+    Args:
+        kind: "texto" o "análisis"
+        jobs: custom_id → {"topic", "content_type", "params", ...}
+    """
+    batch = create_message_batch({custom_id: job["params"] for custom_id, job in jobs.items()}, api_key)
+    manifest = {
+        "batch_id": batch["id"],
+        "kind": kind,
+        "submitted_at": int(time.time()),
+        "jobs": jobs
+    }
+    save_batch_manifest(manifest)
+    return dict(manifest, batch=batch, results=None, token_usage=None)
+
+
+def collect_batch_results(state: Dict[str, Any], api_key: str) -> None:
+    """Descarga los resultados de un lote terminado y los asocia a sus trabajos"""
+    raw_results = fetch_message_batch_results(state["batch"], api_key)
+    ledger = TokenLedger()
+    results = {}
+    for custom_id, job in state["jobs"].items():
+        result = raw_results.get(custom_id, {"type": "missing"})
+        entry = {"status": result.get("type"), "text": None, "analysis": None, "error": None}
+        if result.get("type") == "succeeded":
+            message = result["message"]
+            ledger.record_usage(f"lote {state['kind']}", job["params"], message, 0.0, batch=True)
+            if state["kind"] == "análisis":
+                entry["analysis"], entry["error"] = parse_character_analysis(message)
+            else:
+                entry["text"] = message["content"][0]["text"]
+                if message.get("stop_reason") == "max_tokens":
+                    entry["error"] = "texto truncado por max_tokens"
+        elif result.get("type") == "errored":
+            entry["error"] = json.dumps(result.get("error", {}), ensure_ascii=False)
+        results[custom_id] = entry
+    state["results"] = results
+    state["token_usage"] = ledger.report()
+
+
+def run_batch_wait(task: GenerationTask) -> None:
+    """Espera en segundo plano a que termine el lote y descarga sus resultados"""
+    p = task.params
+    state = dict(p["message_batch"])
+
+    def on_progress(batch):
+        counts = batch.get("request_counts") or {}
+        total = sum(counts.values())
+        task.set_progress(1.0 - counts.get("processing", 0) / total if total else 0.0,
+                          f"📦 Lote {batch.get('processing_status')} • "
+                          + " • ".join(f"{key}: {value}" for key, value in counts.items()))
+
+    try:
+        state["batch"] = wait_for_message_batch(state["batch_id"], p["anthropic_api_key"], on_progress=on_progress,
+                                                cancel_token=task.cancel_token)
+        if state["batch"].get("processing_status") == "ended":
+            collect_batch_results(state, p["anthropic_api_key"])
+    except TimeoutError as e:
+        task.warning(f"⏳ {e}; vuelve a consultarlo más tarde")
+    except requests.RequestException as e:
+        task.error(f"Error consultando el lote: {e}")
+    task.publish(message_batch=state)
+    if state["results"] is not None:
+        task.publish(notice=("success", f"📦 Lote {state['batch_id']} terminado"))
+    else:
+        task.publish(notice=("warning", "⏹️ El lote aún no ha terminado; sigue en Anthropic y se puede consultar más tarde"))
+
+
+def render_batch_panel(api_key: str, model: str, content_type: str, max_tokens: int, max_scenes: int, input_budget: int) -> None:
+    """
+    Panel de trabajos por lotes: envío, seguimiento, reanudación por ID y resultados
+
+    Los lotes cuestan la mitad por token y no bloquean la app: se envían, se
+    puede cerrar la sesión y recuperar el resultado más tarde con su ID.
+    """
+    topics_text = st.text_area(
+        "Un tema por línea:",
+        placeholder="La Alhambra de Granada\nEl tango argentino\nLa cocina peruana",
+        height=120,
+        key="batch_topics"
+    )
+    topics = [line.strip() for line in topics_text.splitlines() if line.strip()]
+    st.caption(f"Se generará un {content_type} por tema con {model} ({len(topics)} trabajos)")
+
+    col_submit, col_resume = st.columns(2)
+    with col_submit:
+        if st.button("📤 Enviar lote", disabled=not (topics and api_key), use_container_width=True):
+            jobs = {
+                f"texto-{index:05d}": {
+                    "topic": topic,
+                    "content_type": content_type,
+                    "params": build_text_request(topic, content_type, model, max_tokens)
+                }
+                for index, topic in enumerate(topics)
+            }
+            try:
+                st.session_state.message_batch = submit_batch_jobs("texto", jobs, api_key)
+                st.success(f"✅ Lote enviado: {st.session_state.message_batch['batch_id']}")
+            except requests.RequestException as e:
+                st.error(f"Error enviando el lote: {e}")
+    with col_resume:
+        resume_id = st.text_input("Reanudar lote por ID", placeholder="msgbatch_...", key="batch_resume_id")
+        if st.button("↩️ Reanudar", disabled=not (resume_id and api_key), use_container_width=True):
+            manifest = load_batch_manifest(resume_id.strip())
+            if manifest is None:
+                st.error("No hay manifiesto local para ese lote (solo se pueden reanudar lotes enviados desde esta instalación)")
+            else:
+                st.session_state.message_batch = dict(manifest, batch={"id": manifest["batch_id"], "processing_status": "in_progress"},
+                                                      results=None, token_usage=None)
+
+    state = st.session_state.message_batch
+    if not state:
+        return
+
+    st.markdown(f"**Lote `{state['batch_id']}`** ({state['kind']}, {len(state['jobs'])} trabajos)")
+    col_refresh, col_wait = st.columns(2)
+    with col_refresh:
+        refresh = st.button("🔄 Actualizar estado", use_container_width=True, key="batch_refresh")
+    with col_wait:
+        # La espera corre como tarea en segundo plano: no bloquea el script
+        if st.button("⏳ Esperar hasta que termine", use_container_width=True, key="batch_wait",
+                     disabled=state["results"] is not None or st.session_state.generation_task is not None):
+            start_generation_task(run_batch_wait, {"anthropic_api_key": api_key, "message_batch": state})
+            st.rerun()
+    if refresh and state["results"] is None:
+        try:
+            state["batch"] = get_message_batch(state["batch_id"], api_key)
+            if state["batch"].get("processing_status") == "ended":
+                collect_batch_results(state, api_key)
+        except requests.RequestException as e:
+            st.error(f"Error consultando el lote: {e}")
+
+    counts = state["batch"].get("request_counts") or {}
+    st.caption(f"Estado: {state['batch'].get('processing_status', 'desconocido')}"
+               + (" • " + " • ".join(f"{key}: {value}" for key, value in counts.items()) if counts else ""))
+
+    if state["results"] is None:
+        return
+
+    st.table([
+        {
+            "ID": custom_id,
+            "Tema": job.get("topic", ""),
+            "Estado": state["results"][custom_id]["status"],
+            "Resultado": (
+                f"{len(state['results'][custom_id]['analysis'].get('characters', []))} personajes" if state["results"][custom_id]["analysis"]
+                else f"{len((state['results'][custom_id]['text'] or '').split())} palabras" if state["results"][custom_id]["text"]
+                else ""
+            ),
+            "Error": state["results"][custom_id]["error"] or ""
+        }
+        for custom_id, job in state["jobs"].items()
+    ])
+    totals = state["token_usage"]["totals"]
+    st.caption(f"🪙 {totals['input_tokens']} tokens de entrada • {totals['output_tokens']} de salida • "
+               f"~{totals['cost_usd']:.4f} USD (sin lote: ~{totals['cost_usd'] / BATCH_PRICE_FACTOR:.4f} USD)")
+
+    st.download_button(
+        label="📥 Descargar resultados (JSONL)",
+        data="\n".join(
+            json.dumps(dict(custom_id=custom_id, topic=job.get("topic"), content_type=job.get("content_type"),
+                            **state["results"][custom_id]), ensure_ascii=False)
+            for custom_id, job in state["jobs"].items()
+        ),
+        file_name=f"{state['batch_id']}.jsonl",
+        mime="application/jsonl",
+        key="download_batch_results"
+    )
+
+    # Segunda fase: análisis de personajes de los textos generados, también por lotes
+    succeeded = {custom_id: result for custom_id, result in state["results"].items() if result["text"]}
+    if state["kind"] == "texto" and succeeded:
+        if st.button(f"🎭 Analizar personajes de {len(succeeded)} textos por lotes", use_container_width=True, key="batch_analysis"):
+            ledger = TokenLedger(input_budget)
+            jobs = {
+                custom_id.replace("texto-", "analisis-"): {
+                    "topic": state["jobs"][custom_id]["topic"],
+                    "content_type": state["jobs"][custom_id]["content_type"],
+                    "text": result["text"],
+                    "params": build_character_analysis_request(
+                        ledger.fit(result["text"], "análisis de personajes"),
+                        state["jobs"][custom_id]["content_type"], model, max_scenes
+                    )
+                }
+                for custom_id, result in succeeded.items()
             }
-            return instructions.get(content_type, instructions["texto"])
-        
-        user_message = f"""Crea un {content_type} sobre: {prompt}
+            try:
+                st.session_state.message_batch = submit_batch_jobs("análisis", jobs, api_key)
+                st.rerun()
+            except requests.RequestException as e:
+                st.error(f"Error enviando el lote de análisis: {e}")
 
-{get_content_specific_instructions(content_type)}
+# ===============================
+# ÍNDICE DE IMÁGENES REUTILIZABLES
+# ===============================
 
-Por favor, asegúrate de que el contenido sea:
-1. Completo y bien desarrollado según las especificaciones
-2. Apropiado para el tipo de contenido solicitado
-3. Interesante y bien escrito
-4. Listo para ser presentado como contenido final
+# Índice local de todas las imágenes renderizadas (compartido entre sesiones)
+IMAGE_INDEX_DIR = os.environ.get(
+    "IMAGE_INDEX_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".image_index")
+)
+IMAGE_INDEX_MAX_ENTRIES = 2000
 
-El {content_type} debe seguir exactamente el formato y extensión indicados."""
-        
-        data = {
+# Los prompts de Flux están en inglés (los de usuario, en español)
+ENGLISH_STOPWORDS = {
+    "the", "and", "with", "for", "from", "into", "onto", "over", "under", "while", "that", "this", "their", "them",
+    "his", "her", "its", "are", "was", "were", "has", "have", "been", "being", "very", "some", "any", "each"
+}
+
+
+def prompt_terms(text: str) -> List[str]:
+    """Términos de un prompt para TF-IDF: minúsculas, sin tildes ni palabras vacías"""
+    normalized = unicodedata.normalize("NFKD", text.lower()).encode("ascii", "ignore").decode("ascii")
+    return [
+        term for term in re.findall(r"[a-z0-9]+", normalized)
+        if len(term) > 2 and term not in ENGLISH_STOPWORDS and term not in SPANISH_STOPWORDS
+    ]
+
+
+def tfidf_vector(terms: List[str], idf: Dict[str, float]) -> Dict[str, float]:
+    """Vector TF-IDF normalizado (norma 1) de una lista de términos"""
+    counts: Dict[str, int] = {}
+    for term in terms:
+        counts[term] = counts.get(term, 0) + 1
+    vector = {term: count * idf.get(term, 1.0) for term, count in counts.items()}
+    norm = math.sqrt(sum(weight * weight for weight in vector.values()))
+    return {term: weight / norm for term, weight in vector.items()} if norm else {}
+
+
+class ImageIndex:
+    """
+    Índice local de imágenes ya generadas para no pagar dos veces el mismo render
+
+    Guarda en IMAGE_INDEX_DIR un index.json (prompt del usuario, prompt final
+    de Flux, estilo, seed, modelo, tamaño y ruta del PNG) y los PNG
+    direccionados por su hash. La búsqueda compara prompts de Flux por
+    similitud coseno TF-IDF: los términos que comparten todos los prompts
+    (calidad, estilo) pesan poco y deciden los del motivo de la imagen. Solo
+    compiten las imágenes renderizadas con los mismos parámetros (modelo,
+    tamaño y al menos los mismos pasos), y la matriz TF-IDF se recalcula en
+    la siguiente búsqueda, no en cada imagen añadida.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._entries: Optional[List[Dict[str, Any]]] = None
+        self._idf: Dict[str, float] = {}
+        self._vectors: List[Dict[str, float]] = []
+        self._stale = True
+
+    @property
+    def _index_path(self) -> str:
+        return os.path.join(self.directory, "index.json")
+
+    def _load(self) -> List[Dict[str, Any]]:
+        # Llamar con el lock tomado
+        if self._entries is None:
+            try:
+                with open(self._index_path, "r", encoding="utf-8") as f:
+                    entries = json.load(f)
+                self._entries = entries if isinstance(entries, list) else []
+            except (OSError, ValueError):
+                self._entries = []
+        return self._entries
+
+    def _rebuild(self) -> None:
+        # Llamar con el lock tomado; no hace nada si no hubo cambios
+        if not self._stale:
+            return
+        self._stale = False
+        documents = [prompt_terms(entry["used_prompt"]) for entry in self._entries]
+        document_frequency: Dict[str, int] = {}
+        for terms in documents:
+            for term in set(terms):
+                document_frequency[term] = document_frequency.get(term, 0) + 1
+        # IDF suavizado: un término presente en todos los prompts sigue pesando algo
+        total = len(documents)
+        self._idf = {term: math.log((1 + total) / (1 + df)) + 1 for term, df in document_frequency.items()}
+        self._vectors = [tfidf_vector(terms, self._idf) for terms in documents]
+
+    def add(self, image_bytes: bytes, used_prompt: str, style: str, seed: Optional[int], model: str,
+            steps: int, width: int, height: int, **attributes) -> Dict[str, Any]:
+        """Guarda el PNG y su entrada (si el mismo PNG ya estaba, solo se devuelve su entrada)"""
+        digest = hashlib.sha256(image_bytes).hexdigest()
+        asset = os.path.join("assets", f"{digest[:2]}", f"{digest}.png")
+        entry = {
+            "id": digest[:16],
+            "used_prompt": used_prompt,
+            "style": style,
+            "seed": seed,
             "model": model,
-            "max_tokens": max_tokens,
-            "temperature": 0.7,
-            "system": system_prompts.get(content_type, system_prompts["texto"]),
-            "messages": [
-                {"role": "user", "content": user_message}
-            ]
+            "steps": int(steps),
+            "width": int(width),
+            "height": int(height),
+            "asset": asset,
+            "timestamp": int(time.time())
         }
-        
-        response = requests.post(
-            "https://api.anthropic.com/v1/messages",
-            headers=headers,
-            json=data,
-            timeout=120
-        )
-        
-        if response.status_code == 200:
-            response_data = response.json()
-            return response_data["content"][0]["text"]
-        else:
-            st.error(f"Error generando texto con Claude: {response.status_code} - {response.text}")
+        entry.update(attributes)
+        with self._lock:
+            entries = self._load()
+            existing = next((item for item in entries if item["id"] == entry["id"]), None)
+            if existing:
+                return existing
+            asset_path = os.path.join(self.directory, asset)
+            os.makedirs(os.path.dirname(asset_path), exist_ok=True)
+            with open(asset_path, "wb") as f:
+                f.write(image_bytes)
+            entries.append(entry)
+            for dropped in entries[:-IMAGE_INDEX_MAX_ENTRIES]:
+                with contextlib.suppress(OSError):
+                    os.remove(os.path.join(self.directory, dropped["asset"]))
+            del entries[:-IMAGE_INDEX_MAX_ENTRIES]
+            tmp_path = f"{self._index_path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(entries, f, ensure_ascii=False)
+            os.replace(tmp_path, self._index_path)
+            self._stale = True
+        return entry
+
+    def search(self, prompt: str, style: str, model: str, steps: int, width: int, height: int, threshold: float,
+               owner: str, limit: int = 3) -> List[Dict[str, Any]]:
+        """
+        Imágenes con similitud >= threshold, de mayor a menor, entre las del
+        mismo propietario (ver image_owner), estilo, modelo y tamaño con al
+        menos esos pasos (un borrador no sirve para un render de calidad completa)
+
+        Cada resultado es una copia de la entrada con su "similarity" (0-1).
+        """
+        with self._lock:
+            entries = self._load()
+            candidates = [
+                index for index, entry in enumerate(entries)
+                if entry.get("owner") == owner and entry["style"] == style and entry.get("model") == model and entry.get("steps", 0) >= int(steps)
+                and entry["width"] == int(width) and entry["height"] == int(height)
+            ]
+            if not candidates:
+                return []
+            self._rebuild()
+            query = tfidf_vector(prompt_terms(prompt), self._idf)
+            matches = []
+            for entry, vector in ((entries[index], self._vectors[index]) for index in candidates):
+                similarity = sum(weight * vector.get(term, 0.0) for term, weight in query.items())
+                if similarity >= threshold:
+                    matches.append(dict(entry, similarity=round(similarity, 4)))
+        matches.sort(key=lambda match: match["similarity"], reverse=True)
+        return matches[:limit]
+
+    def load_image(self, entry: Dict[str, Any]) -> Optional[bytes]:
+        """Bytes del PNG de una entrada (None si el archivo ya no existe)"""
+        try:
+            with open(os.path.join(self.directory, entry["asset"]), "rb") as f:
+                return f.read()
+        except OSError:
             return None
-            
-    except Exception as e:
-        st.error(f"Error en la generación de texto con Claude: {str(e)}")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries = self._load()
+            self._rebuild()
+            return {"entries": len(entries), "terms": len(self._idf)}
+
+
+@st.cache_resource
+def get_image_index() -> ImageIndex:
+    """Índice compartido por todas las sesiones del proceso"""
+    return ImageIndex(IMAGE_INDEX_DIR)
+
+
+def image_owner(api_key: str) -> str:
+    """
+    Propietario de una imagen del índice: huella de la clave de Flux que la
+    pagó. El índice es de todo el servidor, pero cada clave solo ve las suyas
+    (los prompts de una sesión no aparecen en las búsquedas de otro usuario)
+    """
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+
+def offer_image_reuse(message: str, previews: List[tuple]) -> bool:
+    """
+    Pregunta si usar imágenes del índice en lugar de renderizar (apto para hilos)
+
+    Dentro de una GenerationTask espera la respuesta del usuario (ver
+    GenerationTask.offer_reuse); fuera de una tarea no hay a quién
+    preguntar y se renderiza como siempre.
+    """
+    sink = ui()
+    return isinstance(sink, GenerationTask) and sink.offer_reuse(message, previews)
+
+
+def find_reusable_image(prompt: str, style: str, model: str, steps: int, width: int, height: int,
+                        threshold: Optional[float], api_key: str) -> Optional[tuple]:
+    """
+    Busca una imagen ya generada que sirva para este prompt (apto para hilos)
+
+    Returns:
+        (imagen PIL, bytes PNG, entrada con su similitud) o None si no hay
+        ninguna por encima del umbral (o threshold es None: reutilización desactivada)
+    """
+    if threshold is None:
         return None
+    try:
+        index = get_image_index()
+        for match in index.search(prompt, style, model, steps, width, height, threshold, image_owner(api_key)):
+            image_bytes = index.load_image(match)
+            if image_bytes:
+                return Image.open(BytesIO(image_bytes)).convert("RGB"), image_bytes, match
+    except (OSError, ValueError):
+        # El índice es una ayuda: si falla, se renderiza como siempre
+        pass
+    return None
 
-# Nueva función para generar prompt visual con Claude
-def generate_visual_prompt_with_claude(text_content: str, content_type: str, style: str, api_key: str, model: str) -> Optional[str]:
-    """Genera un prompt visual optimizado usando Claude basado en el contenido generado"""
+
+def index_rendered_image(image_bytes: bytes, used_prompt: str, style: str, seed: Optional[int], model: str,
+                         steps: int, width: int, height: int, api_key: str, **attributes) -> None:
+    """Añade un render nuevo al índice sin romper la generación si el disco falla"""
     try:
-        headers = {
-            "x-api-key": api_key,
-            "Content-Type": "application/json",
-            "anthropic-version": "2023-06-01"
-        }
-        
-        # System prompt especializado para generación de prompts visuales
-        system_prompt = """Eres un experto en generación de prompts para modelos de AI de imágenes, específicamente para Flux. Tu tarea es analizar contenido de texto y crear prompts visuales optimizados en inglés.
+        get_image_index().add(image_bytes, used_prompt, style, seed, model, steps, width, height,
+                              owner=image_owner(api_key), **attributes)
+    except OSError:
+        pass
 
-REGLAS IMPORTANTES:
-1. El prompt DEBE estar en inglés perfecto
-2. Debe ser específico y descriptivo visualmente
-3. Incluir términos técnicos de fotografía/arte cuando sea apropiado
-4. Adaptar al estilo solicitado
-5. Ser conciso pero detallado (máximo 150 palabras)
-6. NO reproducir texto del contenido, solo elementos visuales
 
-ESTRUCTURA DEL PROMPT:
-[Descripción visual principal] + [Estilo técnico] + [Calidad/Resolución] + [Elementos compositivos]"""
-# Instrucciones específicas por tipo de contenido (AMPLIADAS)
-        content_instructions = {
-            "ejercicio": """Analiza este ejercicio educativo y crea un prompt visual que represente:
-- La materia/tema principal del ejercicio
-- Un ambiente educativo apropiado (aula, laboratorio, biblioteca, etc.)
-- Elementos visuales que complementen el aprendizaje
-- Personas estudiando o practicando el tema si es relevante
-- Materiales educativos relacionados
+def reuse_summary(reused: Dict[str, Any]) -> str:
+    """Texto breve para mostrar de dónde sale una imagen reutilizada"""
+    when = time.strftime("%d/%m/%Y %H:%M", time.localtime(reused.get("timestamp", 0)))
+    return f"♻️ Reutilizada de una generación anterior ({when}) • similitud {reused['similarity']:.0%}"
 
-Evita incluir texto específico del ejercicio, solo elementos visuales educativos.""",
-            
-            "artículo": """Analiza este artículo y crea un prompt visual que represente:
-- El tema central o concepto principal
-- Elementos que ilustren la información clave
-- Un contexto visual apropiado para el tema
-- Objetos, personas o lugares relevantes al contenido
-- Una composición que transmita el mensaje principal
+# ===============================
+# GENERACIÓN EN SEGUNDO PLANO
+# ===============================
 
-Evita texto específico, enfócate en elementos visuales informativos.""",
-            
-            "texto": """Analiza este texto y crea un prompt visual que capture:
-- El tema o concepto principal
-- El tono y ambiente del contenido
-- Elementos visuales que complementen el mensaje
-- Una composición apropiada para el propósito del texto
-- Elementos que refuercen visualmente la idea principal
+# Cada cuánto se refresca el progreso de una generación en curso
+GENERATION_REFRESH_SECONDS = float(os.getenv("GENERATION_REFRESH_SECONDS", "1.0"))
 
-Enfócate en la esencia visual del contenido.""",
-            
-            "relato": """Analiza este relato y crea un prompt visual que capture:
-- La escena más representativa o impactante
-- Los personajes principales (sin nombres específicos)
-- La ambientación y época de la historia
-- El mood/atmósfera del relato
-- Elementos narrativos clave visualmente
+# Campos de st.session_state que una tarea puede publicar
+TASK_RESULT_FIELDS = ("generated_content", "character_analysis", "character_images",
+                      "sequence_generation_complete", "storyboard_files", "character_sequence_mode", "stage_memo",
+                      "style_sweep", "message_batch")
 
-Crea una escena cinematográfica que represente el relato.""",
-            
-            "diálogo situacional": """Analiza este diálogo situacional y crea un prompt visual que muestre:
-- El contexto/lugar donde ocurre la conversación
-- Dos personas conversando de manera natural
-- El ambiente apropiado (cafetería, aeropuerto, oficina, etc.)
-- Elementos que refuercen el contexto situacional
-- Una escena realista y cotidiana
 
-Representa visualmente la situación del diálogo.""",
-            
-            "artículo cultural": """Analiza este artículo cultural y crea un prompt visual que represente:
-- La tradición, costumbre o elemento cultural principal
-- Escenas típicas relacionadas con la cultura descrita
-- Personas participando en actividades culturales
-- Elementos visuales representativos (objetos, lugares, vestimentas)
-- Un ambiente que refleje la identidad cultural
+class GenerationTask:
+    """
+    Generación que corre en un hilo propio de la sesión, fuera del script
 
-Captura la esencia visual de la cultura descrita.""",
-            
-            "artículo de actualidad": """Analiza este artículo de actualidad y crea un prompt visual que muestre:
-- El tema principal de la noticia
-- Elementos visuales que ilustren la información
-- Un contexto actual y contemporáneo
-- Personas, lugares u objetos relacionados con la noticia
-- Una composición informativa y clara
+    Así un control de la barra lateral no la interrumpe y el script no queda
+    bloqueado minutos. El hilo no toca Streamlit: deja progreso, mensajes,
+    huecos de escena y resultados en este objeto (protegido con un lock), y
+    render_generation_progress, en el hilo del script, los lee y los pasa a
+    session_state cuando la tarea termina.
+    """
 
-Representa visualmente el contenido noticioso.""",
-            
-            "artículo biográfico": """Analiza este artículo biográfico y crea un prompt visual que incluya:
-- Un retrato o representación de la época de la persona
-- Elementos relacionados con sus logros principales
-- El contexto histórico o profesional relevante
-- Objetos o símbolos asociados con su trabajo/vida
-- Una composición que honre su legado
+    def __init__(self, target, params: Dict[str, Any]):
+        self.params = params
+        deadline_seconds = params.get("deadline_seconds")
+        self.cancel_token = CancellationToken(Deadline(deadline_seconds) if deadline_seconds else None)
+        self.profiler: Optional[MemoryProfiler] = None
+        self.started_at = time.perf_counter()
+        self._target = target
+        self._lock = threading.Lock()
+        self._progress = 0.0
+        self._status = "⏳ Preparando la generación..."
+        self._messages: List[tuple] = []
+        self._scenes: Dict[tuple, Dict[str, Any]] = {}
+        self._result: Dict[str, Any] = {}
+        self._done = False
+        self._finished_at: Optional[float] = None
+        self._offer: Optional[Dict[str, Any]] = None
+        self._offer_count = 0
+        self._offer_lock = threading.Lock()
+        self._offer_answered = threading.Event()
+        self._offer_choice = False
+        self._thread = threading.Thread(target=self._run, name="generation-task", daemon=True)
 
-Crea una representación visual dignificante del personaje.""",
-            
-            "clip de noticias": """Analiza estos clips de noticias y crea un prompt visual que muestre:
-- Una composición estilo noticiero o medio de comunicación
-- Elementos gráficos informativos modernos
-- Un ambiente de sala de redacción o estudio de noticias
-- Personas trabajando en medios de comunicación
-- Una estética profesional y contemporánea
+    def start(self) -> None:
+        self._thread.start()
 
-Representa el mundo del periodismo y las noticias.""",
-            
-            "pregunta de debate": """Analiza esta pregunta de debate y crea un prompt visual que represente:
-- Personas en situación de diálogo o debate
-- Un ambiente apropiado para la discusión (aula, mesa redonda, etc.)
-- Elementos que sugieran intercambio de ideas
-- Una composición que invite al diálogo
-- Diversidad de perspectivas visuales
+    def _run(self) -> None:
+        _ui_sink.target = self
+        try:
+            self._target(self)
+        except Exception as e:
+            self.error(f"⚠ Error durante la generación: {str(e)}")
+        finally:
+            _ui_sink.target = None
+            flush_render_history()
+            with self._lock:
+                self._done = True
+                self._finished_at = time.perf_counter()
 
-Crea una escena que fomente la conversación.""",
-            
-            "receta de cocina": """Analiza esta receta y crea un prompt visual que muestre:
-- Los ingredientes principales de la receta
-- Una cocina acogedora y bien equipada
-- El proceso de cocinar o el plato terminado
-- Utensilios de cocina apropiados
-- Una presentación apetitosa y profesional
+    # --- Registro de mensajes (misma interfaz que st para ui()) ---
 
-Representa visualmente la experiencia culinaria.""",
-            
-            "post de redes sociales": """Analiza este post y crea un prompt visual que capture:
-- El estilo visual típico de redes sociales
-- Elementos modernos y contemporáneos
-- Una estética atractiva y "instagrameable"
-- Personas usando dispositivos móviles o en situaciones sociales
-- Colores vibrantes y composición dinámica
+    def _log(self, level: str, message: str) -> None:
+        with self._lock:
+            self._messages.append((level, message))
 
-Crea una imagen perfecta para redes sociales.""",
-            
-            "trivia cultural": """Analiza esta trivia cultural y crea un prompt visual que represente:
-- Un ambiente de quiz o juego educativo
-- Elementos relacionados con el tema de las preguntas
-- Personas participando en actividades de conocimiento
-- Libros, mapas, o símbolos culturales relevantes
-- Una composición educativa y atractiva
+    def info(self, message: str) -> None:
+        self._log("info", message)
+
+    def success(self, message: str) -> None:
+        self._log("success", message)
+
+    def warning(self, message: str) -> None:
+        self._log("warning", message)
+
+    def error(self, message: str) -> None:
+        self._log("error", message)
+
+    # --- Progreso, escenas y resultados ---
+
+    def set_progress(self, value: float, status: Optional[str] = None) -> None:
+        # No retrocede aunque informen a la vez etapas que van en paralelo
+        with self._lock:
+            self._progress = max(self._progress, min(1.0, max(0.0, value)))
+            if status:
+                self._status = status
+
+    def add_scene(self, key: tuple, label: str, seed: int) -> None:
+        with self._lock:
+            self._scenes[key] = {"label": label, "seed": seed, "state": "pending", "thumbnail": None, "message": ""}
+
+    @staticmethod
+    def _thumbnail(image: Image.Image) -> bytes:
+        # Miniatura JPEG: el fragmento la vuelve a enviar en cada refresco
+        thumbnail = image.copy()
+        thumbnail.thumbnail((320, 320))
+        buffer = io.BytesIO()
+        thumbnail.convert("RGB").save(buffer, format="JPEG", quality=80)
+        return buffer.getvalue()
+
+    def scene_done(self, key: tuple, image: Image.Image) -> None:
+        thumbnail = self._thumbnail(image)
+        with self._lock:
+            self._scenes[key].update(state="done", thumbnail=thumbnail)
+
+    def scene_failed(self, key: tuple, message: str, cancelled: bool = False) -> None:
+        with self._lock:
+            self._scenes[key].update(state="cancelled" if cancelled else "error", message=message)
+
+    def publish(self, **fields) -> None:
+        """Deja resultados para session_state (claves de TASK_RESULT_FIELDS y "notice")"""
+        with self._lock:
+            self._result.update(fields)
+
+    # --- Decisiones del usuario ---
+
+    def offer_reuse(self, message: str, previews: List[tuple]) -> bool:
+        """
+        Ofrece imágenes ya generadas y espera la respuesta (desde el hilo de la tarea)
+
+        previews son pares (imagen PIL, pie). render_generation_progress
+        muestra la oferta con sus botones; la espera termina con la respuesta,
+        la cancelación o el plazo (en ambos casos, False: no se reutiliza).
+        """
+        previews = [(self._thumbnail(image), caption) for image, caption in previews]
+        with self._offer_lock:
+            with self._lock:
+                self._offer_count += 1
+                self._offer = {"id": self._offer_count, "message": message, "previews": previews}
+                self._offer_answered.clear()
+            while not self._offer_answered.is_set():
+                if self.cancel_token.wait(0.2):
+                    break
+            with self._lock:
+                self._offer = None
+                return self._offer_answered.is_set() and self._offer_choice
+
+    def answer_offer(self, reuse: bool) -> None:
+        """Respuesta del usuario a la oferta en curso (desde el hilo del script)"""
+        with self._lock:
+            if self._offer is None:
+                return
+            self._offer_choice = reuse
+            self._offer = None
+        self._offer_answered.set()
+
+    def cancel(self) -> None:
+        self.cancel_token.cancel()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_token.cancelled
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Copia coherente del estado para pintarla desde el hilo del script"""
+        with self._lock:
+            return {
+                "progress": self._progress,
+                "status": self._status,
+                "messages": list(self._messages),
+                "scenes": [dict(self._scenes[key], key=key) for key in sorted(self._scenes)],
+                "result": dict(self._result),
+                "offer": self._offer,
+                "done": self._done,
+                "cancelled": self.cancel_token.cancelled,
+                "expired": self.cancel_token.expired,
+                "elapsed": (self._finished_at or time.perf_counter()) - self.started_at
+            }
+
+
+def stage_token(token: CancellationToken, reserve_seconds: float) -> CancellationToken:
+    """
+    Token de una etapa: su plazo deja reserve_seconds (lo estimado para las
+    etapas siguientes) del plazo de la generación. Si la etapa lo agota, se
+    detiene y las siguientes siguen con lo que queda.
+    """
+    if token.deadline is None:
+        return token
+    return token.with_deadline(token.deadline.split(reserve_seconds))
+
+
+def start_task_profiler(task: GenerationTask) -> Optional[MemoryProfiler]:
+    if not task.params.get("memory_profiling"):
+        return None
+    task.profiler = MemoryProfiler()
+    task.profiler.start()
+    return task.profiler
+
+
+def run_sequence_stage(task: GenerationTask, character_analysis: Dict[str, Any], title: str,
+                       profiler: Optional[MemoryProfiler], progress_range: tuple,
+                       cancel_token: Optional[CancellationToken] = None) -> Dict[str, Any]:
+    """Secuencia de personajes (común a la generación completa y a "solo secuencia")"""
+    p = task.params
+    cancel_token = cancel_token or task.cancel_token
+    flux_config = {
+        "api_key": p["bfl_api_key"],
+        "model": p["flux_model"],
+        "width": p["width"],
+        "height": p["height"],
+        "steps": p["steps"],
+        "style": p["image_style"],
+        "concurrency": p["concurrency"],
+        "draft": p["draft_mode"],
+        "cancel_token": cancel_token,
+        "webhook": p["flux_webhook"],
+        "hedge": p["hedging"],
+        "reuse_threshold": p["reuse_threshold"],
+        "user_prompt": p.get("user_prompt", "")
+    }
+    
+    storyboard_writer = None
+    if p["storyboard_enabled"]:
+        storyboard_writer = create_storyboard_writer(
+            sum(len(char["suggested_scenes"]) for char in character_analysis["characters"]), title
+        )
+    
+    sequence_results = generate_character_sequence(
+        character_analysis, flux_config, task,
+        profiler=profiler, storyboard=storyboard_writer, progress_range=progress_range
+    )
+    task.publish(storyboard_files=sequence_results.get("storyboard"))
+    if sequence_results["success"]:
+        task.publish(character_images=sequence_results["character_cards"], sequence_generation_complete=True)
+    elif not cancel_token.cancelled:
+        task.error("❌ Error generando secuencia de personajes")
+    return sequence_results
+
+
+# ===============================
+# PIPELINE DE ETAPAS (GRAFO MEMOIZADO)
+# ===============================
+
+class Stage:
+    """
+    Etapa del pipeline de generación
+
+    inputs son los parámetros de la tarea que determinan su resultado (las
+    claves de API, la concurrencia o el plazo no: cambian cómo se calcula,
+    no qué) y deps las etapas cuya salida usa. run(task, p, deps, token,
+    context) devuelve la salida (dict) o None si falló; estimate(p, history)
+    son los segundos previstos, para repartir el plazo.
+    """
+
+    def __init__(self, name: str, label: str, inputs: tuple, deps: tuple, run, estimate):
+        self.name = name
+        self.label = label
+        self.inputs = inputs
+        self.deps = deps
+        self.run = run
+        self.estimate = estimate
+
+
+def stage_fingerprint(stage: Stage, params: Dict[str, Any], dep_versions: Dict[str, Optional[str]]) -> str:
+    """Clave de memo de una etapa: sus entradas y la versión de cada dependencia"""
+    material = {
+        "stage": stage.name,
+        "inputs": {name: params.get(name) for name in stage.inputs},
+        "deps": dep_versions
+    }
+    return hashlib.sha256(json.dumps(material, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")).hexdigest()
+
+
+def output_version(output: Dict[str, Any]) -> str:
+    """
+    Versión de una salida: hash del contenido si es JSON (texto, análisis) o
+    una nueva en cada cálculo (imágenes y audio)
+
+    Así un texto editado cambia de versión y deja desactualizado lo que
+    depende de él, y un análisis que vuelve a dar lo mismo no obliga a
+    renderizar otra vez.
+    """
+    try:
+        return hashlib.sha256(json.dumps(output, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()[:16]
+    except (TypeError, ValueError):
+        return uuid.uuid4().hex[:16]
+
+
+def update_stage_output(memo: Dict[str, Any], stage_name: str, **fields) -> Dict[str, Any]:
+    """
+    Copia del memo con la salida de una etapa retocada fuera del pipeline
+    (texto editado, pasada final, render nuevo): conserva su clave y cambia
+    de versión, así que las etapas que dependen de ella quedan desactualizadas
+    """
+    memo = dict(memo or {})
+    entry = memo.get(stage_name)
+    if entry:
+        output = dict(entry["output"], **fields)
+        memo[stage_name] = dict(entry, output=output, version=output_version(output))
+    return memo
 
-Representa el mundo del conocimiento y la cultura general."""
+
+def memorize_stage_output(memo: Dict[str, Any], stage_name: str, params: Dict[str, Any], output: Dict[str, Any],
+                          seconds: Optional[float] = None) -> Dict[str, Any]:
+    """Copia del memo con una salida calculada fuera del pipeline para las entradas de params"""
+    memo = dict(memo or {})
+    stage = next(stage for stage in PIPELINE_STAGES if stage.name == stage_name)
+    if all(dep in memo for dep in stage.deps):
+        memo[stage_name] = {
+            "key": stage_fingerprint(stage, params, {dep: memo[dep]["version"] for dep in stage.deps}),
+            "version": output_version(output),
+            "output": output,
+            "seconds": seconds
         }
-        
-        # Adaptaciones por estilo visual
-        # CAMBIAR de español a inglés:
-        style_adaptations = {
-        "photorealistic": "Professional realistic photography with natural lighting, high definition, sharp photographic composition, crisp details",
-        "digital-art": "High quality digital art, vibrant colors, artistic composition, modern illustrative style, professional design",
-        "cinematic": "Cinematic composition, dramatic lighting, depth of field, film atmosphere, high production quality",
-        "documentary": "Authentic documentary style, candid photography, natural lighting, real environment, journalistic quality",
-        "portrait": "Professional portrait photography, studio lighting, people-centered composition, professional quality",
-        "watercolor": "Artistic watercolor style, soft flowing colors, traditional painting technique, paper texture",
-        "oil-painting": "Classic oil painting, visible brushstrokes, rich colors, old masters technique",
-        "anime": "Japanese anime style, vibrant colors, clean lines, expressive character design",
-        "sketch": "Artistic pencil drawing, expressive lines, soft shading, sketch style",
-        "vintage": "Nostalgic vintage style, desaturated colors, aged effect, retro atmosphere", 
-        "minimalist": "Minimalist design, simple composition, neutral colors, negative spaces"
+    return memo
+
+
+def stage_text(task: GenerationTask, p: Dict[str, Any], deps: Dict[str, Any], token: CancellationToken,
+               context: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    stage_start = time.perf_counter()
+    generated_text = generate_text_claude(
+        p["user_prompt"], p["content_type"], p["anthropic_api_key"],
+        p["claude_model"], p["max_tokens_claude"], context["ledger"], token
+    )
+    context["timings"]['text'] = time.perf_counter() - stage_start
+    if context["profiler"]:
+        context["profiler"].checkpoint("texto")
+    
+    if not generated_text:
+        if not token.cancel_requested:
+            task.error("⚠ Error al generar el contenido de texto con Claude.")
+        return None
+    
+    record_render_sample("text", context["timings"]['text'], model=p["claude_model"])
+    return {
+        'text': generated_text,
+        'text_metadata': {
+            'word_count': len(generated_text.split()),
+            'char_count': len(generated_text),
+            'content_type': p["content_type"]
         }
-        
-        user_message = f"""CONTENIDO A ANALIZAR:
-{text_content}
+    }
 
-TIPO DE CONTENIDO: {content_type}
-ESTILO DESEADO: {style}
 
-{content_instructions.get(content_type, content_instructions["texto"])}
+def stage_analysis(task: GenerationTask, p: Dict[str, Any], deps: Dict[str, Any], token: CancellationToken,
+                   context: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Análisis de personajes (solo en modo secuencia; si no, sin personajes)"""
+    if not p["sequence_mode"]:
+        return {"character_analysis": None}
+    stage_start = time.perf_counter()
+    character_analysis = analyze_characters_with_claude(
+        deps["text"]["text"], p["content_type"], p["anthropic_api_key"], p["claude_model"], p["max_scenes"],
+        long_text_mode=p["chapter_analysis"], ledger=context["ledger"], cancel_token=token
+    )
+    context["timings"]['analysis'] = time.perf_counter() - stage_start
+    if context["profiler"]:
+        context["profiler"].checkpoint("análisis")
+    
+    if character_analysis.get("has_characters", False):
+        record_render_sample("analysis", context["timings"]['analysis'], model=p["claude_model"])
+        task.success(f"✅ Detectados {len(character_analysis['characters'])} personajes para secuencia")
+        return {"character_analysis": character_analysis}
+    if token.expired:
+        task.warning("⏱️ El análisis de personajes agotó su plazo. Se generará imagen única.")
+    else:
+        task.warning("⚠️ No se detectaron personajes. Se generará imagen única.")
+    task.publish(character_sequence_mode=False)
+    return {"character_analysis": None}
 
-INSTRUCCIONES ADICIONALES PARA EL ESTILO:
-{style_adaptations.get(style, style_adaptations["photorealistic"])}
 
-Por favor, responde ÚNICAMENTE con el prompt visual en inglés optimizado para Flux, sin explicaciones adicionales."""
-        
-        data = {
-            "model": model,
-            "max_tokens": 200,
-            "temperature": 0.3,  # Menos temperatura para más consistencia
-            "system": system_prompt,
-            "messages": [
-                {"role": "user", "content": user_message}
-            ]
+def stage_images(task: GenerationTask, p: Dict[str, Any], deps: Dict[str, Any], token: CancellationToken,
+                 context: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Secuencia de personajes si el análisis los encontró; si no, imagen única"""
+    character_analysis = deps["analysis"]["character_analysis"]
+    previous = (context["memo"].get("images") or {}).get("output") or {}
+    if character_analysis:
+        title = f"Storyboard: {p['user_prompt'][:40]}" if p.get("user_prompt") else "Storyboard"
+        sequence_results = run_sequence_stage(task, character_analysis, title, context["profiler"], (0.3, 0.9),
+                                              cancel_token=token)
+        context["timings"]['images'] = sequence_results.get("elapsed_seconds", 0.0)
+        if not sequence_results["success"]:
+            return None
+        output = {
+            "character_images": sequence_results["character_cards"],
+            "storyboard_files": sequence_results.get("storyboard"),
+            "image": None,
+            "image_obj": None,
+            "image_metadata": None
         }
-        
-        response = requests.post(
-            "https://api.anthropic.com/v1/messages",
-            headers=headers,
-            json=data,
-            timeout=60
+    else:
+        stage_start = time.perf_counter()
+        reuse_info = {}
+        generated_image, used_prompt, prompt_source = generate_image_flux(
+            deps["text"]["text"], p["content_type"], p["bfl_api_key"], p["flux_model"],
+            p["width"], p["height"], p["steps"], p["image_style"],
+            p["image_prompt"], p["anthropic_api_key"], p["claude_model"],
+            fast_prompt=p["fast_visual_prompt"], timings=context["timings"], ledger=context["ledger"], cancel_token=token,
+            reuse_threshold=p["reuse_threshold"], reuse_info=reuse_info, webhook=p["flux_webhook"],
+            hedge=p["hedging"]
         )
+        context["timings"]['images'] = time.perf_counter() - stage_start
+        if context["profiler"]:
+            context["profiler"].checkpoint("imagen")
+        if not generated_image:
+            return None
         
-        if response.status_code == 200:
-            response_data = response.json()
-            visual_prompt = response_data["content"][0]["text"].strip()
-            return visual_prompt
+        img_buffer = io.BytesIO()
+        generated_image.save(img_buffer, format="PNG", quality=95)
+        image_metadata = {
+            'width': p["width"],
+            'height': p["height"],
+            'model': p["flux_model"],
+            'steps': p["steps"],
+            'style': p["image_style"],
+            'custom_prompt': prompt_source == "personalizado",
+            'used_prompt': used_prompt,
+            'prompt_intelligent': prompt_source == "inteligente",
+            'prompt_local': prompt_source == "local",
+            'timestamp': int(time.time())
+        }
+        if reuse_info:
+            image_metadata['reused'] = reuse_info
         else:
-            st.error(f"Error generando prompt visual con Claude: {response.status_code} - {response.text}")
-            return None
-            
-    except Exception as e:
-        st.error(f"Error en la generación de prompt visual con Claude: {str(e)}")
+            index_rendered_image(
+                img_buffer.getvalue(), used_prompt, p["image_style"], 42, p["flux_model"], p["steps"], p["width"], p["height"],
+                p["bfl_api_key"], kind="image", user_prompt=p["user_prompt"], content_type=p["content_type"]
+            )
+        output = {
+            "character_images": [],
+            "storyboard_files": None,
+            "image": img_buffer.getvalue(),
+            "image_obj": generated_image,
+            "image_metadata": image_metadata
+        }
+    
+    # El storyboard del cálculo anterior ya no lo usa nadie
+    if previous.get("storyboard_files") and previous["storyboard_files"] != output["storyboard_files"]:
+        shutil.rmtree(previous["storyboard_files"].get("output_dir", ""), ignore_errors=True)
+    return output
+
+
+def stage_audio(task: GenerationTask, p: Dict[str, Any], deps: Dict[str, Any], token: CancellationToken,
+                context: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    stage_start = time.perf_counter()
+    generated_text = deps["text"]["text"]
+    dialogue_voices = {}
+    if p["dialogue_voices"] and p["content_type"] == "diálogo situacional":
+        generated_audio, dialogue_voices = generate_dialogue_audio(
+            generated_text, p["voice_model"], p["openai_api_key"], p["hedging"], token, p["tts_sentence_cache"]
+        )
+    else:
+        generated_audio = generate_audio(generated_text, p["voice_model"], p["openai_api_key"], p["hedging"], token,
+                                         p["tts_sentence_cache"])
+    context["timings"]['audio'] = time.perf_counter() - stage_start
+    if context["profiler"]:
+        context["profiler"].checkpoint("audio")
+    if not generated_audio:
         return None
+    
+    if dialogue_voices:
+        record_render_sample("audio", context["timings"]['audio'], voice=p["voice_model"], speakers=len(dialogue_voices))
+    else:
+        record_render_sample("audio", context["timings"]['audio'], voice=p["voice_model"])
+    audio_metadata = {
+        'voice': p["voice_model"],
+        'size_kb': len(generated_audio) / 1024,
+        'timestamp': int(time.time())
+    }
+    if dialogue_voices:
+        audio_metadata['dialogue_voices'] = dialogue_voices
+    return {"audio": generated_audio, "audio_metadata": audio_metadata}
 
-# Función para optimizar prompt para Flux (ahora simplificada ya que Claude genera el prompt completo)
-def optimize_prompt_for_flux(prompt, style="photorealistic"):
-    """Aplica optimizaciones finales al prompt ya generado por Claude"""
+
+def stage_languages(task: GenerationTask, p: Dict[str, Any], deps: Dict[str, Any], token: CancellationToken,
+                    context: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Variantes en otros idiomas, una por hilo (comparten la imagen o secuencia)"""
+    if not p["target_languages"]:
+        return {"language_variants": {}}
+    stage_start = time.perf_counter()
+    executor = ThreadPoolExecutor(max_workers=len(p["target_languages"]))
     try:
-        # Agregar términos técnicos finales si no están presentes
-        quality_terms = "high quality, detailed, professional"
-        resolution_terms = "8K resolution, sharp focus"
-        
-        # Verificar si ya contiene términos de calidad
-        prompt_lower = prompt.lower()
-        if not any(term in prompt_lower for term in ["high quality", "8k", "detailed", "professional", "masterpiece"]):
-            prompt += f", {quality_terms}, {resolution_terms}"
-        
-        return prompt
-    except Exception as e:
-        st.error(f"Error optimizando prompt: {str(e)}")
-        return prompt
+        futures = {
+            language: executor.submit(
+                generate_language_variant, deps["text"]["text"], p["content_type"], language,
+                p["anthropic_api_key"], p["claude_model"], p["max_tokens_claude"], p["voice_model"], p["openai_api_key"],
+                context["ledger"], token, p["hedging"], p["tts_sentence_cache"]
+            )
+            for language in p["target_languages"]
+        }
+        language_variants = {}
+        for language, future in futures.items():
+            variant = future.result()
+            if variant["error"] and variant["error"] not in STOP_MESSAGES:
+                task.error(variant["error"])
+            if variant["text"]:
+                language_variants[language] = variant
+                if variant["audio"]:
+                    record_render_sample("audio", variant["seconds"], voice=p["voice_model"], language=language)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    context["timings"]['languages'] = time.perf_counter() - stage_start
+    if context["profiler"]:
+        context["profiler"].checkpoint("idiomas")
+    return {"language_variants": language_variants}
 
-# Función para generar imagen con Flux Pro (basada en el archivo de referencia)
-def generate_image_flux_pro(prompt, width, height, steps, api_key, seed=None, style="photorealistic"):
+
+def estimate_images_stage(p: Dict[str, Any], history: List[Dict[str, Any]]) -> float:
+    seconds = estimate_image_seconds(p["flux_model"], p["steps"], p["width"], p["height"], history)
+    if p["sequence_mode"]:
+        planned_images = estimate_character_count(history) * p["max_scenes"]
+        seconds *= math.ceil(planned_images / max(1, p["concurrency"]))
+    return seconds
+
+
+# En orden topológico: cada etapa va después de sus dependencias
+PIPELINE_STAGES = (
+    Stage("text", "🧠 Texto", ("user_prompt", "content_type", "claude_model", "max_tokens_claude"), (),
+          stage_text, lambda p, history: estimate_stage_seconds("text", history)),
+    Stage("analysis", "🎭 Análisis de personajes", ("sequence_mode", "content_type", "claude_model", "max_scenes", "chapter_analysis"),
+          ("text",), stage_analysis,
+          lambda p, history: estimate_stage_seconds("analysis", history) if p["sequence_mode"] else 0.0),
+    Stage("images", "🎨 Imagen o secuencia", ("content_type", "claude_model", "flux_model", "width", "height", "steps", "image_style",
+                                            "image_prompt", "fast_visual_prompt", "draft_mode", "storyboard_enabled", "reuse_threshold"),
+          ("text", "analysis"), stage_images, estimate_images_stage),
+    Stage("audio", "🗣️ Audio", ("voice_model", "dialogue_voices", "content_type", "tts_sentence_cache"), ("text",),
+          stage_audio, lambda p, history: estimate_stage_seconds("audio", history)),
+    Stage("languages", "🌍 Idiomas", ("target_languages", "content_type", "voice_model", "claude_model", "max_tokens_claude",
+                                     "tts_sentence_cache"),
+          ("text",), stage_languages,
+          lambda p, history: estimate_stage_seconds("text", history) + estimate_stage_seconds("audio", history) if p["target_languages"] else 0.0),
+)
+
+
+def pipeline_status(params: Dict[str, Any], memo: Dict[str, Any]) -> Dict[str, str]:
     """
-    Genera imagen usando Flux Pro 1.1 con guidance ajustado según el estilo
-    
-    Args:
-        prompt: Prompt de texto para la imagen
-        width: Ancho de la imagen
-        height: Alto de la imagen
-        steps: Número de pasos de generación
-        api_key: API key de Black Forest Labs
-        seed: Seed para reproducibilidad (opcional)
-        style: Estilo visual que afecta el valor de guidance
-    
-    Returns:
-        Imagen PIL o mensaje de error
+    Estado de cada etapa con la configuración actual: "fresh" (se
+    reutilizaría), "stale" (cambió alguna entrada o dependencia) o "missing"
     """
+    status: Dict[str, str] = {}
+    for stage in PIPELINE_STAGES:
+        entry = memo.get(stage.name)
+        if not entry:
+            status[stage.name] = "missing"
+            continue
+        deps_fresh = all(status[dep] == "fresh" for dep in stage.deps)
+        key = stage_fingerprint(stage, params, {dep: memo[dep]["version"] for dep in stage.deps}) if deps_fresh else None
+        status[stage.name] = "fresh" if key == entry["key"] else "stale"
+    return status
+
+
+def publish_pipeline_outputs(task: GenerationTask, outputs: Dict[str, Optional[Dict[str, Any]]],
+                             base_content: Dict[str, Any]) -> Dict[str, Any]:
+    """Pasa las salidas de las etapas al formato de session_state y las publica"""
+    content = dict(base_content)
+    if outputs.get("text"):
+        content.update(outputs["text"])
+        content["text_metadata"] = dict(outputs["text"]["text_metadata"], timestamp=content.get("text_metadata", {}).get("timestamp") or int(time.time()))
+    if outputs.get("analysis"):
+        task.publish(character_analysis=outputs["analysis"]["character_analysis"])
+    if outputs.get("images"):
+        images = outputs["images"]
+        for field in ("image", "image_obj", "image_metadata"):
+            if images[field] is None:
+                content.pop(field, None)
+            else:
+                content[field] = images[field]
+        task.publish(character_images=images["character_images"], storyboard_files=images["storyboard_files"],
+                     sequence_generation_complete=bool(images["character_images"]))
+    if outputs.get("audio"):
+        content.update(outputs["audio"])
+    if outputs.get("languages"):
+        content["language_variants"] = outputs["languages"]["language_variants"]
+    task.publish(generated_content=content)
+    return content
+
+
+def run_pipeline(task: GenerationTask) -> None:
+    """
+    Ejecuta el grafo de etapas recalculando solo lo que cambió
+
+    El memo (stage_memo en session_state) guarda por etapa su clave (ver
+    stage_fingerprint), la versión y la salida. Una etapa cuya clave coincide
+    se reutiliza sin llamar a ninguna API; las demás se ejecutan en cuanto
+    terminan sus dependencias, en paralelo entre sí (audio e idiomas no
+    esperan a las imágenes). Cada etapa tiene su parte del plazo: la
+    generación menos lo que el historial estima para el camino más largo de
+    etapas que aún dependen de ella.
+
+    Parámetros de la tarea además de la configuración: stage_memo,
+    force_stages (se recalculan aunque no hayan cambiado) y stages (solo se
+    calculan estas; el resto se toma del memo tal cual).
+    """
+    p = task.params
+    token = task.cancel_token
+    profiler = start_task_profiler(task)
+    memo = dict(p.get("stage_memo") or {})
+    targets = set(p.get("stages") or [stage.name for stage in PIPELINE_STAGES])
+    force = set(p.get("force_stages") or [])
+    context = {"ledger": TokenLedger(p["input_token_budget"]), "timings": {}, "profiler": profiler, "memo": dict(memo)}
     
-    # Guidance más bajo = más libertad creativa, menos apegado al prompt
-    # Guidance más alto = más estricto con el prompt, fuerza el estilo
-    guidance_by_style = {
-        "photorealistic": 2.5,    # Default de Flux
-        "digital-art": 3.5,       # Más guidance para forzar estilo ilustrado
-        "cinematic": 2.5,         # Default - realista
-        "documentary": 2.5,       # Default - realista
-        "portrait": 2.5,          # Default - realista
-        "watercolor": 4.0,        # Alto para forzar estilo painted
-        "oil-painting": 4.0,      # Alto para forzar estilo painted
-        "anime": 4.5,             # Muy alto para forzar 2D anime
-        "sketch": 3.5,            # Alto para forzar estilo dibujado
-        "vintage": 2.5,           # Default - semi-realista
-        "minimalist": 3.0         # Moderado para estilo simple
-    }
-    
-    guidance_value = guidance_by_style.get(style, 2.5)
-    
-    headers = {
-        'accept': 'application/json',
-        'x-key': api_key,
-        'Content-Type': 'application/json',
-    }
+    history = load_render_history()
+    reserves: Dict[str, float] = {}
+    for stage in reversed(PIPELINE_STAGES):
+        reserves[stage.name] = max(
+            [child.estimate(p, history) + reserves[child.name] for child in PIPELINE_STAGES if stage.name in child.deps],
+            default=0.0
+        )
     
-    json_data = {
-        'prompt': prompt,
-        'width': int(width),
-        'height': int(height),
-        'steps': int(steps),
-        'prompt_upsampling': False,
-        'seed': seed if seed is not None else 42,
-        'guidance': guidance_value,  # Ajustado según el estilo
-        'safety_tolerance': 2,
-        'interval': 2,
-        'output_format': 'jpeg'
-    }
+    def run_stage(stage: Stage, deps: Dict[str, Any], stage_cancel: CancellationToken):
+        _ui_sink.target = task
+        try:
+            return stage.run(task, p, deps, stage_cancel, context)
+        finally:
+            _ui_sink.target = None
     
-    response = requests.post(
-        'https://api.bfl.ml/v1/flux-pro-1.1',
-        headers=headers,
-        json=json_data,
-    )
+    outputs: Dict[str, Optional[Dict[str, Any]]] = {}
+    versions: Dict[str, Optional[str]] = {}
+    reused: List[str] = []
+    running: Dict[Future, tuple] = {}
+    base_content = dict(p.get("generated_content") or {})
+    executor = ThreadPoolExecutor(max_workers=len(PIPELINE_STAGES))
+    try:
+        while len(outputs) < len(PIPELINE_STAGES):
+            started = {stage.name for stage, _, _ in running.values()}
+            for stage in PIPELINE_STAGES:
+                if stage.name in outputs or stage.name in started or not all(dep in outputs for dep in stage.deps):
+                    continue
+                if token.cancelled or any(outputs[dep] is None for dep in stage.deps):
+                    outputs[stage.name] = None
+                    continue
+                key = stage_fingerprint(stage, p, {dep: versions[dep] for dep in stage.deps})
+                entry = memo.get(stage.name)
+                if entry and stage.name not in force and (entry["key"] == key or stage.name not in targets):
+                    outputs[stage.name], versions[stage.name] = entry["output"], entry["version"]
+                    reused.append(stage.label)
+                    continue
+                if stage.name not in targets:
+                    outputs[stage.name] = None
+                    continue
+                stage_cancel = stage_token(token, reserves[stage.name])
+                running[executor.submit(run_stage, stage, {dep: outputs[dep] for dep in stage.deps}, stage_cancel)] = (stage, key, stage_cancel)
+                task.set_progress(len(outputs) / len(PIPELINE_STAGES), f"{stage.label}: en curso...")
+            
+            if not running:
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage, key, stage_cancel = running.pop(future)
+                try:
+                    output = future.result()
+                except Exception as e:
+                    task.error(f"⚠ Error en la etapa {stage.label}: {str(e)}")
+                    output = None
+                outputs[stage.name] = output
+                versions[stage.name] = output_version(output) if output is not None else None
+                # Lo que se cortó por cancelación o plazo se muestra, pero no se memoriza
+                if output is not None and not stage_cancel.cancelled:
+                    memo[stage.name] = {
+                        "key": key,
+                        "version": versions[stage.name],
+                        "output": output,
+                        "seconds": context["timings"].get(stage.name)
+                    }
+                elif stage_cancel.expired and not token.cancelled:
+                    task.warning(f"⏱️ {stage.label} agotó su parte del plazo: se conserva lo terminado.")
+                base_content = publish_pipeline_outputs(task, outputs, base_content)
+                task.publish(stage_memo=dict(memo))
+                task.set_progress(len(outputs) / len(PIPELINE_STAGES))
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
     
-    return process_flux_response(response, api_key)
+    if reused:
+        task.info(f"♻️ Etapas sin cambios reutilizadas: {', '.join(reused)}")
+    base_content['stage_timings'] = context["timings"]
+    base_content['token_usage'] = context["ledger"].report()
+    publish_pipeline_outputs(task, outputs, base_content)
+    task.publish(stage_memo=dict(memo))
+    if outputs.get("text"):
+        task.set_progress(1.0, "✅ ¡Contenido multimedia generado exitosamente!")
 
-# Función para generar imagen con Flux Ultra (basada en el archivo de referencia)  
-def generate_image_flux_ultra(prompt, aspect_ratio, api_key, seed=None):
-    """Genera imagen usando Flux Pro 1.1 Ultra"""
-    headers = {
-        'accept': 'application/json',
-        'x-key': api_key,
-        'Content-Type': 'application/json',
-    }
-    
-    json_data = {
-        'prompt': prompt,
-        'seed': seed if seed is not None else 42,  # Usar seed proporcionado o default
-        'aspect_ratio': aspect_ratio,
-        'safety_tolerance': 2,
-        'output_format': 'jpeg',
-        'raw': False
+
+def run_final_render(task: GenerationTask) -> None:
+    """Pasada final a calidad completa de los borradores aprobados"""
+    p = task.params
+    flux_config = {
+        "api_key": p["bfl_api_key"],
+        "model": p["flux_model"],
+        "width": p["width"],
+        "height": p["height"],
+        "steps": p["steps"],
+        "style": p["image_style"],
+        "concurrency": p["concurrency"],
+        "cancel_token": task.cancel_token,
+        "webhook": p["flux_webhook"],
+        "hedge": p["hedging"]
     }
-    
-    response = requests.post(
-        'https://api.bfl.ml/v1/flux-pro-1.1-ultra',
-        headers=headers,
-        json=json_data,
-    )
-    
-    return process_flux_response(response, api_key)
+    task.set_progress(0.0, f"🎬 Renderizando {len(p['approved'])} escenas a calidad completa...")
+    final_results = render_final_scenes(p["character_images"], p["approved"], flux_config, task)
+    for error_msg in final_results["errors"]:
+        task.error(error_msg)
+    task.publish(stage_memo=update_stage_output(p["stage_memo"], "images", character_images=final_results["character_cards"]))
+    if final_results["rendered"] and not task.cancelled:
+        task.publish(notice=("success", f"🎉 {final_results['rendered']} escenas renderizadas a calidad completa"))
 
-# Función para procesar respuesta de Flux (basada en el archivo de referencia)
-def process_flux_response(response, api_key):
-    """Procesa la respuesta de Flux y hace polling hasta obtener la imagen"""
-    if response.status_code != 200:
-        return f"Error: {response.status_code} {response.text}"
-    
-    request = response.json()
-    request_id = request.get("id")
-    if not request_id:
-        return "No se pudo obtener el ID de la solicitud."
 
-    with st.spinner('Generando imagen con Flux...'):
-        max_attempts = 60  # 5 minutos máximo
-        for attempt in range(max_attempts):
-            time.sleep(5)  # Esperar 5 segundos entre consultas
-            
-            result_response = requests.get(
-                'https://api.bfl.ml/v1/get_result',
-                headers={
-                    'accept': 'application/json',
-                    'x-key': api_key,
-                },
-                params={
-                    'id': request_id,
-                },
-            )
-            
-            if result_response.status_code != 200:
-                return f"Error: {result_response.status_code} {result_response.text}"
-            
-            result = result_response.json()
-            status = result.get("status")
-            
-            if status == "Ready":
-                image_url = result['result'].get('sample')
-                if not image_url:
-                    return "No se encontró URL de imagen en el resultado."
-                
-                image_response = requests.get(image_url)
-                if image_response.status_code != 200:
-                    return f"Error al obtener la imagen: {image_response.status_code}"
-                
-                image = Image.open(BytesIO(image_response.content))
-                jpg_image = image.convert("RGB")
-                return jpg_image
-                
-            elif status == "Failed":
-                return "La generación de la imagen falló."
-            elif status == "Pending":
-                # Mostrar progreso
-                st.info(f"Procesando... Intento {attempt + 1}/{max_attempts}")
-                pass
-            else:
-                return f"Estado inesperado: {status}"
-        
-        return "Timeout: La generación tomó demasiado tiempo."
-# Función principal para generar imagen con Flux (MEJORADA CON SOPORTE PARA SECUENCIAS)
-def generate_image_flux(text_content: str, content_type: str, api_key: str, model: str, width: int, height: int, steps: int, style: str = "photorealistic", custom_prompt: str = None, claude_api_key: str = None, claude_model: str = None, character_seed: int = None) -> tuple[Optional[Image.Image], str]:
-    """Genera imagen usando Flux con prompt inteligente generado por Claude"""
-    try:
-        # Determinar qué prompt usar
-        if custom_prompt and custom_prompt.strip():
-            # Usar el prompt personalizado del usuario (ya en inglés)
-            visual_prompt = custom_prompt.strip()
-            final_prompt = optimize_prompt_for_flux(visual_prompt, style)
-            st.info(f"🎨 Usando prompt personalizado para la imagen")
-            prompt_source = "personalizado"
-        else:
-            # Generar prompt automáticamente usando Claude
-            st.info(f"🤖 Analizando contenido con Claude para generar prompt visual...")
-            
-            if not claude_api_key:
-                # Fallback al método anterior si no hay API de Claude
-                content_preview = ' '.join(text_content.split()[:80])
-                visual_prompt = f"A realistic scene representing: {content_preview}. Real world setting, natural environment, authentic details"
-                st.warning("⚠️ Usando método básico (falta Claude API key para análisis inteligente)")
-                prompt_source = "básico"
-            else:
-                # Usar Claude para generar prompt inteligente
-                visual_prompt = generate_visual_prompt_with_claude(
-                    text_content, content_type, style, claude_api_key, claude_model
-                )
-                
-                if visual_prompt:
-                    st.success(f"✅ Claude analizó el {content_type} y generó prompt visual optimizado")
-                    prompt_source = "inteligente"
-                else:
-                    # Fallback si Claude falla
-                    content_preview = ' '.join(text_content.split()[:80])
-                    visual_prompt = f"A realistic scene representing: {content_preview}. Real world setting, natural environment, authentic details"
-                    st.warning("⚠️ Usando método básico (error en análisis de Claude)")
-                    prompt_source = "básico"
-            
-            final_prompt = optimize_prompt_for_flux(visual_prompt, style)
-        
-        # Mostrar información del prompt generado
-        with st.expander(f"🔍 Prompt generado ({prompt_source})"):
-            st.code(final_prompt, language="text")
-            if prompt_source == "inteligente":
-                st.success("🧠 Prompt generado por Claude analizando todo el contenido")
-            elif prompt_source == "personalizado":
-                st.info("👤 Prompt personalizado proporcionado por el usuario")
-            else:
-                st.warning("⚙️ Prompt básico (primeras palabras del contenido)")
-        
-        # Generar imagen según el modelo con seed opcional
-        if model == "flux-pro-1.1-ultra":
-            # Usar Ultra con aspect ratio
-            aspect_ratio = f"{width}:{height}" if width == height else "16:9"
-            result = generate_image_flux_ultra(final_prompt, aspect_ratio, api_key, character_seed)
-        else:
-            # Usar Pro normal
-            result = generate_image_flux_pro(final_prompt, width, height, steps, api_key, character_seed, style)
-        
-        if isinstance(result, Image.Image):
-            return result, final_prompt
-        else:
-            st.error(f"Error en Flux: {result}")
-            return None, final_prompt
-            
-    except Exception as e:
-        st.error(f"Error en la generación de imagen con Flux: {str(e)}")
-        import traceback
-        st.error(f"Traceback: {traceback.format_exc()}")
-        return None, ""
+def run_image_rerender(task: GenerationTask) -> None:
+    """Renderiza de nuevo una imagen que se reutilizó del índice (mismo prompt, seed nuevo)"""
+    p = task.params
+    content = dict(p["generated_content"])
+    metadata = dict(content["image_metadata"])
+    metadata.pop("reused", None)
+    seed = random.randint(0, 2**31 - 1)
+    task.set_progress(0.1, "🎨 Renderizando una imagen nueva...")
+    render_start = time.perf_counter()
+    if metadata["model"] == "flux-pro-1.1-ultra":
+        aspect_ratio = f"{metadata['width']}:{metadata['height']}" if metadata["width"] == metadata["height"] else "16:9"
+        result = generate_image_flux_ultra(metadata["used_prompt"], aspect_ratio, p["bfl_api_key"], seed,
+                                           show_progress=False, cancel_token=task.cancel_token, webhook=p["flux_webhook"],
+                                           hedge=p["hedging"])
+    else:
+        result = generate_image_flux_pro(metadata["used_prompt"], metadata["width"], metadata["height"], metadata["steps"],
+                                         p["bfl_api_key"], seed, metadata["style"],
+                                         show_progress=False, cancel_token=task.cancel_token, webhook=p["flux_webhook"],
+                                         hedge=p["hedging"])
+    if not isinstance(result, Image.Image):
+        if result not in STOP_MESSAGES:
+            task.error(f"Error en Flux: {result}")
+        return
+    record_render_sample("image", time.perf_counter() - render_start, model=metadata["model"], steps=metadata["steps"],
+                         width=metadata["width"], height=metadata["height"])
+    img_buffer = io.BytesIO()
+    result.save(img_buffer, format="PNG", quality=95)
+    content["image"] = img_buffer.getvalue()
+    content["image_obj"] = result
+    metadata["timestamp"] = int(time.time())
+    content["image_metadata"] = metadata
+    index_rendered_image(content["image"], metadata["used_prompt"], metadata["style"], seed, metadata["model"],
+                         metadata["steps"], metadata["width"], metadata["height"], p["bfl_api_key"], kind="image")
+    memo = update_stage_output(p["stage_memo"], "images", image=content["image"], image_obj=result, image_metadata=metadata)
+    task.publish(generated_content=content, stage_memo=memo, notice=("success", "🎨 Imagen nueva renderizada"))
 
-# NUEVA FUNCIÓN: Generar secuencia de imágenes con personajes consistentes
-def generate_character_sequence(text_content: str, content_type: str, character_analysis: Dict[str, Any], flux_config: Dict[str, Any]) -> Dict[str, Any]:
-    """Genera múltiples imágenes con personajes consistentes usando seeds variables por escena"""
+
+def run_text_renarration(task: GenerationTask) -> None:
+    """Guarda el texto editado y vuelve a narrarlo (con la caché, solo las frases cambiadas)"""
+    p = task.params
+    content = dict(p["generated_content"])
+    text = p["edited_text"]
+    task.set_progress(0.1, "🗣️ Narrando de nuevo el texto editado...")
+    stage_start = time.perf_counter()
+    dialogue_voices = {}
+    info = None
+    if p["dialogue_voices"] and p["content_type"] == "diálogo situacional":
+        audio, dialogue_voices = generate_dialogue_audio(
+            text, p["voice_model"], p["openai_api_key"], p["hedging"], task.cancel_token, p["tts_sentence_cache"]
+        )
+    elif p["tts_sentence_cache"]:
+        audio, error, info = request_sentence_speech(text, p["voice_model"], p["openai_api_key"], p["hedging"], task.cancel_token)
+        if error and error not in STOP_MESSAGES:
+            task.error(error)
+    else:
+        audio = generate_audio(text, p["voice_model"], p["openai_api_key"], p["hedging"], task.cancel_token)
+    if not audio:
+        return
     
-    sequence_results = {
-        "success": True,
-        "character_cards": [],
-        "total_images": 0,
-        "errors": []
+    content["text"] = text
+    content["text_metadata"] = dict(
+        content.get("text_metadata", {}),
+        word_count=len(text.split()),
+        char_count=len(text),
+        timestamp=int(time.time())
+    )
+    content["audio"] = audio
+    content["audio_metadata"] = {
+        'voice': p["voice_model"],
+        'size_kb': len(audio) / 1024,
+        'timestamp': int(time.time())
     }
+    if dialogue_voices:
+        content["audio_metadata"]["dialogue_voices"] = dialogue_voices
+    seconds = time.perf_counter() - stage_start
     
-    st.info("🎭 Iniciando generación de secuencia de personajes...")
-    
-    # Crear progress bar para toda la secuencia
-    total_scenes = sum(len(char["suggested_scenes"]) for char in character_analysis["characters"])
-    progress_bar = st.progress(0)
-    scene_counter = 0
-    
-    for i, character in enumerate(character_analysis["characters"]):
-        st.subheader(f"👤 Personaje {i+1}: {character['name']}")
-        
-        # Generar seed base para este personaje (sin escena específica)
-        base_character_seed = generate_character_seed(character["name"])
-        
-        # Información del personaje
-        with st.expander(f"📋 Character Card: {character['name']}"):
-            st.write(f"**Tipo:** {character['type']}")
-            st.write(f"**Descripción:** {character['physical_description']}")
-            st.write(f"**Características clave:** {', '.join(character['key_features'])}")
-            st.write(f"**Seed base:** {base_character_seed}")
-        
-        character_card = {
-            "name": character["name"],
-            "type": character["type"],
-            "description": character["physical_description"],
-            "seed": base_character_seed,  # Seed base para referencia
-            "images": []
-        }
-        
-        # Generar imagen para cada escena del personaje
-        for j, scene in enumerate(character["suggested_scenes"]):
-            scene_counter += 1
-            progress_bar.progress(scene_counter / total_scenes)
-            
-            st.write(f"🎬 Escena {j+1}: {scene['action']}")
-            
-            # Generar seed específico para esta escena CON offset de estilo
-            character_seed = generate_character_seed(
-                character["name"],
-                scene["action"],
-                j,  # scene_index
-                flux_config["style"]  # Pasar el estilo para aplicar offset
-            )
+    # El texto editado es una versión nueva: el audio queda al día con ella y
+    # la imagen, el análisis y los idiomas, desactualizados
+    memo = update_stage_output(p["stage_memo"], "text", text=text, text_metadata={
+        'word_count': len(text.split()),
+        'char_count': len(text),
+        'content_type': p["content_type"]
+    })
+    memo = memorize_stage_output(memo, "audio", p, {"audio": audio, "audio_metadata": content["audio_metadata"]}, seconds)
+    task.publish(stage_memo=memo)
+    if info:
+        notice = f"🔁 Texto narrado de nuevo en {seconds:.1f} s: {info['cached']} de {info['sentences']} frases reutilizadas"
+    else:
+        notice = f"🔁 Texto narrado de nuevo en {seconds:.1f} s"
+    task.publish(generated_content=content, notice=("success", notice))
 
-            # Crear prompt específico para esta escena
-            scene_prompt = create_character_prompt(character, scene, flux_config["style"])
 
-            # Mostrar el prompt que se va a usar
-            with st.expander(f"🔍 Prompt para {scene['action']} (Seed: {character_seed})"):
-                st.code(scene_prompt, language="text")
+# Barrido de estilos × seeds sobre un mismo prompt
+STYLE_SWEEP_MAX_SEEDS = 4
+# Celdas renderizadas que se guardan en la sesión para reutilizarlas y promoverlas
+STYLE_SWEEP_MAX_CACHED = 48
 
-            # Generar imagen con seed y guidance ajustados por estilo
-            try:
-                if flux_config["model"] == "flux-pro-1.1-ultra":
-                    aspect_ratio = f"{flux_config['width']}:{flux_config['height']}" if flux_config['width'] == flux_config['height'] else "16:9"
-                    image_result = generate_image_flux_ultra(
-                    scene_prompt, 
-                    aspect_ratio, 
-                    flux_config["api_key"], 
-                    character_seed
-                )
-                else:
-                    image_result = generate_image_flux_pro(
-                        scene_prompt, 
-                        flux_config["width"], 
-                        flux_config["height"], 
-                        flux_config["steps"], 
-                        flux_config["api_key"], 
-                        character_seed,
-                        flux_config["style"]  # Pasar estilo para guidance ajustado
-                )
-                
-                if isinstance(image_result, Image.Image):
-                    # Guardar imagen en session state
+
+def style_sweep_prompt(base_prompt: str, style: str) -> str:
+    """Prompt de una celda: el contenido sin menciones de estilo, envuelto en el estilo de la celda"""
+    return f"{get_style_prefix(style)}, {strip_style_keywords(base_prompt)}, {get_style_suffix(style)}"
+
+
+def style_sweep_cell_key(prompt: str, style: str, seed: int, model: str, width: int, height: int, steps: int) -> str:
+    """Huella de una celda: con el mismo prompt, estilo, seed y formato el render sería el mismo"""
+    payload = json.dumps([prompt, style, seed, model, int(width), int(height), int(steps)], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+def plan_style_sweep(base_prompt: str, styles: List[str], seed_count: int, model: str, width: int, height: int,
+                     steps: int) -> List[Dict[str, Any]]:
+    """
+    Celdas del barrido: una fila por estilo y una columna por seed
+
+    Los seeds salen de generate_character_seed con el prompt en lugar del
+    personaje, así que llevan el offset del estilo (get_style_seed_offset) y
+    se repiten al barrer otra vez el mismo prompt. El guidance de cada estilo
+    lo pone generate_image_flux_pro.
+    """
+    cells = []
+    for row, style in enumerate(styles):
+        prompt = style_sweep_prompt(base_prompt, style)
+        for column in range(seed_count):
+            seed = generate_character_seed(base_prompt, "", column, style)
+            cells.append({
+                "position": (row, column),
+                "style": style,
+                "seed": seed,
+                "prompt": prompt,
+                "key": style_sweep_cell_key(prompt, style, seed, model, width, height, steps)
+            })
+    return cells
+
+
+def run_style_sweep(task: GenerationTask) -> None:
+    """
+    Renderiza la cuadrícula estilos × seeds en paralelo, sin pasar de los
+    renders simultáneos de Flux, y muestra cada celda en cuanto termina.
+    Las celdas que ya están en la sesión no se vuelven a renderizar.
+    """
+    p = task.params
+    cached = dict((p["style_sweep"] or {}).get("cells", {}))
+    cells = plan_style_sweep(p["sweep_prompt"], p["sweep_styles"], p["sweep_seeds"],
+                             p["flux_model"], p["width"], p["height"], p["steps"])
+    pending = []
+    for cell in cells:
+        task.add_scene(cell["position"], cell["style"], cell["seed"])
+        if cell["key"] in cached:
+            task.scene_done(cell["position"], Image.open(BytesIO(cached[cell["key"]]["image_bytes"])))
+        else:
+            pending.append(cell)
+    
+    flux_config = {
+        "api_key": p["bfl_api_key"],
+        "model": p["flux_model"],
+        "width": p["width"],
+        "height": p["height"],
+        "steps": p["steps"],
+        "cancel_token": task.cancel_token,
+        "webhook": p["flux_webhook"],
+        "hedge": p["hedging"]
+    }
+    rendered = 0
+    task.set_progress(0.0, f"🎛️ Renderizando {len(pending)} de {len(cells)} celdas del barrido...")
+    if pending:
+        with ThreadPoolExecutor(max_workers=min(max(1, int(p["concurrency"])), len(pending))) as executor:
+            futures = {
+                executor.submit(render_scene_image, cell["prompt"], cell["seed"], dict(flux_config, style=cell["style"])): cell
+                for cell in pending
+            }
+            for done, future in enumerate(as_completed(futures), start=1):
+                cell = futures[future]
+                result = future.result()
+                if isinstance(result, Image.Image):
                     img_buffer = io.BytesIO()
-                    image_result.save(img_buffer, format="PNG", quality=95)
-                    img_bytes = img_buffer.getvalue()
-                    
-                    # Metadata de la imagen
-                    image_data = {
-                        "scene": scene["action"],
-                        "prompt": scene_prompt,
-                        "seed": character_seed,  # Usar el seed específico de la escena
-                        "image_bytes": img_bytes,
-                        "image_obj": image_result,
-                        "timestamp": int(time.time()),
-                        "character_name": character["name"]
+                    result.save(img_buffer, format="PNG")
+                    cached[cell["key"]] = {
+                        "image_bytes": img_buffer.getvalue(),
+                        "style": cell["style"],
+                        "seed": cell["seed"],
+                        "prompt": cell["prompt"],
+                        "model": p["flux_model"],
+                        "width": p["width"],
+                        "height": p["height"],
+                        "steps": p["steps"],
+                        "timestamp": int(time.time())
                     }
-                    
-                    character_card["images"].append(image_data)
-                    sequence_results["total_images"] += 1
-                    
-                    # Mostrar imagen generada
-                    st.image(image_result, caption=f"{character['name']} - {scene['action']}")
-                    st.success(f"✅ Imagen generada con seed {character_seed}")
-                    
+                    index_rendered_image(img_buffer.getvalue(), cell["prompt"], cell["style"], cell["seed"],
+                                         p["flux_model"], p["steps"], p["width"], p["height"], p["bfl_api_key"], kind="sweep")
+                    task.scene_done(cell["position"], result)
+                    rendered += 1
                 else:
-                    error_msg = f"Error generando imagen para {character['name']} - {scene['action']}: {image_result}"
-                    st.error(error_msg)
-                    sequence_results["errors"].append(error_msg)
-                    
-            except Exception as e:
-                error_msg = f"Excepción generando imagen para {character['name']} - {scene['action']}: {str(e)}"
-                st.error(error_msg)
-                sequence_results["errors"].append(error_msg)
-        
-        sequence_results["character_cards"].append(character_card)
+                    task.scene_failed(cell["position"], str(result), cancelled=result in STOP_MESSAGES)
+                    if result not in STOP_MESSAGES:
+                        task.error(f"❌ {cell['style']} (seed {cell['seed']}): {result}")
+                task.set_progress(done / len(pending))
+    
+    # Se conservan las celdas de este barrido y, si cabe, las más recientes de los anteriores
+    grid_keys = {cell["key"] for cell in cells}
+    older = sorted((key for key in cached if key not in grid_keys), key=lambda key: cached[key]["timestamp"], reverse=True)
+    keep = grid_keys | set(older[:max(0, STYLE_SWEEP_MAX_CACHED - len(grid_keys))])
+    task.publish(style_sweep={
+        "prompt": p["sweep_prompt"],
+        "styles": list(p["sweep_styles"]),
+        "seeds": p["sweep_seeds"],
+        "grid": [cell["key"] for cell in cells],
+        "cells": {key: entry for key, entry in cached.items() if key in keep}
+    })
+    if not task.cancelled:
+        task.publish(notice=("success", f"🎛️ Barrido listo: {rendered} celdas renderizadas, "
+                                       f"{len(cells) - len(pending)} reutilizadas"))
+
+
+def promote_sweep_cell(cell: Dict[str, Any]) -> None:
+    """Usa una celda del barrido como imagen final, sin volver a renderizarla"""
+    content = dict(st.session_state.generated_content)
+    metadata = dict(content.get("image_metadata") or {})
+    metadata.pop("reused", None)
+    metadata.update(
+        style=cell["style"],
+        seed=cell["seed"],
+        used_prompt=cell["prompt"],
+        model=cell["model"],
+        width=cell["width"],
+        height=cell["height"],
+        steps=cell["steps"],
+        timestamp=int(time.time())
+    )
+    image = Image.open(BytesIO(cell["image_bytes"])).convert("RGB")
+    content.update(image=cell["image_bytes"], image_obj=image, image_metadata=metadata)
+    st.session_state.generated_content = content
+    st.session_state.stage_memo = update_stage_output(
+        st.session_state.stage_memo, "images", image=cell["image_bytes"], image_obj=image, image_metadata=metadata
+    )
+
+
+def start_generation_task(target, params: Dict[str, Any]) -> GenerationTask:
+    """Arranca una tarea en segundo plano y la deja en la sesión"""
+    task = GenerationTask(target, params)
+    st.session_state.generation_task = task
+    task.start()
+    return task
+
+
+def apply_task_results(task: GenerationTask) -> None:
+    """Pasa a session_state lo que publicó la tarea (en el hilo del script)"""
+    snapshot = task.snapshot()
+    for field, value in snapshot["result"].items():
+        if field in TASK_RESULT_FIELDS:
+            st.session_state[field] = dict(value) if isinstance(value, dict) else value
+    if st.session_state.character_images:
+        st.session_state.sequence_generation_complete = True
+    if st.session_state.generated_content.get("text"):
+        st.session_state.generation_complete = True
     
-    progress_bar.progress(1.0)
+    # El perfil de memoria sigue con las etapas de la ejecución que pinta los resultados
+    st.session_state.memory_profiler_handoff = task.profiler
     
-    if sequence_results["total_images"] > 0:
-        st.success(f"🎉 Secuencia completada: {sequence_results['total_images']} imágenes generadas")
-        
-        # Mostrar resumen por personaje
-        for card in sequence_results["character_cards"]:
-            if card["images"]:
-                st.write(f"**{card['name']}**: {len(card['images'])} imágenes con seed {card['seed']}")
+    problems = [(level, message) for level, message in snapshot["messages"] if level in ("warning", "error")]
+    if snapshot["result"].get("notice"):
+        notice = snapshot["result"]["notice"]
+    elif snapshot["cancelled"]:
+        kept_scenes = sum(len(card["images"]) for card in st.session_state.character_images)
+        kept_parts = []
+        if st.session_state.generated_content.get("text"):
+            kept_parts.append("el texto")
+        if st.session_state.generated_content.get("image"):
+            kept_parts.append("la imagen")
+        if kept_scenes:
+            kept_parts.append(f"{kept_scenes} escenas ya renderizadas")
+        if st.session_state.generated_content.get("audio"):
+            kept_parts.append("el audio")
+        kept = f"Se conservan {', '.join(kept_parts)}." if kept_parts else "No había nada terminado que conservar."
+        headline = "⏱️ Se agotó el plazo de la generación." if snapshot["expired"] else "⏹️ Generación cancelada."
+        notice = ("warning", f"{headline} {kept}")
+    elif not st.session_state.generation_complete:
+        notice = ("error", "⚠ Generación fallida")
+    elif st.session_state.character_sequence_mode and st.session_state.sequence_generation_complete:
+        notice = ("success", "🎉 **¡Generación con secuencia completada!** Tu contenido multimedia con personajes consistentes está listo.")
     else:
-        st.error("❌ No se pudo generar ninguna imagen de la secuencia")
-        sequence_results["success"] = False
+        notice = ("success", "🎉 **¡Generación completada!** Tu contenido multimedia está listo.")
+    st.session_state.generation_notice = {"notice": notice, "problems": problems, "seconds": snapshot["elapsed"]}
+    st.session_state.generation_task = None
+
+
+@st.fragment(run_every=GENERATION_REFRESH_SECONDS)
+def render_generation_progress() -> None:
+    """Progreso de la tarea en curso; se refresca solo, sin volver a ejecutar todo el script"""
+    task = st.session_state.generation_task
+    if task is None:
+        return
+    snapshot = task.snapshot()
+    if snapshot["done"]:
+        apply_task_results(task)
+        st.rerun()
     
-    return sequence_results
+    st.progress(snapshot["progress"], text=snapshot["status"])
+    st.caption(f"⏱️ {snapshot['elapsed']:.0f} s • la interfaz sigue disponible mientras se genera")
+    for level, message in snapshot["messages"][-6:]:
+        getattr(st, level)(message)
+    
+    # Imágenes del índice que se pueden usar en lugar de renderizar
+    offer = snapshot["offer"]
+    if offer:
+        st.warning(offer["message"])
+        preview_columns = st.columns(4)
+        for index, (thumbnail, caption) in enumerate(offer["previews"]):
+            with preview_columns[index % 4]:
+                st.image(thumbnail, caption=caption)
+        reuse_col, render_col = st.columns(2)
+        if reuse_col.button("♻️ Usar estas imágenes", key=f"reuse_offer_accept_{offer['id']}", use_container_width=True):
+            task.answer_offer(True)
+        if render_col.button("🎨 Renderizar nuevas", key=f"reuse_offer_reject_{offer['id']}", use_container_width=True):
+            task.answer_offer(False)
+    
+    if snapshot["scenes"]:
+        columns = st.columns(4)
+        for index, scene in enumerate(snapshot["scenes"]):
+            with columns[index % 4]:
+                if scene["state"] == "done":
+                    st.image(scene["thumbnail"], caption=f"{scene['label']} (seed {scene['seed']})")
+                elif scene["state"] == "pending":
+                    st.info(f"⏳ {scene['label']}")
+                elif scene["state"] == "cancelled":
+                    st.caption(f"⏹️ {scene['label']}")
+                else:
+                    st.error(f"❌ {scene['label']}")
+    
+    if snapshot["expired"]:
+        st.caption("⏱️ Plazo agotado: se cierran las solicitudes en curso y se conserva lo terminado...")
+    elif snapshot["cancelled"]:
+        st.caption("⏹️ Cancelando: se esperan las solicitudes que ya estaban en curso...")
+    elif st.button("⏹️ Cancelar generación", key="cancel_generation_task", use_container_width=True,
+                   help="Deja de enviar y de esperar solicitudes; se conserva lo ya terminado"):
+        task.cancel()
 
-# Función para generar audio con OpenAI TTS (mantenemos la misma)
-def generate_audio(text: str, voice: str, api_key: str) -> Optional[bytes]:
-    """Genera audio usando OpenAI Text-to-Speech"""
-    try:
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json"
-        }
-        
-        # Limpiar y preparar el texto para TTS
-        clean_text = text.replace('\n\n', '. ').replace('\n', ' ').strip()
-        if len(clean_text) > 4000:
-            clean_text = clean_text[:4000] + "..."
-        
-        data = {
-            "model": "tts-1-hd",  # Usar el modelo HD para mejor calidad
-            "input": clean_text,
-            "voice": voice,
-            "response_format": "mp3"
-        }
-        
-        response = requests.post(
-            "https://api.openai.com/v1/audio/speech",
-            headers=headers,
-            json=data,
-            timeout=120
-        )
-        
-        if response.status_code == 200:
-            return response.content
-        else:
-            st.error(f"Error generando audio: {response.status_code} - {response.text}")
-            return None
-            
-    except Exception as e:
-        st.error(f"Error en la generación de audio: {str(e)}")
-        return None
 # ===== INTERFAZ PRINCIPAL CON COLUMNAS CORREGIDAS =====
 # Crear las columnas PRIMERO, antes de definir el contenido
 col1, col2 = st.columns([2, 1])
@@ -1372,6 +6062,48 @@ with col2:
                     st.write(f"**{i+1}. {char['name']}** ({char['type']})")
                     st.caption(f"Escenas: {len(char.get('suggested_scenes', []))}")
     
+    # NUEVO: Plan de renderizado por plazo (antes de gastar en APIs)
+    render_plan = None
+    if deadline_planning:
+        render_history = load_render_history()
+        if st.session_state.character_sequence_mode:
+            if st.session_state.character_analysis:
+                planned_images = sum(len(char.get("suggested_scenes", [])) for char in st.session_state.character_analysis.get("characters", []))
+            else:
+                planned_images = estimate_character_count(render_history) * max_scenes_per_character
+            planned_stages = ["text", "analysis", "audio"]
+        else:
+            planned_images = 1
+            planned_stages = ["text", "audio"] if fast_visual_prompt else ["text", "visual_prompt", "audio"]
+        
+        if st.session_state.character_sequence_mode and draft_mode:
+            # En modo borrador lo que se planifica es la pasada rápida
+            draft_config = make_draft_flux_config({"model": flux_model, "steps": flux_steps, "width": image_width, "height": image_height})
+            plan_model, plan_steps, plan_width, plan_height = draft_config["model"], draft_config["steps"], draft_config["width"], draft_config["height"]
+        else:
+            plan_model, plan_steps, plan_width, plan_height = flux_model, flux_steps, image_width, image_height
+        
+        render_plan = plan_render(
+            planned_images, target_minutes * 60, plan_model, plan_steps, plan_width, plan_height,
+            flux_concurrency, render_history, planned_stages,
+            allow_step_reduction, allow_resolution_reduction
+        )
+        render_plan_summary(render_plan)
+        if not render_history:
+            st.caption("ℹ️ Estimación con valores por defecto: mejorará con cada generación")
+    
+    # Parámetros efectivos de Flux (el plan puede reducir pasos/resolución)
+    if render_plan:
+        effective_steps = render_plan["steps"]
+        effective_width = render_plan["width"]
+        effective_height = render_plan["height"]
+        effective_concurrency = render_plan["concurrency"]
+    else:
+        effective_steps = flux_steps
+        effective_width = image_width
+        effective_height = image_height
+        effective_concurrency = flux_concurrency
+    
     # Información sobre las nuevas tipologías
     with st.expander("🆕 Nuevas tipologías disponibles"):
         st.markdown("""
@@ -1394,11 +6126,13 @@ with col2:
         **🧠 Trivia cultural**: 6 preguntas de cultura general
         """)
     
-    # Botón principal
+    # Botón principal (desactivado mientras haya una generación en segundo plano)
+    task_running = st.session_state.generation_task is not None
     generate_button = st.button(
         "🎯 Generar Contenido Multimedia",
         type="primary",
-        use_container_width=True
+        use_container_width=True,
+        disabled=task_running
     )
     
     # NUEVO: Botón para modo secuencia
@@ -1407,6 +6141,7 @@ with col2:
             "🎬 Generar Solo Secuencia de Imágenes",
             type="secondary",
             use_container_width=True,
+            disabled=task_running,
             help="Genera solo las imágenes de personajes (requiere texto ya generado)"
         )
     else:
@@ -1476,197 +6211,136 @@ Ejemplos:
         height=120,
         help="Si especificas un prompt EN INGLÉS, este se usará en lugar del generado automáticamente por Claude"
     )
+    
+    # Trabajos masivos sin conexión (la mitad de coste por token)
+    with st.expander("📦 Trabajos por lotes (Message Batches API)"):
+        render_batch_panel(anthropic_api_key, claude_model, content_type, max_tokens_claude, max_scenes_per_character, input_token_budget)
+
+# Perfilador de memoria de la generación que acaba de terminar (solo si se
+# activa): sigue registrando las etapas de esta ejecución, que pinta los resultados
+memory_profiler = st.session_state.pop("memory_profiler_handoff", None)
 
 # ===== PROCESO DE GENERACIÓN PRINCIPAL (MEJORADO CON SOPORTE PARA SECUENCIAS) =====
+# La generación corre en segundo plano (GenerationTask); aquí solo se arranca
+# con una copia de la configuración actual de la barra lateral
+generation_settings = {
+    "anthropic_api_key": anthropic_api_key,
+    "bfl_api_key": bfl_api_key,
+    "openai_api_key": openai_api_key,
+    "claude_model": claude_model,
+    "max_tokens_claude": max_tokens_claude,
+    "input_token_budget": input_token_budget,
+    "flux_model": flux_model,
+    "width": effective_width,
+    "height": effective_height,
+    "steps": effective_steps,
+    "concurrency": effective_concurrency,
+    "image_style": image_style,
+    "draft_mode": draft_mode,
+    "storyboard_enabled": storyboard_enabled,
+    "max_scenes": max_scenes_per_character,
+    "chapter_analysis": chapter_analysis,
+    "memory_profiling": memory_profiling,
+    "reuse_threshold": reuse_threshold,
+    "flux_webhook": flux_webhook,
+    "hedging": hedging,
+    "dialogue_voices": dialogue_voices,
+    "tts_sentence_cache": tts_sentence_cache,
+    "deadline_seconds": generation_deadline_minutes * 60,
+    "stage_memo": st.session_state.stage_memo
+}
+# Entradas de todas las etapas del pipeline con la configuración actual
+pipeline_settings = dict(
+    generation_settings,
+    user_prompt=user_prompt,
+    content_type=content_type,
+    image_prompt=image_prompt,
+    fast_visual_prompt=fast_visual_prompt,
+    voice_model=voice_model,
+    target_languages=list(target_languages),
+    sequence_mode=st.session_state.character_sequence_mode
+)
+
 if generate_button and user_prompt:
     if not apis_ready:
         st.error("⚠ Por favor, proporciona todas las claves de API necesarias.")
     else:
-        # Limpiar contenido anterior
+        # Limpiar contenido anterior (las etapas sin cambios vuelven del memo;
+        # el storyboard lo borra la etapa de imágenes si se rehace)
         st.session_state.generated_content = {}
         st.session_state.generation_complete = False
         st.session_state.character_analysis = None
         st.session_state.character_images = []
         st.session_state.sequence_generation_complete = False
+        st.session_state.storyboard_files = None
         
-        # Progress bar mejorada
-        progress_bar = st.progress(0)
-        status_text = st.empty()
-        
-        try:
-            # Paso 1: Generar texto con Claude Sonnet 4
-            status_text.text(f"🧠 Generando {content_type} con Claude Sonnet 4...")
-            progress_bar.progress(15)
-            
-            generated_text = generate_text_claude(
-                user_prompt, content_type, anthropic_api_key, 
-                claude_model, max_tokens_claude
-            )
-            
-            if generated_text:
-                # Guardar en session state
-                st.session_state.generated_content['text'] = generated_text
-                st.session_state.generated_content['text_metadata'] = {
-                    'word_count': len(generated_text.split()),
-                    'char_count': len(generated_text),
-                    'content_type': content_type,
-                    'timestamp': int(time.time())
-                }
-                
-                progress_bar.progress(30)
-                
-                # Paso 1.5: NUEVO - Análisis de personajes si está en modo secuencia
-                if st.session_state.character_sequence_mode:
-                    status_text.text("🎭 Analizando personajes para secuencia...")
-                    progress_bar.progress(35)
-                    
-                    character_analysis = analyze_characters_with_claude(
-                        generated_text, content_type, anthropic_api_key, claude_model, max_scenes_per_character
-                    )
-                    
-                    if character_analysis.get("has_characters", False):
-                        st.session_state.character_analysis = character_analysis
-                        st.success(f"✅ Detectados {len(character_analysis['characters'])} personajes para secuencia")
-                    else:
-                        st.warning("⚠️ No se detectaron personajes. Se generará imagen única.")
-                        st.session_state.character_sequence_mode = False
-                
-                # Paso 2: Generar imagen(es)
-                if st.session_state.character_sequence_mode and st.session_state.character_analysis:
-                    # Modo secuencia: generar múltiples imágenes
-                    status_text.text("🎬 Generando secuencia de imágenes con personajes...")
-                    progress_bar.progress(40)
-                    
-                    flux_config = {
-                        "api_key": bfl_api_key,
-                        "model": flux_model,
-                        "width": image_width,
-                        "height": image_height,
-                        "steps": flux_steps,
-                        "style": image_style
-                    }
-                    
-                    sequence_results = generate_character_sequence(
-                        generated_text, content_type, st.session_state.character_analysis, flux_config
-                    )
-                    
-                    if sequence_results["success"]:
-                        st.session_state.character_images = sequence_results["character_cards"]
-                        st.session_state.sequence_generation_complete = True
-                        progress_bar.progress(70)
-                    else:
-                        st.error("❌ Error generando secuencia de personajes")
-                        progress_bar.progress(40)
-                else:
-                    # Modo normal: generar imagen única
-                    status_text.text(f"🎨 Analizando {content_type} y generando imagen con Flux...")
-                    progress_bar.progress(40)
-                    
-                    generated_image, used_prompt = generate_image_flux(
-                        generated_text, content_type, bfl_api_key, flux_model,
-                        image_width, image_height, flux_steps, image_style, 
-                        image_prompt, anthropic_api_key, claude_model
-                    )
-                    
-                    if generated_image:
-                        # Guardar imagen en session state con información del prompt
-                        img_buffer = io.BytesIO()
-                        generated_image.save(img_buffer, format="PNG", quality=95)
-                        img_bytes = img_buffer.getvalue()
-                        
-                        st.session_state.generated_content['image'] = img_bytes
-                        st.session_state.generated_content['image_obj'] = generated_image
-                        st.session_state.generated_content['image_metadata'] = {
-                            'width': image_width,
-                            'height': image_height,
-                            'model': flux_model,
-                            'steps': flux_steps,
-                            'style': image_style,
-                            'custom_prompt': bool(image_prompt and image_prompt.strip()),
-                            'used_prompt': used_prompt,
-                            'prompt_intelligent': not bool(image_prompt and image_prompt.strip()),
-                            'timestamp': int(time.time())
-                        }
-                    
-                    progress_bar.progress(70)
-                
-                # Paso 3: Generar audio
-                status_text.text("🗣️ Generando narración en audio...")
-                progress_bar.progress(85)
-                
-                generated_audio = generate_audio(generated_text, voice_model, openai_api_key)
-                
-                if generated_audio:
-                    # Guardar audio en session state
-                    st.session_state.generated_content['audio'] = generated_audio
-                    st.session_state.generated_content['audio_metadata'] = {
-                        'voice': voice_model,
-                        'size_kb': len(generated_audio) / 1024,
-                        'timestamp': int(time.time())
-                    }
-                
-                # Marcar como completado
-                st.session_state.generation_complete = True
-                
-                # Completado
-                progress_bar.progress(100)
-                status_text.text("✅ ¡Contenido multimedia generado exitosamente!")
-                
-                # Balloons solo una vez
-                st.balloons()
-                if st.session_state.character_sequence_mode and st.session_state.sequence_generation_complete:
-                    st.success("🎉 **¡Generación con secuencia completada!** Tu contenido multimedia con personajes consistentes está listo.")
-                else:
-                    st.success("🎉 **¡Generación completada!** Tu contenido multimedia está listo.")
-                
-            else:
-                st.error("⚠ Error al generar el contenido de texto con Claude.")
-                
-        except Exception as e:
-            st.error(f"⚠ Error durante la generación: {str(e)}")
-            progress_bar.progress(0)
-            status_text.text("⚠ Generación fallida")
+        start_generation_task(run_pipeline, pipeline_settings)
 
 # NUEVO: Proceso para generar solo secuencia (si ya existe texto)
 if generate_sequence_button and st.session_state.generated_content.get('text'):
     if not bfl_api_key:
         st.error("⚠ Necesitas la API key de Black Forest Labs para generar imágenes.")
     else:
-        st.info("🎬 Generando solo secuencia de imágenes...")
-        
-        # Analizar personajes del texto existente
-        character_analysis = analyze_characters_with_claude(
-            st.session_state.generated_content['text'], 
-            st.session_state.generated_content['text_metadata']['content_type'],
-            anthropic_api_key, claude_model, max_scenes_per_character
-        )
-        
-        if character_analysis.get("has_characters", False):
-            st.session_state.character_analysis = character_analysis
-            
-            flux_config = {
-                "api_key": bfl_api_key,
-                "model": flux_model,
-                "width": image_width,
-                "height": image_height,
-                "steps": flux_steps,
-                "style": image_style
+        # Solo análisis e imágenes, sobre el texto que hay en pantalla (si
+        # vino de un lote, no está en el memo: entra como salida de "text")
+        stage_memo = st.session_state.stage_memo
+        if "text" not in stage_memo:
+            text_output = {
+                "text": st.session_state.generated_content["text"],
+                "text_metadata": st.session_state.generated_content["text_metadata"]
             }
-            
-            sequence_results = generate_character_sequence(
-                st.session_state.generated_content['text'],
-                st.session_state.generated_content['text_metadata']['content_type'],
-                character_analysis, flux_config
-            )
-            
-            if sequence_results["success"]:
-                st.session_state.character_images = sequence_results["character_cards"]
-                st.session_state.sequence_generation_complete = True
-                st.success("🎉 ¡Secuencia de personajes generada!")
+            stage_memo = dict(stage_memo, text={"key": None, "version": output_version(text_output), "output": text_output})
+        start_generation_task(run_pipeline, dict(
+            pipeline_settings,
+            stage_memo=stage_memo,
+            stages=["analysis", "images"],
+            sequence_mode=True,
+            generated_content=st.session_state.generated_content,
+            content_type=st.session_state.generated_content['text_metadata']['content_type']
+        ))
+
+# Generación en curso: su progreso se refresca solo y el resto de la
+# interfaz sigue respondiendo
+if st.session_state.generation_task is not None:
+    render_generation_progress()
+
+# Resumen de la última generación terminada (se muestra una sola vez)
+generation_notice = st.session_state.pop("generation_notice", None)
+if generation_notice:
+    for level, message in generation_notice["problems"]:
+        getattr(st, level)(message)
+    notice_level, notice_message = generation_notice["notice"]
+    getattr(st, notice_level)(notice_message)
+    st.caption(f"⏱️ Generación en segundo plano: {generation_notice['seconds']:.1f} s")
+    if notice_level == "success":
+        st.balloons()
+
+# Etapas memorizadas: qué se reutilizaría con la configuración actual y qué
+# se rehará; cada una se puede rehacer sola (y lo que depende de ella)
+if st.session_state.stage_memo and st.session_state.generation_task is None:
+    stage_status = pipeline_status(pipeline_settings, st.session_state.stage_memo)
+    stale_stages = [stage.label for stage in PIPELINE_STAGES if stage_status[stage.name] != "fresh"]
+    with st.expander(f"🧩 Etapas de la generación ({len(stale_stages)} por rehacer)" if stale_stages else "🧩 Etapas de la generación (al día)"):
+        for stage in PIPELINE_STAGES:
+            entry = st.session_state.stage_memo.get(stage.name)
+            col_stage, col_status, col_action = st.columns([2, 3, 1])
+            col_stage.markdown(f"**{stage.label}**")
+            if stage_status[stage.name] == "fresh":
+                seconds = entry.get("seconds")
+                col_status.caption("✅ Al día" + (f" • calculada en {seconds:.1f} s" if seconds else ""))
+            elif stage_status[stage.name] == "stale":
+                col_status.caption("🔄 Cambió su configuración o una etapa previa: se rehará al generar")
             else:
-                st.error("❌ Error generando secuencia")
-        else:
-            st.warning("⚠️ No se detectaron personajes en el texto para crear secuencia.")
+                col_status.caption("⬜ Sin resultado")
+            if col_action.button("🔁 Rehacer", key=f"rerun_stage_{stage.name}", disabled=not apis_ready or not user_prompt,
+                                 help="Recalcula esta etapa aunque no haya cambiado (y las que dependen de ella)"):
+                start_generation_task(run_pipeline, dict(
+                    pipeline_settings,
+                    force_stages=[stage.name],
+                    generated_content=st.session_state.generated_content
+                ))
+                st.rerun()
+
 # ===== MOSTRAR CONTENIDO GENERADO DESDE SESSION STATE (MEJORADO CON SECUENCIAS) =====
 if st.session_state.generation_complete and st.session_state.generated_content:
     # Contenedores para resultados
@@ -1715,6 +6389,25 @@ if st.session_state.generation_complete and st.session_state.generated_content:
             display_info = type_info.get(content_type_display, f"📊 {word_count} palabras • {char_count} caracteres")
             st.caption(display_info)
             
+            # Retoques del texto: con la caché de frases solo se narran las cambiadas
+            with st.expander("✏️ Editar texto y volver a narrar"):
+                edited_text = st.text_area(
+                    "Texto",
+                    value=st.session_state.generated_content['text'],
+                    height=250,
+                    key=f"edit_text_{metadata.get('timestamp', 0)}"
+                )
+                if st.button("🔁 Guardar y narrar de nuevo", key="renarrate_text",
+                             disabled=not openai_api_key or task_running or not edited_text.strip()):
+                    start_generation_task(run_text_renarration, dict(
+                        generation_settings,
+                        content_type=content_type_display,
+                        voice_model=voice_model,
+                        edited_text=edited_text,
+                        generated_content=st.session_state.generated_content
+                    ))
+                    st.rerun()
+            
             # Botón para descargar texto con key única
             text_timestamp = metadata.get('timestamp', int(time.time()))
             st.download_button(
@@ -1731,7 +6424,10 @@ if st.session_state.generation_complete and st.session_state.generated_content:
             st.header("🎭 Secuencia de Personajes Generada por Flux")
             
             total_images = sum(len(card["images"]) for card in st.session_state.character_images)
+            total_drafts = sum(1 for card in st.session_state.character_images for image_data in card["images"] if image_data.get("is_draft"))
             st.success(f"✅ Secuencia completada: {len(st.session_state.character_images)} personajes, {total_images} imágenes")
+            if total_drafts:
+                st.info(f"📝 {total_drafts} escenas en borrador: marca las que quieras conservar y renderízalas a calidad completa")
             
             # Mostrar imágenes por personaje
             for i, character_card in enumerate(st.session_state.character_images):
@@ -1745,10 +6441,33 @@ if st.session_state.generation_complete and st.session_state.generated_content:
                         with cols[j % 3]:
                             st.image(
                                 image_data["image_obj"], 
-                                caption=f"{image_data['scene']}",
+                                caption=f"{image_data['scene']}" + (" (borrador)" if image_data.get("is_draft") else ""),
                                 use_container_width=True
                             )
                             
+                            # Aprobación de borradores para la pasada final
+                            if image_data.get("is_draft"):
+                                st.checkbox("✅ Aprobar", key=f"approve_draft_{i}_{j}_{image_data['timestamp']}")
+                            
+                            # Escena tomada del índice: se puede pedir un render propio
+                            if image_data.get("reused"):
+                                st.caption(reuse_summary(image_data["reused"]))
+                                if st.button(
+                                    "🎨 Renderizar nueva",
+                                    key=f"rerender_scene_{i}_{j}_{image_data['timestamp']}",
+                                    disabled=not bfl_api_key or task_running
+                                ):
+                                    start_generation_task(run_final_render, dict(
+                                        generation_settings,
+                                        width=image_width,
+                                        height=image_height,
+                                        steps=flux_steps,
+                                        concurrency=flux_concurrency,
+                                        character_images=st.session_state.character_images,
+                                        approved=[(i, j)]
+                                    ))
+                                    st.rerun()
+                            
                             # Mostrar información de la imagen
                             with st.expander(f"📋 Info: {image_data['scene']}"):
                                 st.code(image_data["prompt"], language="text")
@@ -1765,23 +6484,101 @@ if st.session_state.generation_complete and st.session_state.generated_content:
                 else:
                     st.warning(f"No se generaron imágenes para {character_card['name']}")
             
+            # Pasada final: solo los borradores aprobados a calidad completa
+            if total_drafts:
+                approved_drafts = [
+                    (i, j)
+                    for i, character_card in enumerate(st.session_state.character_images)
+                    for j, image_data in enumerate(character_card["images"])
+                    if image_data.get("is_draft") and st.session_state.get(f"approve_draft_{i}_{j}_{image_data['timestamp']}")
+                ]
+                if st.button(
+                    f"🎬 Renderizar finales aprobados ({len(approved_drafts)})",
+                    type="primary",
+                    disabled=not approved_drafts or not bfl_api_key or task_running
+                ):
+                    # Calidad completa: sin las reducciones del plan por plazo
+                    start_generation_task(run_final_render, dict(
+                        generation_settings,
+                        width=image_width,
+                        height=image_height,
+                        steps=flux_steps,
+                        concurrency=flux_concurrency,
+                        character_images=st.session_state.character_images,
+                        approved=approved_drafts
+                    ))
+                    st.rerun()
+            
             # Botón para descargar todas las imágenes como ZIP
             if total_images > 0:
-                import zipfile
-                zip_buffer = io.BytesIO()
-                
-                with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-                    for character_card in st.session_state.character_images:
-                        for image_data in character_card["images"]:
-                            filename = f"{character_card['name']}_{image_data['scene'].replace(' ', '_')}.png"
-                            zip_file.writestr(filename, image_data["image_bytes"])
+                # El ZIP solo se monta cuando cambian las imágenes (no en cada rerun);
+                # los PNG ya están comprimidos, así que se guardan sin recomprimir
+                zip_signature = [
+                    (character_card["name"], image_data["scene"], image_data.get("is_draft", False), len(image_data["image_bytes"]))
+                    for character_card in st.session_state.character_images
+                    for image_data in character_card["images"]
+                ]
+                sequence_zip = st.session_state.get("sequence_zip")
+                if not sequence_zip or sequence_zip["signature"] != zip_signature:
+                    sequence_zip = {
+                        "signature": zip_signature,
+                        "data": codificador_exportacion.build_zip([
+                            (f"{character_card['name']}_{image_data['scene'].replace(' ', '_')}.png", image_data["image_bytes"])
+                            for character_card in st.session_state.character_images
+                            for image_data in character_card["images"]
+                        ]),
+                        "timestamp": int(time.time())
+                    }
+                    st.session_state.sequence_zip = sequence_zip
+                if memory_profiler:
+                    memory_profiler.checkpoint("zip")
                 
                 st.download_button(
                     label="📦 Descargar Todas las Imágenes (ZIP)",
-                    data=zip_buffer.getvalue(),
-                    file_name=f"secuencia_personajes_{int(time.time())}.zip",
+                    data=sequence_zip["data"],
+                    file_name=f"secuencia_personajes_{sequence_zip['timestamp']}.zip",
                     mime="application/zip",
-                    key=f"download_all_sequence_{int(time.time())}"
+                    key="download_all_sequence"
+                )
+                
+                # Storyboard paginado y hoja de contactos (escritos en disco)
+                storyboard_files = st.session_state.get("storyboard_files")
+                col_storyboard1, col_storyboard2, col_storyboard3 = st.columns(3)
+                with col_storyboard1:
+                    if st.button("🗂️ Regenerar storyboard", help="Vuelve a montar el PDF y la hoja de contactos con las imágenes actuales"):
+                        with st.spinner("Montando storyboard página a página..."):
+                            st.session_state.storyboard_files = build_storyboard_from_session(st.session_state.character_images)
+                        st.session_state.stage_memo = update_stage_output(
+                            st.session_state.stage_memo, "images", storyboard_files=st.session_state.storyboard_files
+                        )
+                        storyboard_files = st.session_state.storyboard_files
+                if storyboard_files and storyboard_files.get("pdf_path") and os.path.exists(storyboard_files["pdf_path"]):
+                    with col_storyboard2:
+                        with open(storyboard_files["pdf_path"], "rb") as pdf_file:
+                            st.download_button(
+                                label=f"📄 Storyboard PDF ({storyboard_files['pages']} págs.)",
+                                data=pdf_file,
+                                file_name="storyboard.pdf",
+                                mime="application/pdf",
+                                key="download_storyboard_pdf"
+                            )
+                    with col_storyboard3:
+                        with open(storyboard_files["contact_sheet_path"], "rb") as sheet_file:
+                            st.download_button(
+                                label="🖼️ Hoja de contactos",
+                                data=sheet_file,
+                                file_name="hoja_de_contactos.png",
+                                mime="image/png",
+                                key="download_contact_sheet"
+                            )
+                
+                render_export_panel(
+                    [
+                        (f"{character_card['name']}_{image_data['scene'].replace(' ', '_')}", image_data["image_bytes"])
+                        for character_card in st.session_state.character_images
+                        for image_data in character_card["images"]
+                    ],
+                    "secuencia"
                 )
     
     # Mostrar imagen única (modo normal)
@@ -1796,6 +6593,7 @@ if st.session_state.generation_complete and st.session_state.generated_content:
             style = metadata.get('style', 'N/A')
             custom_prompt_used = metadata.get('custom_prompt', False)
             intelligent_prompt = metadata.get('prompt_intelligent', False)
+            local_prompt = metadata.get('prompt_local', False)
             used_prompt = metadata.get('used_prompt', '')
             
             # Descripción mejorada con información del tipo de prompt
@@ -1805,6 +6603,9 @@ if st.session_state.generation_complete and st.session_state.generated_content:
             elif intelligent_prompt:
                 prompt_info = "Prompt inteligente por Claude"
                 prompt_color = "🔵"
+            elif local_prompt:
+                prompt_info = "Prompt local (modo rápido)"
+                prompt_color = "⚡"
             else:
                 prompt_info = "Prompt básico automático"
                 prompt_color = "🟡"
@@ -1816,6 +6617,16 @@ if st.session_state.generation_complete and st.session_state.generated_content:
                 caption=caption
             )
             
+            # Imagen tomada del índice: se puede pedir un render propio
+            if metadata.get('reused'):
+                st.info(reuse_summary(metadata['reused']))
+                if st.button("🎨 Renderizar una nueva", key="rerender_reused_image", disabled=not bfl_api_key or task_running):
+                    start_generation_task(run_image_rerender, dict(
+                        generation_settings,
+                        generated_content=st.session_state.generated_content
+                    ))
+                    st.rerun()
+            
             # Información del prompt usado
             with st.expander("🔍 Ver prompt utilizado para la imagen"):
                 st.code(used_prompt, language="text")
@@ -1823,6 +6634,8 @@ if st.session_state.generation_complete and st.session_state.generated_content:
                     st.success("🧠 Este prompt fue generado por Claude analizando todo el contenido del texto")
                 elif custom_prompt_used:
                     st.info("👤 Este fue tu prompt personalizado")
+                elif local_prompt:
+                    st.info("⚡ Este prompt se construyó localmente con las palabras clave del texto")
                 else:
                     st.warning("⚙️ Prompt básico generado automáticamente")
             
@@ -1831,6 +6644,8 @@ if st.session_state.generation_complete and st.session_state.generated_content:
                 st.success("✨ Se utilizó tu prompt personalizado para la imagen")
             elif intelligent_prompt:
                 st.success("🤖 Claude analizó el contenido completo para generar un prompt visual optimizado")
+            elif local_prompt:
+                st.info("⚡ Se usó el modo rápido: prompt local sin llamada adicional a Claude")
             else:
                 st.info("⚙️ Se usó el método básico de generación de prompt")
             
@@ -1843,6 +6658,58 @@ if st.session_state.generation_complete and st.session_state.generated_content:
                 mime="image/png",
                 key=f"download_image_{img_timestamp}"
             )
+            
+            render_export_panel([(f"flux_image_{img_timestamp}", st.session_state.generated_content['image'])], "imagen")
+            
+            # Barrido de estilos × seeds sobre el prompt de la imagen
+            with st.expander("🎛️ Barrido de estilos y seeds"):
+                sweep = st.session_state.style_sweep or {}
+                sweep_prompt = st.text_area(
+                    "Prompt del barrido",
+                    value=sweep.get("prompt") or used_prompt,
+                    key="sweep_prompt",
+                    help="Se quitan sus menciones de estilo y cada fila lo envuelve en el suyo"
+                )
+                sweep_styles = st.multiselect(
+                    "Estilos",
+                    IMAGE_STYLES,
+                    default=sweep.get("styles") or [style if style in IMAGE_STYLES else image_style],
+                    key="sweep_styles"
+                )
+                sweep_seeds = st.number_input("Seeds por estilo", 1, STYLE_SWEEP_MAX_SEEDS, sweep.get("seeds", 2),
+                                              key="sweep_seed_count")
+                planned_cells = plan_style_sweep(sweep_prompt, sweep_styles, int(sweep_seeds), flux_model,
+                                                 effective_width, effective_height, effective_steps)
+                cached_cells = sweep.get("cells", {})
+                pending_cells = sum(1 for cell in planned_cells if cell["key"] not in cached_cells)
+                st.caption(f"{len(planned_cells)} celdas • {pending_cells} por renderizar • "
+                           f"hasta {effective_concurrency} a la vez")
+                if st.button("🎛️ Renderizar cuadrícula", key="run_style_sweep",
+                             disabled=not bfl_api_key or task_running or not planned_cells or not sweep_prompt.strip()):
+                    start_generation_task(run_style_sweep, dict(
+                        generation_settings,
+                        style_sweep=st.session_state.style_sweep,
+                        sweep_prompt=sweep_prompt,
+                        sweep_styles=list(sweep_styles),
+                        sweep_seeds=int(sweep_seeds)
+                    ))
+                    st.rerun()
+                
+                grid = [cached_cells.get(key) for key in sweep.get("grid", [])]
+                for row_style in sweep.get("styles", []):
+                    row_cells = [cell for cell in grid if cell and cell["style"] == row_style]
+                    if not row_cells:
+                        continue
+                    st.markdown(f"**{row_style}**")
+                    sweep_columns = st.columns(sweep["seeds"])
+                    for column, cell in zip(sweep_columns, row_cells):
+                        with column:
+                            st.image(cell["image_bytes"], caption=f"seed {cell['seed']}")
+                            is_final = metadata.get("used_prompt") == cell["prompt"] and metadata.get("seed") == cell["seed"]
+                            if st.button("⭐ Usar como final", key=f"promote_sweep_{row_style}_{cell['seed']}",
+                                         disabled=is_final or task_running):
+                                promote_sweep_cell(cell)
+                                st.rerun()
     
     # Mostrar audio
     if 'audio' in st.session_state.generated_content:
@@ -1855,7 +6722,12 @@ if st.session_state.generation_complete and st.session_state.generated_content:
             voice = metadata.get('voice', 'N/A')
             size_kb = metadata.get('size_kb', 0)
             
-            st.caption(f"🎧 Voz: {voice} • Tamaño: {size_kb:.1f} KB")
+            dialogue_voices = metadata.get('dialogue_voices')
+            if dialogue_voices:
+                cast = ", ".join(f"{speaker}: {speaker_voice}" for speaker, speaker_voice in dialogue_voices.items())
+                st.caption(f"🎧 Voces: {cast} • Narración: {voice} • Tamaño: {size_kb:.1f} KB")
+            else:
+                st.caption(f"🎧 Voz: {voice} • Tamaño: {size_kb:.1f} KB")
             
             # Botón para descargar audio con key única
             audio_timestamp = metadata.get('timestamp', int(time.time()))
@@ -1867,6 +6739,43 @@ if st.session_state.generation_complete and st.session_state.generated_content:
                 key=f"download_audio_{audio_timestamp}"
             )
     
+    # Variantes en otros idiomas (comparten la imagen o la secuencia de arriba)
+    language_variants = st.session_state.generated_content.get('language_variants')
+    if language_variants:
+        st.header("🌍 Variantes por idioma")
+        st.caption("Misma imagen/secuencia para todas las variantes; solo cambian el texto y el audio")
+        variants_timestamp = st.session_state.generated_content.get('text_metadata', {}).get('timestamp', int(time.time()))
+        for tab, (language, variant) in zip(st.tabs(list(language_variants)), language_variants.items()):
+            with tab:
+                st.markdown(variant["text"])
+                col_text, col_audio = st.columns(2)
+                with col_text:
+                    st.download_button(
+                        label="📥 Descargar texto",
+                        data=variant["text"],
+                        file_name=f"contenido_{language}_{variants_timestamp}.txt",
+                        mime="text/plain",
+                        key=f"download_variant_text_{language}_{variants_timestamp}"
+                    )
+                if variant["audio"]:
+                    st.audio(variant["audio"], format="audio/mp3")
+                    with col_audio:
+                        st.download_button(
+                            label="📥 Descargar audio",
+                            data=variant["audio"],
+                            file_name=f"audio_tts_{language}_{variants_timestamp}.mp3",
+                            mime="audio/mp3",
+                            key=f"download_variant_audio_{language}_{variants_timestamp}"
+                        )
+                st.caption(f"⏱️ {variant['seconds']:.1f} s (adaptación + audio, en paralelo con el resto)")
+    
+    # Cerrar el perfil de memoria tras el primer render de resultados
+    if memory_profiler:
+        memory_profiler.checkpoint("render resultados")
+        memory_profiler.stop()
+        st.session_state.generated_content['memory_profile'] = memory_profiler.report()
+        memory_profiler = None
+    
     # Estadísticas finales (MEJORADAS CON SECUENCIAS)
     with st.expander("📈 Estadísticas de generación"):
         if st.session_state.sequence_generation_complete:
@@ -1904,9 +6813,130 @@ if st.session_state.generation_complete and st.session_state.generated_content:
             with col_stats4:
                 content_type = text_meta.get('content_type', 'texto')
                 st.metric("Tipo contenido", content_type.title())
-    
+        
+        # Tiempos y memoria por etapa (exportables juntos)
+        stage_timings_data = st.session_state.generated_content.get('stage_timings', {})
+        memory_profile = st.session_state.generated_content.get('memory_profile')
+        if 'prompt' in stage_timings_data:
+            st.caption(f"⏱️ Construcción del prompt visual: {stage_timings_data['prompt'] * 1000:.1f} ms "
+                       f"de {stage_timings_data.get('images', 0):.1f} s de la etapa de imagen")
+        if memory_profile:
+            st.markdown("**🧠 Memoria por etapa**")
+            st.caption("Cada fila cubre el intervalo desde el punto de control anterior: con etapas en paralelo "
+                       "(audio, idiomas e imágenes) las cifras acumulan todo lo que corría a la vez")
+            st.table([
+                {
+                    "Etapa": stage["stage"],
+                    "Pico (MB)": round(stage["peak_bytes"] / 2**20, 2),
+                    "Retenida (MB)": round(stage["retained_bytes"] / 2**20, 2),
+                    "Δ retenida (MB)": round(stage["delta_bytes"] / 2**20, 2)
+                }
+                for stage in memory_profile["stages"]
+            ])
+            heaviest = max(memory_profile["stages"], key=lambda stage: stage["peak_bytes"])
+            with st.expander(f"📍 Principales asignaciones ({heaviest['stage']})"):
+                for site in heaviest["top_allocations"]:
+                    st.caption(f"{site['site']}: {site['size_diff'] / 1024:+.1f} KB ({site['count_diff']:+d} bloques)")
+        # Tokens de Claude por llamada y de la generación completa
+        token_usage = st.session_state.generated_content.get('token_usage')
+        if token_usage and token_usage["calls"]:
+            totals = token_usage["totals"]
+            st.markdown("**🪙 Tokens de Claude**")
+            st.table([
+                {
+                    "Uso": purpose,
+                    "Llamadas": values["calls"],
+                    "Entrada (estimada)": values["estimated_input_tokens"],
+                    "Entrada": values["input_tokens"],
+                    "Salida": values["output_tokens"],
+                    "Caché (escritura/lectura)": f"{values['cache_creation_input_tokens']}/{values['cache_read_input_tokens']}",
+                    "Truncadas": values["truncated"],
+                    "Coste (USD)": round(values["cost_usd"], 4)
+                }
+                for purpose, values in token_usage["by_purpose"].items()
+            ])
+            st.caption(f"Total: {totals['input_tokens']} tokens de entrada • {totals['output_tokens']} de salida • "
+                       f"~{totals['cost_usd']:.4f} USD")
+            for trim in token_usage["trims"]:
+                st.caption(f"✂️ {trim['purpose']}: entrada resumida de ~{trim['estimated_before']} a ~{trim['estimated_after']} tokens "
+                           f"(presupuesto {token_usage['input_budget']})")
+        if stage_timings_data or memory_profile or token_usage:
+            st.download_button(
+                label="📥 Exportar tiempos, memoria y tokens (JSON)",
+                data=json.dumps({"stage_timings": stage_timings_data, "memory_profile": memory_profile, "token_usage": token_usage}, indent=2, ensure_ascii=False),
+                file_name=f"perfil_generacion_{st.session_state.generated_content.get('text_metadata', {}).get('timestamp', int(time.time()))}.json",
+                mime="application/json",
+                key="download_generation_profile"
+            )
+        
+        # Solicitudes idénticas agrupadas (single-flight) en este servidor
+        coalescer_stats = get_request_coalescer().stats()
+        if coalescer_stats:
+            st.caption("🔗 Solicitudes idénticas agrupadas: " + " • ".join(
+                f"{namespace}: {values['coalesced']} de {values['requests']} ({values['upstream']} llamadas reales)"
+                for namespace, values in coalescer_stats.items()
+            ))
+
+        # Avisos de Flux recibidos por webhook en este servidor
+        if flux_webhook:
+            webhook_receiver = get_flux_webhook_receiver()
+            if webhook_receiver is None:
+                st.caption(f"🔔 El puerto {FLUX_WEBHOOK_PORT} está ocupado: los renders se consultan por polling")
+            else:
+                webhook_stats = webhook_receiver.stats()
+                st.caption(f"🔔 Avisos de Flux recibidos por webhook: {webhook_stats['received']} • "
+                           f"renders esperando aviso: {webhook_stats['waiting']}")
+
+        # Solicitudes duplicadas por lentitud (hedging) en este servidor
+        hedge_stats = get_hedge_stats().stats()
+        if any(values["hedged"] for values in hedge_stats.values()):
+            st.caption("🏁 Hedging: " + " • ".join(
+                f"{kind}: {values['hedged']} de {values['requests']} duplicadas ({values['hedge_rate']:.0%}), "
+                f"{values['hedge_wins']} ganó el respaldo, ~{values['saved_seconds']:.1f} s ahorrados (estimados)"
+                for kind, values in hedge_stats.items()
+            ))
+
+        # Salud y uso de cada clave de API (pools por proveedor)
+        session_api_keys = {"anthropic": anthropic_api_key, "bfl": bfl_api_key, "openai": openai_api_key}
+        key_pool_rows = {provider: get_key_pool(provider).stats(session_api_keys[provider]) for provider in API_KEY_PROVIDERS}
+        if any(len(rows) > 1 or any(row["throttled"] for row in rows) for rows in key_pool_rows.values()):
+            with st.expander("🔑 Uso de las claves de API"):
+                for provider, rows in key_pool_rows.items():
+                    if not rows:
+                        continue
+                    st.markdown(f"**{API_KEY_PROVIDERS[provider]}**")
+                    st.table([
+                        {
+                            "Clave": row["key"],
+                            "Origen": row["source"],
+                            "Estado": row["health"],
+                            "En curso": f"{row['in_flight']}/{row['concurrency']}",
+                            "Solicitudes": row["requests"],
+                            "429": row["throttled"],
+                            "Errores": row["errors"],
+                            "Media (s)": round(row["mean_seconds"], 2)
+                        }
+                        for row in rows
+                    ])
+
+        # Caché de frases narradas
+        if tts_sentence_cache:
+            tts_stats = get_tts_cache().stats()
+            if tts_stats["hits"] or tts_stats["misses"]:
+                st.caption(f"♻️ Caché de frases narradas: {tts_stats['segments']} frases guardadas • "
+                           f"{tts_stats['hits']} reutilizadas y {tts_stats['misses']} sintetizadas en este servidor")
+        
+        # Índice local de imágenes reutilizables
+        if reuse_threshold is not None:
+            index_stats = get_image_index().stats()
+            st.caption(f"♻️ Índice de imágenes: {index_stats['entries']} renders guardados • "
+                       f"{index_stats['terms']} términos • umbral de reutilización {reuse_threshold:.0%}")
+
     # Botón para limpiar y empezar de nuevo
     if st.button("🔄 Generar Nuevo Contenido", type="secondary"):
+        discard_session_storyboard()
+        st.session_state.stage_memo = {}
+        st.session_state.style_sweep = None
         st.session_state.generated_content = {}
         st.session_state.generation_complete = False
         st.session_state.character_analysis = None
@@ -1914,100 +6944,126 @@ if st.session_state.generation_complete and st.session_state.generated_content:
         st.session_state.sequence_generation_complete = False
         st.rerun()
 
+# Si la generación falló antes de mostrar resultados, no dejar tracemalloc activo
+if memory_profiler:
+    memory_profiler.stop()
+    memory_profiler = None
+
 # ===== INFORMACIÓN ADICIONAL EN EL FOOTER =====
 st.markdown("---")
 
+# Ayuda bajo demanda: las pestañas solo se construyen y envían si se piden
+show_help = st.toggle("📖 Mostrar ayuda e información", value=False, key="show_help")
+
 # Tabs informativas (ACTUALIZADAS CON NUEVAS FUNCIONALIDADES)
-tab1, tab2, tab3, tab4 = st.tabs(["📚 Instrucciones", "🔑 APIs", "💡 Consejos", "⚡ Modelos"])
-
-with tab1:
-    st.markdown("""
-    ### Cómo usar la aplicación:
-    
-    1. **🔧 Configura las APIs**: Ingresa tus claves en la barra lateral
-    2. **✏️ Escribe tu prompt**: Describe detalladamente qué quieres generar  
-    3. **📋 Selecciona el tipo**: Ahora con **13 tipologías** diferentes disponibles
-    4. **🎭 Activa secuencias**: Para contenido con personajes (opcional)
-    5. **⚙️ Personaliza**: Ajusta modelos y configuraciones según tus necesidades
-    6. **🚀 Genera**: Presiona el botón y espera tu contenido multimedia completo
-    
-    ### 🆕 **Nuevas funcionalidades:**
-    
-    **🎭 Modo Secuencia de Personajes:**
-    - Detecta automáticamente personajes en relatos y cuentos
-    - Genera múltiples imágenes con el mismo personaje
-    - Usa seeds consistentes para mantener apariencia
-    - Perfect para cuentos infantiles y material educativo
-    
-    **📋 13 Tipologías Especializadas:**
-    - Cada tipo tiene prompts optimizados
-    - Formatos específicos y extensiones adaptadas
-    - Ejemplos y plantillas incluidas
-    """)
-
-with tab2:
-    st.markdown("""
-    ### APIs necesarias:
-    
-    **🧠 Anthropic API (Claude Sonnet 4)**
-    - Regístrate en: https://console.anthropic.com/
-    - Usado para: Generación de texto + Análisis de personajes + Prompts visuales inteligentes
-    
-    **🎨 Black Forest Labs API (Flux)**
-    - Regístrate en: https://api.bfl.ml/
-    - Usado para: Generación de imágenes + Secuencias con seeds consistentes
-    
-    **🗣️ OpenAI API (TTS)**
-    - Regístrate en: https://platform.openai.com/
-    - Usado para: Conversión de texto a voz de alta calidad
-    """)
-
-with tab3:
-    st.markdown("""
-    ### Consejos para mejores resultados:
-    
-    **📝 Para secuencias de personajes:**
-    - Describe claramente los personajes en tu relato
-    - Incluye características físicas específicas
-    - Usa nombres para los personajes principales
-    - El sistema funciona mejor con 1-3 personajes
-    
-    **🎨 Para imágenes:**
-    - **Automático Inteligente**: Claude adapta el análisis visual a cada tipología
-    - **Personalizado**: Escribe tu prompt EN INGLÉS para control total
-    - **Seeds consistentes**: Garantizan el mismo personaje en múltiples imágenes
-    """)
-
-with tab4:
-    st.markdown("""
-    ### Información de los modelos:
-    
-    **🧠 Claude Sonnet 4 (2025)**
-    - Análisis de personajes con IA
-    - Generación de prompts visuales optimizados
-    - 13 tipologías especializadas de contenido
-    
-    **🎨 Flux Pro 1.1 / Ultra**
-    - Generación de imágenes de alta calidad
-    - Soporte para seeds consistentes
-    - Múltiples estilos visuales
-    
-    **🗣️ OpenAI TTS-1-HD**
-    - 6 voces diferentes con personalidades únicas
-    - Calidad de audio profesional
-    
-    ### 🎭 **Sistema de Consistencia de Personajes:**
-    
-    **Cómo funciona:**
-    1. Claude analiza el texto y detecta personajes
-    2. Extrae características físicas específicas
-    3. Genera seed único por personaje
-    4. Crea múltiples escenas con el mismo seed
-    5. Resultado: Mismo personaje en diferentes situaciones
-    
-    **Casos de uso perfectos:**
-    - Cuentos infantiles con protagonistas
-    - Material educativo con personajes recurrentes
-    - Relatos con secuencias narrativas
-    - Historias que requieren continuidad visual
-    """)
+if show_help:
+    tab1, tab2, tab3, tab4 = st.tabs(["📚 Instrucciones", "🔑 APIs", "💡 Consejos", "⚡ Modelos"])
+    
+    with tab1:
+        st.markdown("""
+        ### Cómo usar la aplicación:
+    
+        1. **🔧 Configura las APIs**: Ingresa tus claves en la barra lateral
+        2. **✏️ Escribe tu prompt**: Describe detalladamente qué quieres generar  
+        3. **📋 Selecciona el tipo**: Ahora con **13 tipologías** diferentes disponibles
+        4. **🎭 Activa secuencias**: Para contenido con personajes (opcional)
+        5. **⚙️ Personaliza**: Ajusta modelos y configuraciones según tus necesidades
+        6. **🚀 Genera**: Presiona el botón y espera tu contenido multimedia completo
+    
+        ### 🆕 **Nuevas funcionalidades:**
+    
+        **🎭 Modo Secuencia de Personajes:**
+        - Detecta automáticamente personajes en relatos y cuentos
+        - Genera múltiples imágenes con el mismo personaje
+        - Usa seeds consistentes para mantener apariencia
+        - Perfect para cuentos infantiles y material educativo
+    
+        **📋 13 Tipologías Especializadas:**
+        - Cada tipo tiene prompts optimizados
+        - Formatos específicos y extensiones adaptadas
+        - Ejemplos y plantillas incluidas
+        """)
+
+    with tab2:
+        st.markdown("""
+        ### APIs necesarias:
+    
+        **🧠 Anthropic API (Claude Sonnet 4)**
+        - Regístrate en: https://console.anthropic.com/
+        - Usado para: Generación de texto + Análisis de personajes + Prompts visuales inteligentes
+    
+        **🎨 Black Forest Labs API (Flux)**
+        - Regístrate en: https://api.bfl.ml/
+        - Usado para: Generación de imágenes + Secuencias con seeds consistentes
+    
+        **🗣️ OpenAI API (TTS)**
+        - Regístrate en: https://platform.openai.com/
+        - Usado para: Conversión de texto a voz de alta calidad
+        """)
+
+    with tab3:
+        st.markdown("""
+        ### Consejos para mejores resultados:
+    
+        **📝 Para secuencias de personajes:**
+        - Describe claramente los personajes en tu relato
+        - Incluye características físicas específicas
+        - Usa nombres para los personajes principales
+        - El sistema funciona mejor con 1-3 personajes
+    
+        **🎨 Para imágenes:**
+        - **Automático Inteligente**: Claude adapta el análisis visual a cada tipología
+        - **Personalizado**: Escribe tu prompt EN INGLÉS para control total
+        - **Seeds consistentes**: Garantizan el mismo personaje en múltiples imágenes
+        """)
+
+    with tab4:
+        st.markdown("""
+        ### Información de los modelos:
+    
+        **🧠 Claude Sonnet 4 (2025)**
+        - Análisis de personajes con IA
+        - Generación de prompts visuales optimizados
+        - 13 tipologías especializadas de contenido
+    
+        **🎨 Flux Pro 1.1 / Ultra**
+        - Generación de imágenes de alta calidad
+        - Soporte para seeds consistentes
+        - Múltiples estilos visuales
+    
+        **🗣️ OpenAI TTS-1-HD**
+        - 6 voces diferentes con personalidades únicas
+        - Calidad de audio profesional
+    
+        ### 🎭 **Sistema de Consistencia de Personajes:**
+    
+        **Cómo funciona:**
+        1. Claude analiza el texto y detecta personajes
+        2. Extrae características físicas específicas
+        3. Genera seed único por personaje
+        4. Crea múltiples escenas con el mismo seed
+        5. Resultado: Mismo personaje en diferentes situaciones
+    
+        **Casos de uso perfectos:**
+        - Cuentos infantiles con protagonistas
+        - Material educativo con personajes recurrentes
+        - Relatos con secuencias narrativas
+        - Historias que requieren continuidad visual
+        """)
+
+
+# ===== COSTE DE EJECUCIÓN DEL SCRIPT =====
+@st.cache_resource
+def get_startup_stats() -> Dict[str, Any]:
+    """Duración de la primera ejecución del script en este proceso (arranque en frío)"""
+    return {"first_run_seconds": None}
+
+
+script_seconds = time.perf_counter() - SCRIPT_START
+startup_stats = get_startup_stats()
+if startup_stats["first_run_seconds"] is None:
+    startup_stats["first_run_seconds"] = script_seconds
+st.caption(
+    f"⚙️ Ejecución del script: {script_seconds * 1000:.0f} ms • "
+    f"primera ejecución del proceso: {startup_stats['first_run_seconds'] * 1000:.0f} ms"
+)